@@ -1,27 +1,46 @@
 # -*- coding: utf-8 -*-
 
 import collections
+import concurrent.futures
+import csv
+import datetime
 import decorator
 import flask
-import iiif_prezi.factory
 import json
 from markupsafe import Markup
 import mwapi
 import mwoauth
+import orjson
 import os
 import random
 import re
 import requests
 import requests_oauthlib
+import secrets
+import sqlite3
 import stat
 import string
+import threading
+import time
 import toolforge
 import urllib.parse
 import yaml
 import math
 
-from exceptions import WrongDataValueType
+from exceptions import InvalidOperation, UpstreamUnavailable, WrongDataValueType
+import autocomplete
+import cache
+import entities
+import export
+import importer
 import messages
+import metrics
+import outbox
+import profiling
+import recentchanges
+import regions
+import upstream
+import writebehind
 
 import queries
 from consts import *
@@ -39,6 +58,25 @@ requests_session.headers.update({
 
 default_property = 'P18'
 
+# stale-while-revalidate caches of upstream data (see cache.py):
+# fresh for the first duration, then served stale while refreshed in the background for the second
+ENTITY_TTL = 5 * 60  # without the recent changes, see RECENT_CHANGES_ENTITY_TTL
+entity_cache = cache.StaleWhileRevalidateCache('entities', maxsize=8192, ttl=ENTITY_TTL, stale_ttl=24 * 60 * 60)
+image_cache = cache.StaleWhileRevalidateCache('images', maxsize=8192, ttl=60 * 60, stale_ttl=7 * 24 * 60 * 60)
+formatted_value_cache = cache.StaleWhileRevalidateCache('formatted_values', maxsize=8192, ttl=24 * 60 * 60, stale_ttl=7 * 24 * 60 * 60)
+sparql_cache = cache.StaleWhileRevalidateCache('sparql', maxsize=2048, ttl=10 * 60, stale_ttl=24 * 60 * 60)
+# pages of the IIIF collection, built from the caches above
+collection_cache = cache.StaleWhileRevalidateCache('collection', maxsize=1024, ttl=60 * 60, stale_ttl=24 * 60 * 60)
+# the item search of the statement editor: the index of depicted items, and the wbsearchentities results it falls back to
+depicted_index_cache = cache.StaleWhileRevalidateCache('depicted_index', maxsize=1, ttl=10 * 60, stale_ttl=24 * 60 * 60)
+depicted_index_warmed = threading.Event()
+search_cache = cache.StaleWhileRevalidateCache('search', maxsize=8192, ttl=24 * 60 * 60, stale_ttl=7 * 24 * 60 * 60)
+
+COLLECTION_PAGE_SIZE = 100  # manifests per page of the IIIF collection
+REVIEW_ORDERS = ('oldest', 'statements')  # orders of the review queue, see queries.get_review_queue
+# seconds a bulk upload holds its unfinished pairs without progress; after that they count as interrupted (e.g. by a restart)
+BULK_UPLOAD_LEASE = 10 * 60
+
 depicted_properties = {
     # first label is used in dropdown,
     # second forms “… with no region specified” list label
@@ -72,20 +110,187 @@ else:
     print('config.yaml file not found, assuming local development setup')
     app.secret_key = 'fake'
 
+# the upstream APIs can be pointed elsewhere, e.g. at the local stand-in used by the benchmarks
+app.config.setdefault('API_HOSTS', {})  # domain -> base URL (scheme and host, no trailing slash)
+app.config.setdefault('SPARQL_ENDPOINT', 'https://query.wikidata.org/sparql')
+# requests with ?profile=1 are profiled for project leads, or for everyone if PROFILING is true
+app.config.setdefault('PROFILING', False)
+app.config.setdefault('PROFILE_DIRECTORY', 'profiles')
+# bulk uploads by project leads make this many uploads at a time
+app.config.setdefault('BULK_UPLOAD_CONCURRENCY', 2)
+# region updates are buffered for this many seconds, so that only the last one of a drag/resize is written (0 disables this)
+app.config.setdefault('QUALIFIER_WRITE_DELAY', 1.0)
+# approval emails to the same user within this many seconds are sent as one digest, by a background worker
+# (only started with a config.yaml, since the emails are sent with the project lead's OAuth access token)
+app.config.setdefault('EMAIL_DIGEST_WINDOW', 300)
+app.config.setdefault('EMAIL_WORKER', has_config)
+# the OAuth access tokens of project leads are only kept in memory, so digests queued by a process that has since restarted
+# are sent from the tool's own account, if EMAIL_ACCESS_TOKEN ({key: ..., secret: ...}) is set in config.yaml
+app.config.setdefault('EMAIL_ACCESS_TOKEN', None)
+# labels and descriptions are loaded in these languages for everyone, and the fallback through the user's languages
+# happens locally, so the cached entity data is shared; other languages fall back to these
+app.config.setdefault('ENTITY_LANGUAGES', ['en', 'ar', 'de', 'el', 'es', 'fr', 'he', 'it', 'ja', 'nl', 'pl', 'pt', 'ru', 'tr', 'zh'])
+# the recent changes of Wikidata and Commons are polled every RECENT_CHANGES_INTERVAL seconds, and the cached data of edited pages is dropped;
+# meanwhile, cached entities are kept for RECENT_CHANGES_ENTITY_TTL seconds instead of a few minutes
+app.config.setdefault('RECENT_CHANGES', has_config)
+app.config.setdefault('RECENT_CHANGES_INTERVAL', 10)
+app.config.setdefault('RECENT_CHANGES_ENTITY_TTL', 24 * 60 * 60)
+# the index of depicted items for the item search is built in the background when the first request comes in,
+# rather than by the first search (only started with a config.yaml, since it loads every corpus item)
+app.config.setdefault('DEPICTED_INDEX_WARMUP', has_config)
+# item searches that the index of depicted items cannot fill are passed on to wbsearchentities,
+# at most SEARCH_RATE times per second on average (in bursts of up to SEARCH_BURST) for all users together
+app.config.setdefault('SEARCH_RATE', 2)
+app.config.setdefault('SEARCH_BURST', 10)
+# pages for visitors without an OAuth session are the same for everyone with the same languages, and are cached
+# for PAGE_CACHE_TTL seconds (unless the data they were built from changes first); proxies and browsers may keep them
+# for PAGE_CACHE_MAX_AGE seconds, since their copies are not dropped on changes
+app.config.setdefault('PAGE_CACHE_TTL', 5 * 60)
+app.config.setdefault('PAGE_CACHE_MAX_AGE', 60)
+# in the review queue of project leads, the data of this many following entries is loaded in the background
+app.config.setdefault('REVIEW_PREFETCH', 3)
+
+qualifier_buffer = writebehind.QualifierBuffer(app.config['QUALIFIER_WRITE_DELAY'])
+search_limiter = upstream.RateLimiter(app.config['SEARCH_RATE'], app.config['SEARCH_BURST'])
+# no stale period: a page is rendered in the request, not refreshed in the background
+page_cache = cache.StaleWhileRevalidateCache('pages', maxsize=2048, ttl=app.config['PAGE_CACHE_TTL'], stale_ttl=0)
+# the rendered depicteds of an entity, keyed by its revision and the version of the local annotations they include
+fragment_cache = cache.StaleWhileRevalidateCache('fragments', maxsize=4096, ttl=60 * 60, stale_ttl=0)
+page_invalidations = {}  # dependency -> time of its last invalidation, to catch pages that were being rendered meanwhile
+page_invalidations_lock = threading.Lock()
+# one thread loads the next entries of the review queue, it only warms the caches and should not compete with requests
+review_prefetch_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='review-prefetch')
+review_prefetching = set()  # (item ID, username) pairs queued or being loaded
+review_prefetching_lock = threading.Lock()
+
+def send_approval_digest(username, emails):
+    """Sends one email about the approved items of an outbox digest, on behalf of the last project lead who approved them
+    whose access token this process has, or else from the EMAIL_ACCESS_TOKEN account"""
+    subject, text = approval_email({email['item_id']: email['item_url'] for email in emails},
+                                   uploaded=all(email['uploaded'] for email in emails))
+    access_tokens = [email_outbox.access_token(email['project_lead_username']) for email in reversed(emails)]
+    access_token = next((access_token for access_token in access_tokens if access_token is not None), app.config['EMAIL_ACCESS_TOKEN'])
+    if access_token is None:
+        raise outbox.NoSender('No access token to send the email with in this process')
+    session = oauth_session('www.wikidata.org', access_token)
+    token = session.get(action='query', meta='tokens', type='csrf')['query']['tokens']['csrftoken']
+    session.post(action='emailuser', target=username, subject=subject, text=text, token=token)
+
+email_outbox = outbox.Outbox(send_approval_digest, app.config['EMAIL_DIGEST_WINDOW'])
+
+def invalidate_changed_page(domain, change):
+    """Drops the cached data that came from a page edited since it was loaded (see recentchanges.py)"""
+    if domain == 'www.wikidata.org':
+        # items are in the main namespace, properties in the Property: namespace
+        entity_id = change['title'].split(':')[-1]
+        entity_cache.invalidate_where(lambda key: key[0] == domain and key[1] == entity_id)
+        invalidate_rendered((domain, entity_id))
+        page = collection_page_of(entity_id)
+        if page is not None:
+            collection_cache.invalidate_where(lambda key: key[2] == page)
+    else:
+        image_title = change['title'][len('File:'):]
+        image_cache.invalidate(('image', image_title))
+        image_cache.invalidate(('imageinfo', 'File:' + image_title.replace(' ', '_')))
+        entity_cache.invalidate_where(lambda key: key[0] == domain and key[1] == 'M' + str(change['pageid']))
+        invalidate_rendered(('image', image_title))
+        invalidate_rendered((domain, 'M' + str(change['pageid'])))
+
+def recent_changes_health(healthy):
+    """Keeps entities for a day only while the recent changes are read, otherwise edits would go unnoticed that long"""
+    entity_cache.ttl = app.config['RECENT_CHANGES_ENTITY_TTL'] if healthy else ENTITY_TTL
+
+RECENT_CHANGES_NAMESPACES = {'www.wikidata.org': [0, 120], 'commons.wikimedia.org': [6]}
+recent_changes = recentchanges.RecentChanges(lambda domain: anonymous_session(domain), invalidate_changed_page,
+                                             RECENT_CHANGES_NAMESPACES, app.config['RECENT_CHANGES_INTERVAL'], recent_changes_health)
+
+def api_host(domain):
+    return app.config['API_HOSTS'].get(domain, 'https://' + domain)
+
 def anonymous_session(domain):
-    host = 'https://' + domain
-    return mwapi.Session(host=host, user_agent=user_agent, formatversion=2)
+    host = api_host(domain)
+    return upstream.Session(host=host, user_agent=user_agent, formatversion=2)
 
 def authenticated_session(domain):
     if 'oauth_access_token' not in flask.session:
         return None
-    host = 'https://' + domain
-    access_token = mwoauth.AccessToken(**flask.session['oauth_access_token'])
+    return oauth_session(domain, flask.session['oauth_access_token'])
+
+def oauth_session(domain, access_token):
+    """Returns a session authenticated with the given OAuth access token (a dict with key and secret), also outside of requests"""
+    host = api_host(domain)
+    access_token = mwoauth.AccessToken(**access_token)
     auth = requests_oauthlib.OAuth1(client_key=consumer_token.key, client_secret=consumer_token.secret,
                                     resource_owner_key=access_token.key, resource_owner_secret=access_token.secret)
-    return mwapi.Session(host=host, auth=auth, user_agent=user_agent, formatversion=2)
+    return upstream.Session(host=host, auth=auth, user_agent=user_agent, formatversion=2)
 
 
+@decorator.decorator
+def cached_page(func, *args, **kwargs):
+    """Serves the page from the page cache to visitors without an OAuth session, keyed by path and languages, see get_rendered"""
+    if 'oauth_access_token' in flask.session or flask.request.method != 'GET' or set(flask.request.args) - {'uselang'}:
+        response = flask.make_response(func(*args, **kwargs))
+        response.cache_control.private = True
+        return response
+
+    def render():
+        rendered = flask.make_response(func(*args, **kwargs))
+        return {
+            'body': rendered.get_data(),
+            'status': rendered.status_code,
+            'headers': [(name, value) for name, value in rendered.headers if name.lower() != 'set-cookie'],
+        }
+
+    page = get_rendered(page_cache, (flask.request.path, tuple(dict.fromkeys(request_language_codes()))), render)
+    response = flask.Response(page['body'], page['status'], page['headers'])
+    response.cache_control.public = True
+    response.cache_control.max_age = app.config['PAGE_CACHE_MAX_AGE']
+    response.vary.update(['Accept-Language', 'Cookie'])  # logged-in users get a different page
+    return response
+
+def get_rendered(rendered_cache, key, render):
+    """Returns the dict from render() through a cache of rendered pages or fragments.
+
+    While it is rendered, the entities and images it is built from are recorded with depend_on,
+    so that invalidate_rendered can drop it when one of them changes."""
+    def load():
+        started = time.monotonic()
+        outer = flask.g.pop('rendered_dependencies', None)
+        flask.g.rendered_dependencies = set()
+        try:
+            rendered = render()
+        finally:
+            dependencies = frozenset(flask.g.pop('rendered_dependencies'))
+            if outer is not None:
+                flask.g.rendered_dependencies = outer
+        return {**rendered, 'dependencies': dependencies, 'started': started}
+
+    rendered = rendered_cache.get(key, load)
+    if invalidated_since(rendered['dependencies'], rendered['started']):
+        rendered_cache.invalidate(key)  # something changed while it was rendered, it may be outdated already
+    depend_on(*rendered['dependencies'])  # e.g. the page a fragment is part of
+    return rendered
+
+def depend_on(*dependencies):
+    """Records data the page or fragment being rendered is built from, (domain, entity ID) or ('image', title), see get_rendered"""
+    if flask.has_request_context() and 'rendered_dependencies' in flask.g:
+        flask.g.rendered_dependencies.update(dependencies)
+
+def invalidate_rendered(dependency):
+    """Drops the cached pages and fragments that were built from an entity or image"""
+    now = time.monotonic()
+    with page_invalidations_lock:
+        if len(page_invalidations) > 1024:
+            for old in [old for old, invalidated in page_invalidations.items() if invalidated < now - 60]:
+                del page_invalidations[old]
+        page_invalidations[dependency] = now
+    for rendered_cache in (page_cache, fragment_cache):
+        rendered_cache.invalidate_where(lambda key: dependency in rendered_cache.peek(key, {'dependencies': ()})['dependencies'])
+
+def invalidated_since(dependencies, started):
+    with page_invalidations_lock:
+        return any(page_invalidations.get(dependency, started) > started for dependency in dependencies)
+
 @decorator.decorator
 def enableCORS(func, *args, **kwargs):
     rv = func(*args, **kwargs)
@@ -235,8 +440,9 @@ def item(item_id):
     return item_and_property(item_id, property_id=default_property)
 
 @app.route('/item/<item_id>/<property_id>')
+@cached_page
 def item_and_property(item_id, property_id):
-    item = load_item_and_property(item_id, property_id, include_depicteds=True)
+    item = load_item_and_property(item_id, property_id, include_depicteds_html=True)
     if 'image_title' not in item:
         return flask.render_template('item-without-image.html', **item)
     return flask.render_template('item.html', **item)
@@ -251,8 +457,96 @@ def iiif_manifest_with_property(item_id, property_id):
     item = load_item_and_property(item_id, property_id, include_description=True, include_metadata=True)
     if 'image_title' not in item:
         return '', 404
-    manifest = build_manifest(item)
-    return flask.jsonify(manifest.toJSON(top=True))
+    base_url = current_url()[:-len('/manifest.json')]
+    manifest = build_manifest(item, base_url, load_image_info(item['image_title']),
+                              image_attribution(item['image_title'], request_language_codes()))
+    return iiif_response(manifest)
+
+@app.route('/iiif/v3/<item_id>/<property_id>/manifest.json')
+@enableCORS
+def iiif_manifest_v3_with_property(item_id, property_id):
+    item = load_item_and_property(item_id, property_id, include_description=True, include_metadata=True)
+    if 'image_title' not in item:
+        return '', 404
+    base_url = current_url()[:-len('/manifest.json')]
+    manifest = build_manifest_v3(item, base_url, load_image_info(item['image_title']),
+                                 image_attribution(item['image_title'], request_language_codes()))
+    return iiif_response(manifest, 'application/ld+json;profile="http://iiif.io/api/presentation/3/context.json"')
+
+@app.route('/iiif/collection.json')
+@enableCORS
+def iiif_collection():
+    """A paged IIIF sc:Collection of the manifests of all dashboard items (Presentation API 2.1, see § Paging)"""
+    total = len(corpus_item_ids())
+    pages = max(math.ceil(total / COLLECTION_PAGE_SIZE), 1)
+    return iiif_response({
+        '@context': 'http://iiif.io/api/presentation/2/context.json',
+        '@id': full_url('iiif_collection'),
+        '@type': 'sc:Collection',
+        'label': 'Dura-Europos Wikidata Annotation Tool',
+        'total': total,
+        'first': full_url('iiif_collection_page', page=1),
+        'last': full_url('iiif_collection_page', page=pages),
+    })
+
+@app.route('/iiif/collection/<int:page>.json')
+@enableCORS
+def iiif_collection_page(page):
+    item_ids = corpus_item_ids()
+    pages = max(math.ceil(len(item_ids) / COLLECTION_PAGE_SIZE), 1)
+    if not 1 <= page <= pages:
+        return '', 404
+    language_codes = request_language_codes()
+    # the page only depends on the languages that entity data is loaded in, not on the whole fallback chain
+    key = (flask.request.host_url, flask.request.headers.get('X-Forwarded-Proto', 'http'), page, entity_language_codes(language_codes))
+    collection_page = collection_cache.get(key, lambda: build_collection_page(item_ids, page, pages, language_codes))
+    return iiif_response(collection_page)
+
+def build_collection_page(item_ids, page, pages, language_codes):
+    """Builds one page of the IIIF collection from the cached entity, label and image data"""
+    item_ids = item_ids[(page - 1) * COLLECTION_PAGE_SIZE:page * COLLECTION_PAGE_SIZE]
+    entities = load_entities('www.wikidata.org', item_ids, ['claims'])
+    labels = load_labels(item_ids, language_codes)
+    image_titles = {}
+    for item_id in item_ids:
+        image_datavalue = entities[item_id].images.get(default_property)
+        if image_datavalue is not None and image_datavalue['type'] == 'string':
+            image_titles[item_id] = image_datavalue['value']
+    image_infos = load_image_infos(set(image_titles.values()))
+
+    manifests = []
+    for item_id, image_title in image_titles.items():
+        image_info = image_infos[image_title]
+        if image_info is None:
+            continue
+        manifest = {
+            '@id': full_url('iiif_manifest_with_property', item_id=item_id, property_id=default_property),
+            '@type': 'sc:Manifest',
+            'label': language_string_wikibase_to_jsonld(labels[item_id]),
+        }
+        width, height = int(image_info['thumbwidth']), int(image_info['thumbheight'])
+        manifest['thumbnail'] = {
+            '@id': thumbnail_url(image_info, image_title),
+            '@type': 'dctypes:Image',
+            'format': image_info['mime'],
+            'width': 400,
+            'height': int(height * (400 / width)),
+        }
+        manifests.append(manifest)
+
+    collection_page = {
+        '@context': 'http://iiif.io/api/presentation/2/context.json',
+        '@id': full_url('iiif_collection_page', page=page),
+        '@type': 'sc:Collection',
+        'within': full_url('iiif_collection'),
+        'startIndex': (page - 1) * COLLECTION_PAGE_SIZE,
+        'manifests': manifests,
+    }
+    if page > 1:
+        collection_page['prev'] = full_url('iiif_collection_page', page=page - 1)
+    if page < pages:
+        collection_page['next'] = full_url('iiif_collection_page', page=page + 1)
+    return collection_page
 
 @app.route('/iiif/<item_id>/list/annotations.json')
 def iiif_annotations(item_id):
@@ -276,7 +570,7 @@ def iiif_annotations_with_property(item_id, property_id):
     }
 
     if 'image_title' not in item:
-        return flask.jsonify(annolist)
+        return iiif_response(annolist)
 
     canvas_url = url[:-len('list/annotations.json')] + 'canvas/c0.json'
     # Although the pct canvas is OK for the image API, we need to target
@@ -310,7 +604,7 @@ def iiif_annotations_with_property(item_id, property_id):
             h = int(float(parts[3]) * height / 100)
             anno['on'] = anno['on'] + '#xywh=' + ','.join(str(d) for d in [x, y, w, h])
         annolist['resources'].append(anno)
-    return flask.jsonify(annolist)
+    return iiif_response(annolist)
 
 @app.route('/iiif_region/<iiif_region>')
 def iiif_region(iiif_region):
@@ -318,22 +612,10 @@ def iiif_region(iiif_region):
 
 @app.route('/iiif_region/<iiif_region>/<property_id>')
 def iiif_region_and_property(iiif_region, property_id):
-    iiif_region_string = '"' + iiif_region.replace('\\', '\\\\').replace('"', '\\"') + '"'
-    property_claim_predicates = ' '.join(f'p:{property_id}' for property_id in depicted_properties)
-    query = '''
-      SELECT DISTINCT ?item WHERE {
-        VALUES ?p { %s }
-        ?item ?p [ pq:P2677 %s ].
-      }
-    ''' % (property_claim_predicates, iiif_region_string)
-    query_results = requests_session.get('https://query.wikidata.org/sparql',
-                                         params={'query': query}).json()
-
     items = []
     items_without_image = []
-    for result in query_results['results']['bindings']:
-        item_id = result['item']['value'][len('http://www.wikidata.org/entity/'):]
-        item = load_item_and_property(item_id, property_id, include_depicteds=True)
+    for item_id in items_with_region(iiif_region):
+        item = load_item_and_property(item_id, property_id, include_depicteds_html=True)
         if 'image_title' not in item:
             items_without_image.append(item_id)
         else:
@@ -341,7 +623,114 @@ def iiif_region_and_property(iiif_region, property_id):
 
     return flask.render_template('iiif_region.html', items=items, items_without_image=items_without_image)
 
+@app.route('/api/v2/regions')
+def api_regions():
+    """Returns the local regions containing a point (x and y, in percent) or overlapping a box (iiif_region),
+    on one item (item_id) or across all of them."""
+    if not get_userinfo():
+        return 'Not logged in', 403
+    item_id = flask.request.args.get('item_id')
+    if 'iiif_region' in flask.request.args:
+        box = regions.parse_pct_region(flask.request.args['iiif_region'])
+        if box is None:
+            return 'Bad iiif_region', 400
+    else:
+        try:
+            box = (float(flask.request.args['x']), float(flask.request.args['y']), 0.0, 0.0)
+        except (KeyError, ValueError):
+            return 'Incomplete query (x and y or iiif_region)', 400
+    if item_id is not None and not re.fullmatch('Q[1-9][0-9]*', item_id):
+        return 'Bad item ID', 400
+
+    return flask.jsonify(regions=[region_json(region) for region in local_regions_in_box(item_id, box)])
+
+@app.route('/api/v2/regions/duplicates')
+def api_region_duplicates():
+    """Returns the local regions whose intersection over union with a region (iiif_region) on one item (item_id)
+    is at least the threshold (default 0.8); without iiif_region, all such pairs of regions on the item(s)."""
+    if not get_userinfo():
+        return 'Not logged in', 403
+    item_id = flask.request.args.get('item_id')
+    if item_id is not None and not re.fullmatch('Q[1-9][0-9]*', item_id):
+        return 'Bad item ID', 400
+    try:
+        threshold = float(flask.request.args.get('threshold', 0.8))
+    except ValueError:
+        return 'Bad threshold', 400
+
+    if 'iiif_region' in flask.request.args:
+        box = regions.parse_pct_region(flask.request.args['iiif_region'])
+        if box is None or item_id is None:
+            return 'Bad iiif_region or missing item ID', 400
+        bounds = region_bounds(box)
+        duplicates = []
+        for region in local_regions_in_box(item_id, box):
+            overlap = intersection_over_union(bounds, (region['min_x'], region['max_x'], region['min_y'], region['max_y']))
+            if overlap >= threshold:
+                duplicates.append({**region_json(region), 'iou': overlap})
+        return flask.jsonify(duplicates=sorted(duplicates, key=lambda duplicate: -duplicate['iou']))
+
+    buffered = buffered_regions()
+    pairs = []
+    for row in queries.jsonify_rows(queries.query_db(queries.get_overlapping_region_pairs(), params=item_number_bounds(item_id))):
+        if row['statement_id'] in buffered or row['other_statement_id'] in buffered:
+            continue  # paired below, with the buffered region
+        overlap = intersection_over_union((row['min_x'], row['max_x'], row['min_y'], row['max_y']),
+                                          (row['other_min_x'], row['other_max_x'], row['other_min_y'], row['other_max_y']))
+        if overlap >= threshold:
+            pairs.append({'statement_ids': [row['statement_id'], row['other_statement_id']], 'iou': overlap})
+    for statement_id, row in buffered.items():
+        box = regions.parse_pct_region(row['iiif_region'])
+        if box is None or item_id not in (None, row['item_id']):
+            continue
+        for region in local_regions_in_box(row['item_id'], box, buffered):
+            other_id = region['statement_id']
+            if other_id == statement_id or (other_id in buffered and other_id < statement_id):
+                continue  # each pair once
+            overlap = intersection_over_union(region_bounds(box), (region['min_x'], region['max_x'], region['min_y'], region['max_y']))
+            if overlap >= threshold:
+                pairs.append({'statement_ids': sorted([statement_id, other_id]), 'iou': overlap})
+    return flask.jsonify(pairs=sorted(pairs, key=lambda pair: -pair['iou']))
+
+@app.route('/api/v2/search_depicted')
+def api_search_depicted():
+    """Suggests items for the statement editor: the depicted items of the corpus and of local statements
+    with a label starting with the search, most used first, followed by the results of wbsearchentities."""
+    search = flask.request.args.get('search', '').strip()
+    try:
+        limit = min(max(int(flask.request.args.get('limit', 7)), 1), 50)
+        offset = max(int(flask.request.args.get('continue', 0)), 0)
+    except ValueError:
+        return 'Bad limit or continue', 400
+    if not search:
+        return flask.jsonify(search=[])
+    language_codes = request_language_codes()
+
+    index = load_depicted_index() or autocomplete.DepictedIndex({}, {})  # only wbsearchentities until the index is ready
+    item_ids = index.search(search)
+    results = [{'id': item_id, 'uses': index.uses[item_id]} for item_id in item_ids[offset:offset + limit]]
+    entities_data = load_entities('www.wikidata.org', [result['id'] for result in results], ['descriptions', 'labels'])
+    for result in results:
+        entity = entities_data[result['id']]
+        result['label'] = language_fallback(entity.labels, language_codes)
+        result['description'] = language_fallback(entity.descriptions, language_codes)
+    more = len(item_ids) > offset + limit
+    if len(results) < limit:
+        try:
+            found = search_wikidata(search, language_codes[0])
+        except UpstreamUnavailable:
+            found = []  # rate limited or unavailable, the depicted items have to do
+        found = [result for result in found if result['id'] not in index.uses]
+        start = max(offset - len(item_ids), 0)
+        results += found[start:start + limit - len(results)]
+        more = len(item_ids) + len(found) > offset + limit
+    response = {'search': results}
+    if more:
+        response['search-continue'] = offset + limit
+    return flask.jsonify(response)
+
 @app.route('/file/<image_title>')
+@cached_page
 def file(image_title):
     image_title_ = image_title.replace(' ', '_')
     if image_title_.startswith('File:'):
@@ -359,7 +748,7 @@ def file_depicteds_html(image_title):
     file = load_file(image_title.replace('_', ' '))
     if not file:
         return flask.render_template('file-not-found.html', title=image_title), 404
-    return flask.render_template('depicteds.html', depicteds=file['depicteds'])
+    return file['depicteds_html']['regions']
 
 @app.route('/api/v1/add_statement/<domain>', methods=['POST'])
 def api_add_statement(domain):
@@ -463,6 +852,7 @@ def api_add_qualifier(domain):
     return flask.jsonify(qualifier_hash=None)
 
 @app.route('/dashboard/<page>')
+@cached_page
 def dashboard(page):
     page = int(page)
     entries = query_dashboard(page)
@@ -485,17 +875,12 @@ def dashboard(page):
     processed_entries = []
     # load all item ids and extract 
     language_codes = request_language_codes()
-    props = ['claims']
-    session = anonymous_session('www.wikidata.org')
-    api_response = session.get(action='wbgetentities',
-                               props=props,
-                               ids=entries,
-                               languages=language_codes)
+    entities = load_entities('www.wikidata.org', entries, ['claims'])
     for entry in entries:
         processed_entry = {
             'item_id': entry 
         }
-        image_datavalue = best_value(api_response['entities'][entry], default_property)
+        image_datavalue = entities[entry].images.get(default_property)
         processed_entry.update(load_image(image_datavalue['value'], language_codes))
         processed_entries.append(processed_entry)
 
@@ -532,17 +917,12 @@ def project_lead_dashboard(page):
     # need to get the images and stuff of each object
     objects_info = {}
     language_codes = request_language_codes()
-    props = ['claims']
-    session = anonymous_session('www.wikidata.org')
-    api_response = session.get(action='wbgetentities',
-                               props=props,
-                               ids=keys,
-                               languages=language_codes)
+    entities = load_entities('www.wikidata.org', keys, ['claims'])
     for key in keys:
         entry = {
             'item_id': key
         }
-        image_datavalue = best_value(api_response['entities'][key], default_property)
+        image_datavalue = entities[key].images.get(default_property)
         entry.update(load_image(image_datavalue['value'], language_codes))
         objects_info[key] = entry
     return flask.render_template('project-lead-dashboard.html', objects=trimmed_objects, objects_info=objects_info, pages=pages)
@@ -571,18 +951,13 @@ def annotations(page):
 
     # get actual object information for key list
     language_codes = request_language_codes()
-    props = ['claims']
-    session = anonymous_session('www.wikidata.org')
-    api_response = session.get(action='wbgetentities',
-                               props=props,
-                               ids=keys,
-                               languages=language_codes)
+    entities = load_entities('www.wikidata.org', keys, ['claims'])
     objects = []
     for key in keys:
         processed_entry = {
             'item_id': key
         }
-        image_datavalue = best_value(api_response['entities'][key], default_property)
+        image_datavalue = entities[key].images.get(default_property)
         processed_entry.update(load_image(image_datavalue['value'], language_codes))
 
         # check if this thing has been approved or not
@@ -680,11 +1055,14 @@ def api_add_qualifier_local(domain):
     if domain not in {'www.wikidata.org', 'commons.wikimedia.org'}:
         return 'Unsupported domain', 403
 
+    if regions.parse_pct_region(iiif_region) is None:
+        return 'Bad iiif_region', 400
+
     session = authenticated_session(domain)
     if session is None:
         return 'Not logged in', 403
     
-    queries.query_db(queries.add_qualifier(), params=[statement_id, iiif_region, (qualifier_hash if qualifier_hash else "")])
+    qualifier_buffer.put(statement_id, iiif_region, (qualifier_hash if qualifier_hash else ""))
 
     return flask.jsonify(qualifier_hash=None)
 
@@ -694,6 +1072,7 @@ def api_delete_statement_local():
     if not statement_id:
         return 'Incomplete form data', 400
     
+    qualifier_buffer.discard(statement_id)
     queries.query_db(queries.delete_statement(), params=[statement_id])
     queries.query_db(queries.delete_comment_with_statement_id(), params=[statement_id])
     
@@ -705,30 +1084,135 @@ def api_delete_qualifier_local():
     if not statement_id:
         return 'Incomplete form data', 400
 
+    qualifier_buffer.discard(statement_id)
     queries.query_db(queries.delete_qualifier(), params=[statement_id])
     
     statement = queries.jsonify_rows(queries.query_db(queries.get_statement(), params=[statement_id]))[0]
     language_codes = request_language_codes()   
-    depicted = {
-            'snaktype': statement['snaktype'],
-            'statement_id': statement['statement_id'],
-            'property_id': statement['property_id'],
-    }
-    if statement['snaktype'] == 'value':
-        depicted['item_id'] = statement['value_id']
-        labels = load_labels([statement['value_id']], language_codes)
-        depicted['label'] = labels[statement['value_id']]
-    else:
-        if statement['snaktype'] == 'somevalue':
-            depicted['label'] = messages.somevalue(language_codes[0])
-        elif statement['snaktype'] == 'novalue':
-            depicted['label'] = messages.novalue(language_codes[0])
-        else:
-            raise ValueError('Unknown snaktype')
+    labels = load_labels([statement['value_id']] if statement['snaktype'] == 'value' else [], language_codes)
+    depicted = local_depicted(statement, labels, language_codes)
   
     return flask.jsonify(depicted=depicted,
                          depicted_item_link=depicted_item_link(depicted))
 
+@app.route('/api/v2/batch_local/<domain>', methods=['POST'])
+def api_batch_local(domain):
+    """Applies an ordered list of local annotation writes in one transaction.
+
+    The operations form field is a JSON list of objects with an op and its arguments:
+    add_statement (snaktype, item_id, property_id, reference_type, reference_value, pages_value; for entity_id),
+    set_region (statement, iiif_region, qualifier_hash), delete_region (statement) and delete_statement (statement).
+    A statement is either the ID of an existing local statement or, as {"index": n},
+    the statement added by the nth operation of the same batch.
+    If any operation fails, none of them are applied.
+    """
+    entity_id = flask.request.form.get('entity_id')
+    csrf_token = flask.request.form.get('_csrf_token')
+    try:
+        operations = json.loads(flask.request.form.get('operations', ''))
+    except ValueError:
+        return 'Bad operations', 400
+    if not entity_id or not csrf_token or not isinstance(operations, list):
+        return 'Incomplete form data', 400
+
+    if csrf_token != flask.session['_csrf_token']:
+        return 'Wrong CSRF token (try reloading the page).', 403
+
+    if not flask.request.referrer.startswith(full_url('index')):
+        return 'Wrong Referer header', 403
+
+    if domain not in {'www.wikidata.org', 'commons.wikimedia.org'}:
+        return 'Unsupported domain', 403
+
+    session = authenticated_session(domain)
+    if session is None:
+        return 'Not logged in', 403
+
+    username = get_userinfo()['name']
+    statements = []
+    try:
+        # buffered regions of the statements in this batch must not be written over its changes later,
+        # so they are discarded once it is committed, without a flush in between
+        with qualifier_buffer.paused():
+            with queries.transaction() as connection:
+                for index, operation in enumerate(operations):
+                    statements.append(apply_local_operation(connection, index, operation, statements, entity_id, username))
+            for statement in statements:
+                qualifier_buffer.discard(statement['statement_id'])
+    except InvalidOperation as error:
+        return f'Operation {error.index}: {error.message}', 400
+
+    # render all the depicted items at once, so their labels are loaded in one batch
+    language_codes = request_language_codes()
+    labels = load_labels([statement['value_id'] for statement in statements if statement['snaktype'] == 'value'], language_codes)
+    results = []
+    for operation, statement in zip(operations, statements):
+        result = {'op': operation['op'], 'statement_id': statement['statement_id']}
+        if operation['op'] in {'add_statement', 'delete_region'}:
+            result['depicted'] = local_depicted(statement, labels, language_codes)
+            result['depicted_item_link'] = depicted_item_link(result['depicted'])
+        results.append(result)
+    return flask.jsonify(results=results)
+
+def apply_local_operation(connection, index, operation, statements, entity_id, username):
+    """Applies one operation of a local batch write, returning the statement it concerns.
+
+    statements are those of the preceding operations, for statement references by index."""
+    if not isinstance(operation, dict):
+        raise InvalidOperation(index, 'not an object')
+    op = operation.get('op')
+
+    if op == 'add_statement':
+        snaktype = operation.get('snaktype')
+        item_id = operation.get('item_id')
+        property_id = operation.get('property_id', 'P180')
+        reference_type = operation.get('reference_type')
+        reference_value = operation.get('reference_value')
+        pages_value = operation.get('pages_value')
+        if snaktype not in {'value', 'somevalue', 'novalue'}:
+            raise InvalidOperation(index, 'Bad snaktype')
+        if (snaktype == 'value') != (item_id is not None):
+            raise InvalidOperation(index, 'Inconsistent data')
+        if property_id not in depicted_properties:
+            raise InvalidOperation(index, 'Bad property ID')
+        if reference_type and reference_value:
+            if pages_value:
+                queries.query_db(queries.add_statement_with_reference_and_page(), params=[entity_id, property_id, item_id, snaktype, username, reference_type, reference_value, pages_value], connection=connection)
+            else:
+                queries.query_db(queries.add_statement_with_reference(), params=[entity_id, property_id, item_id, snaktype, username, reference_type, reference_value], connection=connection)
+        else:
+            queries.query_db(queries.add_statement(), params=[entity_id, property_id, item_id, snaktype, username], connection=connection)
+        statement_id = queries.jsonify_rows(queries.query_db(queries.get_last_inserted_statement(), connection=connection))[0]['statement_id']
+        return {'statement_id': statement_id, 'snaktype': snaktype, 'property_id': property_id, 'value_id': item_id}
+
+    if op not in {'set_region', 'delete_region', 'delete_statement'}:
+        raise InvalidOperation(index, 'Unknown op')
+    reference = operation.get('statement')
+    if isinstance(reference, dict):
+        if not isinstance(reference.get('index'), int) or not 0 <= reference['index'] < index:
+            raise InvalidOperation(index, 'Bad statement index')
+        statement = statements[reference['index']]
+    else:
+        rows = queries.jsonify_rows(queries.query_db(queries.get_statement(), params=[reference], connection=connection))
+        if not rows or rows[0]['username'] != username:
+            raise InvalidOperation(index, 'No such local statement')
+        statement = rows[0]
+    statement_id = statement['statement_id']
+
+    if op == 'set_region':
+        iiif_region = operation.get('iiif_region')
+        if not iiif_region:
+            raise InvalidOperation(index, 'Missing iiif_region')
+        if regions.parse_pct_region(iiif_region) is None:
+            raise InvalidOperation(index, 'Bad iiif_region')
+        queries.query_db(queries.add_qualifier(), params=[statement_id, iiif_region, operation.get('qualifier_hash') or ''], connection=connection)
+    elif op == 'delete_region':
+        queries.query_db(queries.delete_qualifier(), params=[statement_id], connection=connection)
+    else:
+        queries.query_db(queries.delete_statement(), params=[statement_id], connection=connection)
+        queries.query_db(queries.delete_comment_with_statement_id(), params=[statement_id], connection=connection)
+    return statement
+
 @app.route("/api/v2/add_comment", methods=['POST'])
 def api_add_comment():
     statement_id = flask.request.form.get('statement_id')
@@ -760,6 +1244,66 @@ def api_get_comments_own_user():
     result = queries.query_db(queries.get_comments(), params=[item_id, userinfo['name']])
     return queries.jsonify_rows(result)
 
+@app.route('/api/v2/annotations/<item_id>/delta')
+def api_annotations_delta(item_id):
+    """Returns what changed in the local annotations of a user (default: the logged-in one) on an item since a version:
+    the statements (with regions) and comments that were added or changed, the IDs of deleted ones, and the approval
+    if it changed; or 304 Not Modified. Without since (or with an unknown version), everything is returned."""
+    userinfo = get_userinfo()
+    if not userinfo:
+        return 'Not logged in', 403
+    username = flask.request.args.get('username', userinfo['name'])
+    if username != userinfo['name'] and deny_access():
+        return 'Only project leads can see the annotations of other users', 403
+    try:
+        since = int(flask.request.args.get('since', 0))
+    except ValueError:
+        return 'Bad since', 400
+
+    rows = queries.query_db(queries.get_annotation_version(), params=[item_id, username])
+    version = rows[0]['version'] if rows else 0
+    # the version covers the regions in the database; regions still in the write-behind buffer are sent until they are written
+    params = {'item_id': item_id, 'username': username}
+    buffered_ids = qualifier_buffer.statement_ids()
+    buffered_ids = [] if not buffered_ids else [row['statement_id'] for row in queries.query_db(
+        queries.get_local_statements_with_regions(), params={**params, 'statement_ids': json.dumps([int(statement_id) for statement_id in buffered_ids])})]
+    if since == version and not buffered_ids:
+        return '', 304
+
+    # partial replies need every change after since, the log of older versions may be pruned
+    full = not (0 < since <= version and (since == version or queries.query_db(queries.has_annotation_change(),
+                                                                               params=[item_id, username, since + 1])))
+    if full:
+        statement_ids = comment_ids = None
+        approval_changed = True
+    else:
+        changes = queries.query_db(queries.get_annotation_changes(), params=[item_id, username, since])
+        statement_ids = sorted({*buffered_ids, *(int(change['key']) for change in changes if change['kind'] == 'statement')})
+        comment_ids = [int(change['key']) for change in changes if change['kind'] == 'comment']
+        approval_changed = any(change['kind'] == 'approval' for change in changes)
+
+    statements = [] if statement_ids == [] else queries.jsonify_rows(queries.query_db(
+        queries.get_local_statements_with_regions(),
+        params={**params, 'statement_ids': None if statement_ids is None else json.dumps(statement_ids)}))
+    for statement in statements:
+        buffered = qualifier_buffer.get(statement['statement_id'])
+        if buffered:
+            statement['iiif_region'], statement['qualifier_hash'] = buffered
+    comments = [] if comment_ids == [] else queries.jsonify_rows(queries.query_db(
+        queries.get_comments_by_id(), params={**params, 'comment_ids': None if comment_ids is None else json.dumps(comment_ids)}))
+    delta = {
+        'version': version,
+        'full': full,
+        'statements': statements,
+        'deleted_statements': sorted(set(statement_ids or []) - {statement['statement_id'] for statement in statements}),
+        'comments': comments,
+        'deleted_comments': sorted(set(comment_ids or []) - {comment['comment_id'] for comment in comments}),
+    }
+    if approval_changed:
+        approval = queries.query_db(queries.get_approval(), params=[username, item_id])
+        delta['approved'] = bool(approval and approval[0]['approved'])
+    return flask.jsonify(delta)
+
 @app.route('/api/v2/upload_annotations', methods=["POST"])
 def api_upload_annotation():
     item_id = flask.request.form.get('item_id')
@@ -826,34 +1370,174 @@ def comment(item_id, username):
     if deny_access():
         return flask.render_template('no-access.html')
 
-    item = load_item_and_property(item_id=item_id, property_id=default_property, include_depicteds=True, local_only=True, username=username)
+    item = load_item_and_property(item_id=item_id, property_id=default_property, include_depicteds_html=True, local_only=True, username=username)
     return flask.render_template('comment.html', **item)
 
+@app.route('/review')
+def review():
+    """Opens the first entry of the review queue, oldest first or (?order=statements) most statements first"""
+    if deny_access():
+        return flask.render_template('no-access.html')
+
+    order = flask.request.args.get('order', 'oldest')
+    if order not in REVIEW_ORDERS:
+        return f'Unknown order {order!r}, must be one of {", ".join(REVIEW_ORDERS)}', 400
+    queue = review_queue(order)
+    if not queue:
+        return flask.render_template('review-done.html')
+    item_id, username = queue[0]
+    return flask.redirect(flask.url_for('review_entry', order=order, item_id=item_id, username=username))
+
+@app.route('/review/<order>/<item_id>/<username>')
+def review_entry(order, item_id, username):
+    """The comment page of an entry of the review queue, with links to the previous and next entries,
+    whose data is loaded into the caches in the background meanwhile"""
+    if deny_access():
+        return flask.render_template('no-access.html')
+    if order not in REVIEW_ORDERS:
+        return flask.redirect(flask.url_for('review'))
+
+    queue = review_queue(order)
+    if (item_id, username) in queue:
+        position = queue.index((item_id, username))
+        previous_entry = queue[position - 1] if position > 0 else None
+        following = queue[position + 1:]
+    else:
+        position = None  # e.g. approved meanwhile, the queue goes on with the oldest remaining entry
+        previous_entry = None
+        following = queue
+    language_codes = request_language_codes()
+    prefetch_review_entries(following[:app.config['REVIEW_PREFETCH']], language_codes)
+
+    item = load_item_and_property(item_id=item_id, property_id=default_property, include_depicteds_html=True, local_only=True,
+                                  username=username, language_codes=language_codes)
+    return flask.render_template('review.html', **item, order=order, position=position, queue_length=len(queue),
+                                 previous_entry=previous_entry, next_entry=following[0] if following else None)
+
 @app.route('/api/v2/emailuser', methods=["POST"])
 def api_email_user():
+    """Approves an item_id, username pair and queues the email telling the user, see outbox.py"""
     username = flask.request.form.get('username')
     item_id = flask.request.form.get('item_id')
-    subject = f"Annotations for object {item_id} approved"
-    link = "https://dura-europos-wd-annotation.toolforge.org" + str(flask.url_for('item', item_id=item_id))
-    text = f"Your annotations for object {item_id} have been approved on the Dura Europos Wikidata Annotation Tool. Please navigate to {link} or type in {item_id} into the lookup bar when you visit the homepage at https://dura-europos-wd-annotation.toolforge.org/"
+    userinfo = get_userinfo()
+    if not userinfo:
+        return 'Not logged in', 403
 
-    # update the database
-    queries.query_db(queries.add_approval(), params=[username, item_id, True])
+    with queries.transaction() as connection:
+        queries.query_db(queries.add_approval(), params=[username, item_id, True], connection=connection)
+        email_outbox.enqueue(username, item_id, item_url(item_id), False, userinfo['name'], flask.session['oauth_access_token'],
+                             connection=connection)
 
-    session = authenticated_session("www.wikidata.org")
-    if session is None:
+    return "Success", 200
+
+@app.route('/projectleaddashboard/bulk', methods=['POST'])
+def project_lead_bulk_upload():
+    """Approves and uploads many item_id, username pairs at once, in the background"""
+    if deny_access():
+        return flask.render_template('no-access.html')
+    if flask.request.form.get('_csrf_token') != flask.session.get('_csrf_token'):
+        return 'Wrong CSRF token (try reloading the page).', 403
+    pairs = []
+    for pair in flask.request.form.getlist('pair'):
+        item_id, _, username = pair.partition('|')
+        if item_id and username:
+            pairs.append((item_id, username))
+    if not pairs:
+        return flask.redirect(flask.url_for('project_lead_dashboard', page=1))
+
+    if authenticated_session('www.wikidata.org') is None:
         return 'Not logged in', 403
+    project_lead = get_userinfo()['name']
+    batch_id = secrets.token_hex(8)
+    with queries.transaction() as connection:
+        for item_id, username in pairs:
+            queries.query_db(queries.add_bulk_upload(), params=[batch_id, item_id, username, project_lead, time.time() + BULK_UPLOAD_LEASE],
+                             connection=connection)
+    start_bulk_upload(batch_id, pairs)
+    return flask.redirect(flask.url_for('project_lead_bulk_upload_status', batch_id=batch_id))
+
+@app.route('/projectleaddashboard/bulk/<batch_id>/retry', methods=['POST'])
+def project_lead_bulk_upload_retry(batch_id):
+    """Uploads the failed (or interrupted) pairs of a bulk upload again, with the session of the current project lead"""
+    if deny_access():
+        return flask.render_template('no-access.html')
+    if flask.request.form.get('_csrf_token') != flask.session.get('_csrf_token'):
+        return 'Wrong CSRF token (try reloading the page).', 403
+    with queries.transaction() as connection:
+        failed = queries.query_db(queries.get_failed_bulk_uploads(), params=[batch_id], connection=connection)
+        queries.query_db(queries.requeue_failed_bulk_uploads(), params=[time.time() + BULK_UPLOAD_LEASE, batch_id], connection=connection)
+    pairs = [(row['item_id'], row['username']) for row in failed]
+    if pairs:
+        start_bulk_upload(batch_id, pairs)
+    return flask.redirect(flask.url_for('project_lead_bulk_upload_status', batch_id=batch_id))
+
+def start_bulk_upload(batch_id, pairs):
+    """Runs the uploads of queued pairs in a background thread of this process, on behalf of the logged-in project lead"""
+    session = authenticated_session('www.wikidata.org')
     token = session.get(action='query', meta='tokens', type='csrf')['query']['tokens']['csrftoken']
-    try: 
-        response = session.post(action="emailuser",
-                                target=username,
-                                subject=subject,
-                                text=text,
-                                token=token)
-    except mwapi.errors.APIError as error:
-        return str(error), 500
+    project_lead = get_userinfo()['name']
+    item_links = {item_id: item_url(item_id) for item_id, _ in pairs}
+    access_token = flask.session['oauth_access_token']
+    threading.Thread(target=run_bulk_upload, args=(batch_id, pairs, session, token, item_links, project_lead, access_token), daemon=True).start()
+
+@app.route('/api/v2/export/<export_format>')
+def api_export(export_format):
+    """Streams the local annotations as ndjson, csv, quickstatements or wbeditentity, see export.py.
 
-    return "Success", 200    
+    Optional filters: username, item_id, approved (yes/no), since and until (dates or ISO 8601 timestamps, UTC)."""
+    if deny_access():
+        return flask.render_template('no-access.html'), 403
+    if export_format not in export.FORMATS:
+        return f'Unknown export format {export_format}', 404
+    args = flask.request.args
+    try:
+        approved = export.parse_approved(args.get('approved'))
+    except ValueError as error:
+        return str(error), 400
+    statements = export.statements(username=args.get('username') or None, item_id=args.get('item_id') or None, approved=approved,
+                                   since=args.get('since') or None, until=args.get('until') or None)
+    mimetype, extension = export.MEDIA_TYPES[export_format]
+    return flask.Response(export.FORMATS[export_format](statements), mimetype=mimetype,
+                          headers={'Content-Disposition': f'attachment; filename="annotations-{export_format}.{extension}"'})
+
+@app.route('/api/v2/import', methods=['POST'])
+def api_import():
+    """Imports annotations from an uploaded CSV file or IIIF annotation list, see importer.py.
+
+    Rows without a username are attributed to the username form field (default: the project lead);
+    with skip_invalid, the valid rows are imported even if some rows are invalid."""
+    if deny_access():
+        return flask.render_template('no-access.html'), 403
+    if flask.request.form.get('_csrf_token') != flask.session.get('_csrf_token'):
+        return 'Wrong CSRF token (try reloading the page).', 403
+    upload = flask.request.files.get('file')
+    if upload is None:
+        return 'No file', 400
+    try:
+        rows = importer.read(upload.read().decode('utf-8'))
+    except (UnicodeDecodeError, ValueError, csv.Error) as error:
+        return f'Could not read the file: {error}', 400
+    imported, errors = importer.import_annotations(
+        rows,
+        flask.request.form.get('username') or get_userinfo()['name'],
+        existing_items,
+        item_image_sizes,
+        skip_invalid=bool(flask.request.form.get('skip_invalid')))
+    response = {'imported': imported, 'errors': [{'row': number, 'error': error} for number, error in errors]}
+    return flask.jsonify(response), 400 if errors and not imported else 200
+
+@app.route('/projectleaddashboard/bulk/<batch_id>')
+def project_lead_bulk_upload_status(batch_id):
+    if deny_access():
+        return flask.render_template('no-access.html')
+    # the thread running a batch lives in one process only; if that process went away, its unfinished pairs can be retried
+    queries.query_db(queries.fail_interrupted_bulk_uploads(), params=['Interrupted (the tool was restarted), please retry', time.time()])
+    uploads = queries.jsonify_rows(queries.query_db(queries.get_bulk_uploads(), params=[batch_id]))
+    if not uploads:
+        return 'No such bulk upload', 404
+    done = all(upload['status'] in {'uploaded', 'failed'} for upload in uploads)
+    failed = any(upload['status'] == 'failed' for upload in uploads)
+    return flask.render_template('bulk-upload.html', batch_id=batch_id, uploads=uploads, done=done, failed=failed)
 
 @app.route('/api/v2/get_approved', methods=["POST"])
 def api_get_approved():
@@ -871,6 +1555,36 @@ def api_get_approved():
         result = [{'approved': 0}]
     return flask.jsonify(result)
 
+@app.route('/metrics')
+def prometheus_metrics():
+    """Latency histograms of outbound API calls, SPARQL queries, sqlite statements and requests of this worker"""
+    return flask.Response(metrics.prometheus_text(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/profiles')
+def profiles():
+    if not profiling_allowed():
+        return flask.render_template('no-access.html')
+    return flask.render_template('profiles.html', profiles=profiling.list_profiles(app.config['PROFILE_DIRECTORY']))
+
+@app.route('/profiles/<name>')
+def profile(name):
+    if not profiling_allowed():
+        return flask.render_template('no-access.html')
+    summary = profiling.load_profile(app.config['PROFILE_DIRECTORY'], name)
+    if summary is None:
+        return 'No such profile', 404
+    return flask.render_template('profile.html', profile=summary)
+
+@app.route('/profiles/<name>/folded')
+def profile_folded(name):
+    """The profile as folded stacks, for flamegraph.pl, speedscope and similar viewers"""
+    if not profiling_allowed():
+        return flask.render_template('no-access.html')
+    folded = profiling.load_profile(app.config['PROFILE_DIRECTORY'], name, suffix='.folded')
+    if folded is None:
+        return 'No such profile', 404
+    return flask.Response(folded, mimetype='text/plain')
+
 # https://iiif.io/api/image/2.0/#region
 @app.template_filter()
 def iiif_region_to_style(iiif_region):
@@ -884,7 +1598,7 @@ def iiif_region_to_style(iiif_region):
         left, top, width, height = iiif_region.split(',')
         z_index = int(1_000_000_000 / (int(width) * int(height)))
         return 'left: %spx; top: %spx; width: %spx; height: %spx; z-index: %s;' % (left, top, width, height, z_index)
-    except ValueError:
+    except (ValueError, ZeroDivisionError):
         flask.abort(400, Markup('Invalid IIIF region <kbd>{}</kbd> encountered. Remove the invalid qualifier manually, then reload.').format(iiif_region))
 
 @app.template_filter()
@@ -998,35 +1712,41 @@ def handle_wrong_data_value_type(error):
                                      actual_data_value_type=error.actual_data_value_type)
     return response, error.status_code
 
+@app.errorhandler(UpstreamUnavailable)
+def handle_upstream_unavailable(error):
+    response = flask.render_template('upstream-unavailable.html', host=error.host)
+    headers = {}
+    if error.retry_after is not None:
+        headers['Retry-After'] = str(math.ceil(error.retry_after))
+    return response, error.status_code, headers
+
+@app.errorhandler(sqlite3.OperationalError)
+def handle_database_locked(error):
+    if 'database is locked' not in str(error):
+        raise error
+    # another request held the write lock for longer than the busy timeout; the client can simply retry
+    return 'The database is locked (busy), please try again.', 503, {'Retry-After': '1'}
 
-def load_item_and_property(item_id, property_id,
-                           include_depicteds=False, include_description=False, include_metadata=False, local_only=False, username=None):
-    language_codes = request_language_codes()
+
+def load_item_and_property(item_id, property_id, include_depicteds=False, include_depicteds_html=False,
+                           include_description=False, include_metadata=False, local_only=False, username=None, language_codes=None):
+    if language_codes is None:
+        language_codes = request_language_codes()
 
     props = ['claims']
     if include_description:
         props.append('descriptions')
 
-    session = anonymous_session('www.wikidata.org')
-    api_response = session.get(action='wbgetentities',
-                               props=props,
-                               ids=item_id,
-                               languages=language_codes)
-    item_data = api_response['entities'][item_id]
+    item_data = load_entities('www.wikidata.org', [item_id], props)[item_id]
     item = {
         'entity_id': item_id,
     }
     entity_ids = [item_id]
 
     if include_description:
-        description = None
-        for language_code in language_codes:
-            if language_code in item_data['descriptions']:
-                description = item_data['descriptions'][language_code]
-                break
-        item['description'] = description
-
-    image_datavalue = best_value(item_data, property_id)
+        item['description'] = language_fallback(item_data.descriptions, language_codes)
+
+    image_datavalue = item_data.images.get(property_id)
     if image_datavalue is not None:
         if image_datavalue['type'] != 'string':
             raise WrongDataValueType(expected_data_value_type='string', actual_data_value_type=image_datavalue['type'])
@@ -1038,7 +1758,7 @@ def load_item_and_property(item_id, property_id,
             depicteds = []
             append_local_depicteds(depicteds, item_id, username)
         else:
-            depicteds = depicted_items(item_data, item_id)
+            depicteds = depicted_items(item_data, item_id, current_username())
         for depicted in depicteds:
             if 'item_id' in depicted:
                 entity_ids.append(depicted['item_id'])
@@ -1055,6 +1775,9 @@ def load_item_and_property(item_id, property_id,
             depicted['label'] = depicted_label(depicted, labels, language_codes)
         item['depicteds'] = depicteds
 
+    if include_depicteds_html:
+        item['depicteds_html'] = load_depicteds_html(item_data, language_codes, local_only=local_only, username=username)
+
     if include_metadata:
         item['metadata'] = []
         for property_id, values in metadata.items():
@@ -1078,35 +1801,62 @@ def load_file(image_title):
         'entity_id': entity_id,
         **image,
     }
-    entity_ids = []
-
-    session = anonymous_session('commons.wikimedia.org')
-    api_response = session.get(action='wbgetentities',
-                               props=['claims'],
-                               ids=[entity_id],
-                               languages=language_codes)
-    file_data = api_response['entities'][entity_id]
 
-    depicteds = depicted_items(file_data, entity_id)
-    for depicted in depicteds:
-        if 'item_id' in depicted:
-            entity_ids.append(depicted['item_id'])
+    file_data = load_entities('commons.wikimedia.org', [entity_id], ['claims'])[entity_id]
+    file['depicteds_html'] = load_depicteds_html(file_data, language_codes)
 
-    labels = load_labels(entity_ids, language_codes)
+    return file
 
-    for depicted in depicteds:
-        depicted['label'] = depicted_label(depicted, labels, language_codes)
-    file['depicteds'] = depicteds
+def load_depicteds_html(entity, language_codes, local_only=False, username=None):
+    """Returns the rendered depicteds of an entity, {'regions': ..., 'without_region': ...}, through the fragment cache.
+
+    They include the local depicteds of the logged-in user, or only the local depicteds of username if local_only.
+    The cache key has everything else they depend on: the entity revision, the version of the local annotations
+    (and of the regions still in the write-behind buffer) and the languages; label edits drop them, see get_rendered."""
+    if not local_only:
+        username = current_username()
+    local_version = None
+    if username is not None:
+        rows = queries.query_db(queries.get_annotation_version(), params=[entity.entity_id, username])
+        local_version = (rows[0]['version'] if rows else 0, qualifier_buffer.version)
+
+    def render():
+        if local_only:
+            depicteds = []
+            append_local_depicteds(depicteds, entity.entity_id, username)
+        else:
+            depicteds = depicted_items(entity, entity.entity_id, username)
+        labels = load_labels([depicted['item_id'] for depicted in depicteds if 'item_id' in depicted], language_codes)
+        for depicted in depicteds:
+            depicted['label'] = depicted_label(depicted, labels, language_codes)
+        return {
+            'regions': Markup(flask.render_template('depicteds.html', depicteds=depicteds)),
+            'without_region': Markup(flask.render_template('depicteds-without-region.html', depicteds=depicteds)),
+        }
 
-    return file
+    key = (entity.entity_id, entity.lastrevid, local_only, username, local_version, tuple(dict.fromkeys(language_codes)))
+    return get_rendered(fragment_cache, key, render)
 
 def load_image(image_title, language_codes):
-    """Load the metadata of an image file on Commons, without structured data."""
+    """Load the metadata of an image file on Commons, without structured data.
+
+    The image is cached with the metadata in all languages; the attribution is built for the language codes."""
+    depend_on(('image', image_title))
+    image = image_cache.get(('image', image_title), lambda: load_image_uncached(image_title))
+    if image is None:
+        return None
+    image = dict(image)
+    image['image_attribution'] = attribution_from_extmetadata(image.pop('image_extmetadata'), language_codes)
+    return image
+
+def load_image_uncached(image_title):
     session = anonymous_session('commons.wikimedia.org')
+    # imageinfo has no revision ID, so any later edit of the file page (or its structured data) counts
+    recent_changes.track('commons.wikimedia.org', 'File:' + image_title, 0)
 
     query_params = query_default_params()
     query_params.setdefault('titles', set()).update(['File:' + image_title])
-    image_attribution_query_add_params(query_params, image_title, language_codes[0])
+    image_attribution_query_add_params(query_params, image_title)
     image_url_query_add_params(query_params, image_title)
     image_size_query_add_params(query_params, image_title)
 
@@ -1116,13 +1866,13 @@ def load_image(image_title, language_codes):
         return None
 
     page_id = page['pageid']
-    attribution = image_attribution_query_process_response(query_response, image_title, language_codes[0])
+    extmetadata = image_attribution_query_process_response(query_response, image_title)
     url = image_url_query_process_response(query_response, image_title)
     width, height = image_size_query_process_response(query_response, image_title)
     return {
         'image_page_id': page_id,
         'image_title': image_title,
-        'image_attribution': attribution,
+        'image_extmetadata': extmetadata,
         'image_url': url,
         'image_width': width,
         'image_height': height,
@@ -1140,11 +1890,34 @@ def depicted_label(depicted, labels, language_codes):
 
 def load_image_info(image_title):
     file_title = 'File:' + image_title.replace(' ', '_')
-    session = anonymous_session('commons.wikimedia.org')
-    response = session.get(action='query', prop='imageinfo', iiprop='url|mime',
-                           iiurlwidth=8000, titles=file_title)
 
-    return response['query']['pages'][0]['imageinfo'][0]
+    def load():
+        session = anonymous_session('commons.wikimedia.org')
+        response = session.get(action='query', prop='imageinfo', iiprop='url|mime',
+                               iiurlwidth=8000, titles=file_title)
+        return response['query']['pages'][0]['imageinfo'][0]
+
+    return image_cache.get(('imageinfo', file_title), load)
+
+def load_image_infos(image_titles):
+    """Loads the imageinfo (as in load_image_info) of many images through the image cache, 50 per request.
+
+    Returns a dict from image title to imageinfo, or None for missing images."""
+    keys = {image_title: ('imageinfo', 'File:' + image_title.replace(' ', '_')) for image_title in image_titles}
+
+    def load_many(keys):
+        session = anonymous_session('commons.wikimedia.org')
+        infos = {}
+        for chunk in [keys[i:i + 50] for i in range(0, len(keys), 50)]:
+            response = session.get(action='query', prop='imageinfo', iiprop='url|mime',
+                                   iiurlwidth=8000, titles=[key[1] for key in chunk])
+            for key in chunk:
+                page = query_response_page(response, key[1])
+                infos[key] = page['imageinfo'][0] if 'imageinfo' in page else None
+        return infos
+
+    values = image_cache.get_many(list(keys.values()), load_many)
+    return {image_title: values[key] for image_title, key in keys.items()}
 
 def full_url(endpoint, **kwargs):
     return flask.url_for(endpoint, _external=True, _scheme=flask.request.headers.get('X-Forwarded-Proto', 'http'), **kwargs)
@@ -1152,60 +1925,146 @@ def full_url(endpoint, **kwargs):
 def current_url():
     return full_url(flask.request.endpoint, **flask.request.view_args)
 
-def language_string_wikibase_to_iiif(language_string):
+def language_string_wikibase_to_jsonld(language_string):
     if language_string is None:
         return None
-    return {language_string['language']: language_string['value']}
+    return {'@value': language_string['value'], '@language': language_string['language']}
 
-def build_manifest(item):
-    base_url = current_url()[:-len('/manifest.json')]
-    fac = iiif_prezi.factory.ManifestFactory()
-    fac.set_base_prezi_uri(base_url)
-    fac.set_debug('error')
-
-    iiif_item_label = language_string_wikibase_to_iiif(item['label'])
-    iiif_item_description = language_string_wikibase_to_iiif(item['description'])
-
-    manifest = fac.manifest(ident='manifest.json')
-    if iiif_item_label is not None:
-        manifest.label = iiif_item_label
-    if iiif_item_description is not None:
-        manifest.description = iiif_item_description
-    attribution = image_attribution(item['image_title'], request_language_codes()[0])
-    if attribution is not None:
-        manifest.attribution = attribution['attribution_text']
-        manifest.license = attribution['license_url']
-    for metadata in item['metadata']:
-        manifest.set_metadata({
-            'label': language_string_wikibase_to_iiif(metadata['label']),
-            'value': metadata['value'],
-        })
-    sequence = manifest.sequence(ident='normal', label='default order')
-    canvas = sequence.canvas(ident='c0')
-    if iiif_item_label is not None:
-        canvas.label = iiif_item_label
-    annolist = fac.annotationList(ident='annotations', label='Things depicted on this canvas')
-    canvas.add_annotationList(annolist)
-    populate_canvas(canvas, item, fac)
-
-    return manifest
-
-def populate_canvas(canvas, item, fac):
-    image_info = load_image_info(item['image_title'])
+def language_string_wikibase_to_iiif3(language_string):
+    if language_string is None:
+        return None
+    return {language_string['language']: [language_string['value']]}
+
+def iiif_response(document, mimetype='application/json'):
+    # orjson is several times faster than the standard json module for these documents
+    return flask.Response(orjson.dumps(document), mimetype=mimetype)
+
+def build_manifest(item, base_url, image_info, attribution):
+    """Builds the IIIF Presentation 2.1 manifest of an item with an image, as plain dicts.
+
+    base_url is the manifest URL without /manifest.json, image_info and attribution are
+    as returned by load_image_info and image_attribution. Unset (falsy) properties are left out,
+    as the iiif_prezi factory that this replaces did."""
+    label = language_string_wikibase_to_jsonld(item['label'])
+    description = language_string_wikibase_to_jsonld(item['description'])
     width, height = image_info['thumbwidth'], image_info['thumbheight']
-    canvas.set_hw(height, width)
-    anno = canvas.annotation(ident='a0')
-    img = anno.image(ident=image_info['thumburl'], iiif=False)
-    img.set_hw(height, width)
-    img.format = image_info['mime']
+    canvas_id = base_url + '/canvas/c0.json'
+
+    canvas = {
+        '@id': canvas_id,
+        '@type': 'sc:Canvas',
+        'label': label,
+        'height': height,
+        'width': width,
+        'images': [{
+            '@id': base_url + '/annotation/a0.json',
+            '@type': 'oa:Annotation',
+            'motivation': 'sc:painting',
+            'on': canvas_id,
+            'resource': {
+                '@id': image_info['thumburl'],
+                '@type': 'dctypes:Image',
+                'format': image_info['mime'],
+                'height': height,
+                'width': width,
+            },
+        }],
+        'otherContent': [{
+            '@id': base_url + '/list/annotations.json',
+            '@type': 'sc:AnnotationList',
+            'label': 'Things depicted on this canvas',
+        }],
+        'thumbnail': {
+            '@id': thumbnail_url(image_info, item['image_title']),
+            '@type': 'dctypes:Image',
+            'format': image_info['mime'],
+            'height': int(height * (400 / width)),
+            'width': 400,
+        },
+    }
+    manifest = {
+        '@context': 'http://iiif.io/api/presentation/2/context.json',
+        '@id': base_url + '/manifest.json',
+        '@type': 'sc:Manifest',
+        'label': label,
+        'description': description,
+        'attribution': attribution and attribution['attribution_text'],
+        'license': attribution and attribution['license_url'],
+        'metadata': [{'label': language_string_wikibase_to_jsonld(metadata['label']), 'value': metadata['value']}
+                     for metadata in item['metadata']],
+        'sequences': [{
+            '@id': base_url + '/sequence/normal.json',
+            '@type': 'sc:Sequence',
+            'label': 'default order',
+            'canvases': [without_unset(canvas)],
+        }],
+    }
+    return without_unset(manifest)
+
+def build_manifest_v3(item, base_url, image_info, attribution):
+    """Builds the IIIF Presentation 3.0 manifest of an item with an image, as plain dicts (arguments as for build_manifest).
 
-    # add a thumbnail to the canvas
+    The depicted items are only available as a 2.1 annotation list, so they are not linked from this manifest."""
+    label = language_string_wikibase_to_iiif3(item['label'])
+    width, height = image_info['thumbwidth'], image_info['thumbheight']
+    canvas_id = base_url + '/canvas/c0.json'
+
+    canvas = {
+        'id': canvas_id,
+        'type': 'Canvas',
+        'label': label,
+        'height': height,
+        'width': width,
+        'thumbnail': [{
+            'id': thumbnail_url(image_info, item['image_title']),
+            'type': 'Image',
+            'format': image_info['mime'],
+            'height': int(height * (400 / width)),
+            'width': 400,
+        }],
+        'items': [{
+            'id': base_url + '/page/p0.json',
+            'type': 'AnnotationPage',
+            'items': [{
+                'id': base_url + '/annotation/a0.json',
+                'type': 'Annotation',
+                'motivation': 'painting',
+                'target': canvas_id,
+                'body': {
+                    'id': image_info['thumburl'],
+                    'type': 'Image',
+                    'format': image_info['mime'],
+                    'height': height,
+                    'width': width,
+                },
+            }],
+        }],
+    }
+    manifest = {
+        '@context': 'http://iiif.io/api/presentation/3/context.json',
+        'id': base_url + '/manifest.json',
+        'type': 'Manifest',
+        'label': label,
+        'summary': language_string_wikibase_to_iiif3(item['description']),
+        'metadata': [{'label': language_string_wikibase_to_iiif3(metadata['label']), 'value': {'none': [metadata['value']]}}
+                     for metadata in item['metadata']],
+        'items': [without_unset(canvas)],
+    }
+    if attribution is not None:
+        manifest['requiredStatement'] = {'label': {'en': ['Attribution']}, 'value': {'none': [attribution['attribution_text']]}}
+        # rights must be a Creative Commons or RightsStatements.org URI, with http
+        rights = attribution['license_url'] and attribution['license_url'].replace('https://', 'http://', 1)
+        if rights and rights.startswith(('http://creativecommons.org/', 'http://rightsstatements.org/')):
+            manifest['rights'] = rights
+    return without_unset(manifest)
+
+def without_unset(resource):
+    return {key: value for key, value in resource.items() if value}
+
+def thumbnail_url(image_info, image_title):
+    """Returns the URL of the 400px wide thumbnail of an image"""
     thumbs_path = image_info['thumburl'].replace('/wikipedia/commons/', '/wikipedia/commons/thumb/')
-    thumb_400 = thumbs_path + '/400px-' + item['image_title']
-    canvas.thumbnail = fac.image(ident=thumb_400)
-    canvas.thumbnail.format = image_info['mime']
-    thumbwidth, thumbheight = 400, int(height * (400 / width))
-    canvas.thumbnail.set_hw(thumbheight, thumbwidth)
+    return thumbs_path + '/400px-' + image_title
 
 def request_language_codes():
     """Determine the MediaWiki language codes to use from the request context."""
@@ -1229,81 +2088,12 @@ def request_language_codes():
 
     return language_codes
 
-def best_value(entity_data, property_id):
-    if property_id not in entity_data['claims']:
-        return None
-
-    statements = entity_data['claims'][property_id]
-    normal_value = None
-    deprecated_value = None
-
-    for statement in statements:
-        if statement['mainsnak']['snaktype'] != 'value':
-            continue
-
-        datavalue = statement['mainsnak']['datavalue']
-        if statement['rank'] == 'preferred':
-            return datavalue
-        if statement['rank'] == 'normal':
-            normal_value = datavalue
-        else:
-            deprecated_value = datavalue
-
-    return normal_value or deprecated_value
-
-def best_values(entity_data, property_id):
-    if property_id not in entity_data['claims']:
-        return []
-
-    statements = entity_data['claims'][property_id]
-    preferred_values = []
-    normal_values = []
-    deprecated_values = []
-
-    for statement in statements:
-        if statement['mainsnak']['snaktype'] != 'value':
-            continue
-
-        datavalue = statement['mainsnak']['datavalue']
-        if statement['rank'] == 'preferred':
-            preferred_values.append(datavalue)
-        elif statement['rank'] == 'normal':
-            normal_values.append(datavalue)
-        else:
-            deprecated_values.append(datavalue)
-
-    return preferred_values or normal_values or deprecated_values
-
-def depicted_items(entity_data, entity_id):
-    depicteds = []
-
-    statements = entity_data.get('claims', entity_data.get('statements', {}))
-    if statements == []:
-        statements = {}  # T222159
-    for property_id in depicted_properties:
-        for statement in statements.get(property_id, []):
-            snaktype = statement['mainsnak']['snaktype']
-            depicted = {
-                'snaktype': snaktype,
-                'statement_id': statement['id'],
-                'property_id': property_id,
-            }
-            if snaktype == 'value':
-                depicted['item_id'] = statement['mainsnak']['datavalue']['value']['id']
-
-            for qualifier in statement.get('qualifiers', {}).get('P2677', []):
-                if qualifier['snaktype'] != 'value':
-                    continue
-                depicted['iiif_region'] = qualifier['datavalue']['value']
-                depicted['qualifier_hash'] = qualifier['hash']
-                break
-
-            depicteds.append(depicted)
+def depicted_items(entity, entity_id, username=None):
+    depicteds = [depicted.to_dict() for depicted in entity.depicteds]
 
     # user must be logged in to see their own personal annotations
-    userinfo = get_userinfo()
-    if userinfo:
-        append_local_depicteds(depicteds, entity_id, userinfo['name'])
+    if username:
+        append_local_depicteds(depicteds, entity_id, username)
 
     return depicteds
 
@@ -1321,7 +2111,12 @@ def append_local_depicteds(depicteds, entity_id, username):
             if row['snaktype'] == 'value':
                 depicted['item_id'] = row['value_id']
 
-            # check to see if there is qualifer info attached
+            # check to see if there is qualifer info attached (a region update that has not been written yet wins)
+            pending_qualifier = qualifier_buffer.get(row['statement_id'])
+            if pending_qualifier:
+                depicted['iiif_region'], depicted['qualifier_hash'] = pending_qualifier
+                depicteds.append(depicted)
+                continue
             qualifier_result = queries.query_db(queries.get_qualifier_for_statement(), params=[row['statement_id']])
             qualifiers_output = queries.jsonify_rows(qualifier_result)
             if qualifiers_output:
@@ -1332,95 +2127,298 @@ def append_local_depicteds(depicteds, entity_id, username):
 
             depicteds.append(depicted)
 
-def entity_metadata(entity_data):
-    # property IDs based on https://www.wikidata.org/wiki/Wikidata:WikiProject_Visual_arts/Item_structure#Describing_individual_objects
-    property_ids = [
-        'P170',  # creator
-        'P1476',  # title
-        'P571',  # inception
-        'P186',  # material used
-        'P2079',  # fabrication method
-        'P2048',  # height
-        'P2049',  # width
-        'P2610',  # thickness
-        'P88',  # commissioned by
-        'P1071',  # location of final assembly
-        'P127',  # owned by
-        'P1259',  # coordinates of the point of view
-        'P195',  # collection
-        'P276',  # location
-        'P635',  # coordinate location
-        'P1684',  # inscription
-        'P136',  # genre
-        'P135',  # movement
-        'P921',  # main subject
-        'P144',  # based on
-        'P941',  # inspired by
-    ]
+def items_with_region(iiif_region):
+    """Returns the IDs of the items with a depicted statement with this region: on Wikidata, then the local ones"""
+    iiif_region_string = '"' + iiif_region.replace('\\', '\\\\').replace('"', '\\"') + '"'
+    property_claim_predicates = ' '.join(f'p:{property_id}' for property_id in depicted_properties)
+    query = '''
+      SELECT DISTINCT ?item WHERE {
+        VALUES ?p { %s }
+        ?item ?p [ pq:P2677 %s ].
+      }
+    ''' % (property_claim_predicates, iiif_region_string)
+    try:
+        query_results = sparql_cache.get(('iiif_region', iiif_region, property_claim_predicates),
+                                         lambda: upstream.sparql(requests_session, app.config['SPARQL_ENDPOINT'], query))
+        bindings = query_results['results']['bindings']
+    except UpstreamUnavailable:
+        # the local annotations can still be shown
+        bindings = []
+    item_ids = [result['item']['value'][len('http://www.wikidata.org/entity/'):] for result in bindings]
+
+    # local annotations, including regions that are not uploaded (or not even written) yet
+    buffered = buffered_regions()
+    local_rows = queries.jsonify_rows(queries.query_db(queries.get_items_with_region(), params=[iiif_region]))
+    local_item_ids = {row['item_id'] for row in local_rows if row['statement_id'] not in buffered}
+    local_item_ids.update(row['item_id'] for row in buffered.values() if row['iiif_region'] == iiif_region)
+    item_ids.extend(sorted(local_item_ids))
+    return list(dict.fromkeys(item_ids))
+
+def buffered_regions():
+    """Returns the local statements with a region in the write-behind buffer, by statement ID, with that iiif_region.
+
+    Read paths use them instead of flushing the buffer, which would take the database write lock."""
+    statement_ids = qualifier_buffer.statement_ids()
+    if not statement_ids:
+        return {}
+    rows = queries.jsonify_rows(queries.query_db(queries.get_statements_by_id(),
+                                                 params=[json.dumps([int(statement_id) for statement_id in statement_ids])]))
+    regions = {}
+    for row in rows:
+        buffered = qualifier_buffer.get(row['statement_id'])
+        if buffered:  # unless it was written meanwhile
+            regions[row['statement_id']] = {**row, 'iiif_region': buffered[0]}
+    return regions
+
+def item_number_bounds(item_id):
+    # the region index is keyed by the numeric part of the item ID
+    if item_id is None:
+        return [0, 2 ** 31 - 1]
+    return [int(item_id[1:]), int(item_id[1:])]
+
+def region_bounds(box):
+    """Converts a pct (x, y, w, h) box into (min_x, max_x, min_y, max_y) in hundredths of a percent, as in the region index"""
+    x, y, w, h = box
+    return (int(x * 100), math.ceil((x + w) * 100), int(y * 100), math.ceil((y + h) * 100))
+
+def local_regions_in_box(item_id, box, buffered=None):
+    """Returns the local statements whose regions overlap a pct box, on one item or (if item_id is None) all of them.
+
+    Regions in the write-behind buffer (buffered, default buffered_regions()) replace the ones in the region index."""
+    if buffered is None:
+        buffered = buffered_regions()
+    min_item, max_item = item_number_bounds(item_id)
+    bounds = region_bounds(box)
+    rows = queries.jsonify_rows(queries.query_db(queries.get_regions_in_box(), params=[min_item, max_item, *bounds]))
+    in_box = [row for row in rows if row['statement_id'] not in buffered]
+    for row in buffered.values():
+        row_box = regions.parse_pct_region(row['iiif_region'])
+        if row_box is None or not min_item <= int(row['item_id'][1:]) <= max_item:
+            continue
+        min_x, max_x, min_y, max_y = region_bounds(row_box)
+        if max_x >= bounds[0] and min_x <= bounds[1] and max_y >= bounds[2] and min_y <= bounds[3]:
+            in_box.append({**row, 'min_x': min_x, 'max_x': max_x, 'min_y': min_y, 'max_y': max_y})
+    return in_box
+
+def region_json(region):
+    return {key: region[key] for key in ('statement_id', 'item_id', 'value_id', 'snaktype', 'username', 'iiif_region')}
+
+def intersection_over_union(a, b):
+    """Intersection over union of two (min_x, max_x, min_y, max_y) boxes"""
+    intersection = max(0, min(a[1], b[1]) - max(a[0], b[0])) * max(0, min(a[3], b[3]) - max(a[2], b[2]))
+    union = (a[1] - a[0]) * (a[3] - a[2]) + (b[1] - b[0]) * (b[3] - b[2]) - intersection
+    return intersection / union if union else 1.0
+
+def local_depicted(statement, labels, language_codes):
+    """Builds the depicted dict of a locally saved statement; labels must include the label of its value, if any"""
+    depicted = {
+        'snaktype': statement['snaktype'],
+        'statement_id': statement['statement_id'],
+        'property_id': statement['property_id'],
+    }
+    if statement['snaktype'] == 'value':
+        depicted['item_id'] = statement['value_id']
+        depicted['label'] = labels[statement['value_id']]
+    elif statement['snaktype'] == 'somevalue':
+        depicted['label'] = messages.somevalue(language_codes[0])
+    elif statement['snaktype'] == 'novalue':
+        depicted['label'] = messages.novalue(language_codes[0])
+    else:
+        raise ValueError('Unknown snaktype')
+    return depicted
+
+def entity_metadata(entity):
     metadata = collections.defaultdict(list)
 
     session = anonymous_session('www.wikidata.org')
-    for property_id in property_ids:
-        for value in best_values(entity_data, property_id):
-            response = session.get(action='wbformatvalue',
-                                   generate='text/html',
-                                   datavalue=json.dumps(value),
-                                   property=property_id)
-            metadata[property_id].append(response['result'])
+    for property_id, datavalues in entity.metadata.items():
+        for datavalue in datavalues:
+            # the values are bound now, a stale entry is refreshed later, after the loop has moved on
+            def format_value(property_id=property_id, datavalue=datavalue):
+                return session.get(action='wbformatvalue', generate='text/html', datavalue=datavalue, property=property_id)['result']
+            formatted = formatted_value_cache.get((property_id, datavalue), format_value)
+            metadata[property_id].append(formatted)
 
     return metadata
 
 def load_labels(entity_ids, language_codes):
     entity_ids = list(set(entity_ids))
     labels = {}
-    session = anonymous_session('www.wikidata.org')
-    for chunk in [entity_ids[i:i + 50] for i in range(0, len(entity_ids), 50)]:
-        items_data = session.get(action='wbgetentities', props='labels', languages=language_codes, ids=chunk)['entities']
-        for entity_id, item_data in items_data.items():
-            labels[entity_id] = {'language': 'zxx', 'value': entity_id}
-            for language_code in language_codes:
-                if language_code in item_data['labels']:
-                    labels[entity_id] = item_data['labels'][language_code]
-                    break
+    items_data = load_entities('www.wikidata.org', entity_ids, ['labels'])
+    for entity_id, item_data in items_data.items():
+        labels[entity_id] = (language_fallback(item_data.labels, language_codes) or
+                             {'language': 'zxx', 'value': entity_id})
     return labels
 
-def image_attribution(image_title, language_code):
-    params = query_default_params()
-    image_attribution_query_add_params(params, image_title, language_code)
-    session = anonymous_session('commons.wikimedia.org')
-    response = session.get(**params)
-    return image_attribution_query_process_response(response, image_title, language_code)
+def language_fallback(values, language_codes):
+    """Returns the language string (label or description) in the first of the language codes that has a value, or None.
+
+    values maps language codes to strings, like the labels and descriptions of an entities.Entity."""
+    for language_code in language_codes:
+        if language_code in values:
+            return {'language': language_code, 'value': values[language_code]}
+    return None
+
+def entity_language_codes(language_codes):
+    """The language codes that entity data is loaded in, in fallback order and without duplicates.
+
+    Everything built from entity labels and descriptions only depends on these, not on the whole list."""
+    supported = set(app.config['ENTITY_LANGUAGES'])
+    return tuple(dict.fromkeys(language_code for language_code in language_codes if language_code in supported))
+
+def load_entities(domain, entity_ids, props):
+    """Load entity data with wbgetentities through the entity cache, returning a dict from entity ID to data.
+
+    The data is an entities.Entity projection of the JSON. Labels and descriptions are always loaded
+    in all of the ENTITY_LANGUAGES, independent of the request, so that the cached data is shared
+    by all visitors; callers pick a language with language_fallback."""
+    props = tuple(sorted(set(props)))
+
+    def load_many(keys):
+        session = anonymous_session(domain)
+        ids = [key[1] for key in keys]
+        loaded = {}
+        for chunk in [ids[i:i + 50] for i in range(0, len(ids), 50)]:
+            # info for the lastrevid, so that edits after it are noticed in the recent changes
+            response = session.get(action='wbgetentities', props=[*props, 'info'], ids=chunk, languages=app.config['ENTITY_LANGUAGES'])
+            for entity_id, entity_data in response['entities'].items():
+                # only the projection is kept, the full JSON is garbage as soon as this chunk is done
+                loaded[entity_id] = entities.Entity.from_json(entity_data, depicted_properties)
+                track_entity(domain, loaded[entity_id])
+        for key in keys:
+            # e.g. a seeded or stale entry that was refreshed in the background
+            previous = entity_cache.peek(key)
+            if previous is not None and previous.lastrevid != loaded[key[1]].lastrevid:
+                invalidate_rendered((domain, key[1]))
+        return {key: loaded[key[1]] for key in keys}
+
+    keys = [(domain, entity_id, props) for entity_id in entity_ids]
+    depend_on(*((domain, entity_id) for entity_id in entity_ids))
+    if domain == 'www.wikidata.org':
+        seed_entity_cache([key for key in keys if entity_cache.peek(key) is None])
+    values = entity_cache.get_many(keys, load_many)
+    return {key[1]: values[key] for key in keys}
+
+def track_entity(domain, entity):
+    """Follows the edits of an entity in the recent changes, from the revision it was loaded at"""
+    if entity.missing:
+        return
+    if domain == 'www.wikidata.org':
+        recent_changes.track(domain, entity.entity_id if entity.entity_id.startswith('Q') else 'Property:' + entity.entity_id, entity.lastrevid)
+    # MediaInfo entities are followed with the images of their file pages, see load_image_uncached
+
+def seed_entity_cache(keys):
+    """Puts the data of the entity store (see dumpimporter.py) into the entity cache for the given keys, where it covers their props.
+
+    The seeded entries are already stale, so they are served right away and refreshed from the API in the background."""
+    if not keys:
+        return
+    rows = queries.query_db(queries.get_stored_entities(), params=[json.dumps([key[1] for key in keys])])
+    stored = {row['entity_id']: row for row in rows}
+    seeded = {}
+    for key in keys:
+        row = stored.get(key[1])
+        if row is not None and set(key[2]) <= set(row['props'].split('|')):
+            seeded[key] = entities.Entity.from_record(json.loads(row['data']))
+            track_entity(key[0], seeded[key])
+    entity_cache.put_many(seeded, age=entity_cache.ttl)
+
+def load_depicted_index():
+    """Returns the index of depicted items, or None while it is built in the background (it loads every corpus item)"""
+    return depicted_index_cache.get_or_load_later(('depicted',), build_depicted_index)
+
+def build_depicted_index():
+    """Indexes the labels of the items depicted in the corpus or in local statements, counting their uses"""
+    uses = collections.Counter()
+    for entity in load_entities('www.wikidata.org', corpus_item_ids(), ['claims']).values():
+        uses.update(depicted.item_id for depicted in entity.depicteds if depicted.item_id)
+    local_rows = queries.query_db(queries.get_local_depicted_uses(), params=[json.dumps(list(depicted_properties))])
+    uses.update({row['value_id']: row['uses'] for row in local_rows})
+    # with descriptions, so that the entries are cached for the search results as well
+    entities_data = load_entities('www.wikidata.org', list(uses), ['descriptions', 'labels'])
+    labels = {item_id: entity.labels for item_id, entity in entities_data.items() if not entity.missing}
+    return autocomplete.DepictedIndex({item_id: uses[item_id] for item_id in labels}, labels)
+
+def search_wikidata(search, language_code):
+    """Returns the wbsearchentities results (id, label, description) for items matching the search, through the search cache.
+
+    Raises UpstreamUnavailable if the search rate limit is used up."""
+    def load():
+        if not search_limiter.acquire():
+            metrics.increment('search_rate_limited_total')
+            raise UpstreamUnavailable('www.wikidata.org')
+        response = anonymous_session('www.wikidata.org').get(action='wbsearchentities', search=search, type='item',
+                                                             language=language_code, uselang=language_code, limit=50)
+        return [{'id': result['id'], 'uses': 0,
+                 'label': result.get('display', {}).get('label'),
+                 'description': result.get('display', {}).get('description')}
+                for result in response['search']]
+
+    return search_cache.get((autocomplete.fold(search), language_code), load)
+
+def existing_items(item_ids):
+    """Returns the set of the item IDs that exist on Wikidata, looked up in batches through the entity cache"""
+    entities = load_entities('www.wikidata.org', item_ids, ['claims'])
+    return {item_id for item_id, item_data in entities.items() if not item_data.missing}
+
+def item_image_sizes(item_ids):
+    """Returns a dict from item ID to the (width, height) of its image, in the canvas pixels of the IIIF annotation lists"""
+    entities = load_entities('www.wikidata.org', item_ids, ['claims'])
+    image_titles = {}
+    for item_id, item_data in entities.items():
+        image_datavalue = item_data.images.get(default_property)
+        if image_datavalue is not None and image_datavalue['type'] == 'string':
+            image_titles[item_id] = image_datavalue['value']
+    image_infos = load_image_infos(set(image_titles.values()))
+    return {item_id: (int(image_infos[image_title]['thumbwidth']), int(image_infos[image_title]['thumbheight']))
+            for item_id, image_title in image_titles.items() if image_infos[image_title]}
+
+def image_attribution(image_title, language_codes):
+    """The attribution of an image, from the same cached metadata as load_image"""
+    image = load_image(image_title, language_codes)
+    return image and image['image_attribution']
 
-def image_attribution_query_add_params(params, image_title, language_code):
+def image_attribution_query_add_params(params, image_title):
     params.setdefault('prop', set()).update(['imageinfo'])
     params.setdefault('iiprop', set()).update(['extmetadata'])
-    params['iiextmetadatalanguage'] = language_code
+    # all translations of the metadata, so that it can be cached once for all languages
+    params['iiextmetadatamultilang'] = True
     params.setdefault('titles', set()).update(['File:' + image_title])
 
-def image_attribution_query_process_response(response, image_title, language_code):
+def image_attribution_query_process_response(response, image_title):
     page = query_response_page(response, 'File:' + image_title)
     imageinfo = page['imageinfo'][0]
-    metadata = imageinfo['extmetadata']
-    no_value = {'value': None}
-
-    attribution_required = metadata.get('AttributionRequired', no_value)['value']
+    return imageinfo['extmetadata']
+
+def extmetadata_value(metadata, name, language_codes):
+    """Returns the value of an extmetadata field, in the first of the language codes it is translated into if it is"""
+    value = metadata.get(name, {}).get('value')
+    if not isinstance(value, dict):
+        return value
+    for language_code in [*language_codes, '_default']:
+        if language_code in value:
+            return value[language_code]
+    return next(iter(value.values()), None)
+
+def attribution_from_extmetadata(metadata, language_codes):
+    attribution_required = extmetadata_value(metadata, 'AttributionRequired', language_codes)
     if attribution_required != 'true':
         return None
 
     attribution = Markup()
 
-    artist = metadata.get('Artist', no_value)['value']
+    artist = extmetadata_value(metadata, 'Artist', language_codes)
     if artist:
         attribution += Markup(r', ') + Markup(artist)
 
-    license_short_name = metadata.get('LicenseShortName', no_value)['value']
-    license_url = metadata.get('LicenseUrl', no_value)['value']
+    license_short_name = extmetadata_value(metadata, 'LicenseShortName', language_codes)
+    license_url = extmetadata_value(metadata, 'LicenseUrl', language_codes)
     if license_short_name and license_url:
         attribution += (Markup(r', <a href="') + Markup.escape(license_url) + Markup(r'">') +
                         Markup.escape(license_short_name) +
                         Markup(r'</a>'))
 
-    credit = metadata.get('Credit', no_value)['value']
+    credit = extmetadata_value(metadata, 'Credit', language_codes)
     if credit:
         attribution += Markup(r' (') + Markup(credit) + Markup(r')')
 
@@ -1483,25 +2481,29 @@ def query_response_page(response, title):
     pages = response['query']['pages']
     return next(page for page in pages if page['title'] == title)
 
-def query_dashboard(page_number):
-    """Returns list of object ids that should be displayed on the dashboard based on the page number"""
-    query = '''SELECT DISTINCT ?item ?itemLabel WHERE {
-                SERVICE wikibase:label { bd:serviceParam wikibase:language "[AUTO_LANGUAGE]". }
-                {
-                    SELECT DISTINCT ?item WHERE {
+# the dashboard items: photographs in (a sub-collection of) the Yale University Art Gallery collection, with an image
+corpus_query = '''SELECT DISTINCT ?item WHERE {
                         ?item p:P31 ?statement0.
                         ?statement0 (ps:P31) wd:Q125191.
                         ?item p:P195 ?statement1.
                         ?statement1 (ps:P195/(wdt:P279*)) wd:Q1568434.
                         ?item p:P18 ?dummy0.
                     }
-                    ORDER BY ASC(?item)
+                    ORDER BY ASC(?item)'''
+
+def query_dashboard(page_number):
+    """Returns list of object ids that should be displayed on the dashboard based on the page number"""
+    query = '''SELECT DISTINCT ?item ?itemLabel WHERE {
+                SERVICE wikibase:label { bd:serviceParam wikibase:language "[AUTO_LANGUAGE]". }
+                {
+                    %s
                     LIMIT %d
                     OFFSET %d
                 }
-            }''' % (ENTRIES_PER_PAGE, (page_number - 1) * ENTRIES_PER_PAGE) 
+            }''' % (corpus_query, ENTRIES_PER_PAGE, (page_number - 1) * ENTRIES_PER_PAGE)
 
-    query_results = requests_session.get('https://query.wikidata.org/sparql', params={'query': query}).json()
+    query_results = sparql_cache.get(('dashboard', page_number),
+                                     lambda: upstream.sparql(requests_session, app.config['SPARQL_ENDPOINT'], query))
 
     # transform query results into just list of item ids
     dashboard_item_ids = []
@@ -1509,6 +2511,57 @@ def query_dashboard(page_number):
         dashboard_item_ids.append(item['itemLabel']['value'])
     return dashboard_item_ids
 
+def corpus_item_ids():
+    """Returns the IDs of all dashboard items, in dashboard order, from one cached query"""
+    query_results = sparql_cache.get(('corpus',), lambda: upstream.sparql(requests_session, app.config['SPARQL_ENDPOINT'], corpus_query))
+    return corpus_query_item_ids(query_results)
+
+def corpus_query_item_ids(query_results):
+    return [binding['item']['value'][len('http://www.wikidata.org/entity/'):] for binding in query_results['results']['bindings']]
+
+def collection_page_of(item_id):
+    """The number of the IIIF collection page an item is on, or None if it is not in the corpus (or the corpus is not cached)"""
+    query_results = sparql_cache.peek(('corpus',))
+    if query_results is None:
+        return None
+    item_ids = corpus_query_item_ids(query_results)
+    if item_id not in item_ids:
+        return None
+    return item_ids.index(item_id) // COLLECTION_PAGE_SIZE + 1
+
+def review_queue(order):
+    """Returns the (item ID, username) pairs that are waiting for a project lead to review them, in one of the REVIEW_ORDERS"""
+    return [(row['item_id'], row['username']) for row in queries.query_db(queries.get_review_queue(), params={'order': order})]
+
+def prefetch_review_entries(entries, language_codes):
+    """Loads the items, images and rendered local annotations of review queue entries into the caches in the background,
+    so that the project lead does not wait for them when moving on; entries that are already being loaded are skipped"""
+    with review_prefetching_lock:
+        entries = [entry for entry in entries if entry not in review_prefetching]
+        review_prefetching.update(entries)
+    if not entries:
+        return None
+    metrics.increment('review_prefetches_total', len(entries))
+    return review_prefetch_executor.submit(prefetch_review, entries, language_codes)
+
+def prefetch_review(entries, language_codes):
+    try:
+        with app.app_context():
+            load_entities('www.wikidata.org', [item_id for item_id, _ in entries], ['claims'])  # in one request
+            for item_id, username in entries:
+                load_item_and_property(item_id=item_id, property_id=default_property, include_depicteds_html=True, local_only=True,
+                                       username=username, language_codes=language_codes)
+    except Exception:
+        pass  # e.g. the API is unavailable; the page loads what is missing itself then
+    finally:
+        with review_prefetching_lock:
+            review_prefetching.difference_update(entries)
+
+def current_username():
+    """Returns the name of the currently logged in wikidata user, or None"""
+    userinfo = get_userinfo()
+    return userinfo['name'] if userinfo else None
+
 def get_userinfo():
     """Returns userinfo for currently logged in wikidata user, return None if no logged in user"""
     session = authenticated_session('www.wikidata.org')
@@ -1542,51 +2595,86 @@ def deny_access():
             return True
     return False
 
-def upload_local_annotations(item_id, username):
-    """Uploads all local statements/qualifiers to Wikidata for a given item_id/username pair"""
+def profiling_allowed():
+    return app.config['PROFILING'] or not deny_access()
+
+def upload_local_annotations(item_id, username, session=None, token=None):
+    """Uploads all local statements/qualifiers to Wikidata for a given item_id/username pair.
+
+    Only what is missing on Wikidata is written: a depicted value, region or reference
+    that is already there (added by someone else, or by an earlier, partial upload) costs no edit.
+    The session (and its CSRF token) default to the logged-in user's."""
+    qualifier_buffer.flush()
     result = queries.query_db(queries.get_object_statements(), params=[item_id, username])
     all_statements = queries.jsonify_rows(result)
 
     # set up wikidata api session
-    session = authenticated_session("www.wikidata.org")
+    if session is None:
+        session = authenticated_session("www.wikidata.org")
     if session is None:
         return 'Not logged in', 403
 
-    token = session.get(action='query', meta='tokens', type='csrf')['query']['tokens']['csrftoken']
+    # the current claims decide what is written, so they are fetched fresh rather than from the entity cache
+    entity = session.get(action='wbgetentities', ids=[item_id], props=['claims'])['entities'][item_id]
+    claims = list(entity.get('claims', {}).get('P180', []))
+    entity_cache.invalidate_where(lambda key: key[1] == item_id)
+    claimed_ids = set()
+
+    if token is None:
+        token = session.get(action='query', meta='tokens', type='csrf')['query']['tokens']['csrftoken']
 
     for statement in all_statements:
-        value = json.dumps({'entity-type': 'item', 'id': statement['value_id']})
-        try:
-            response = session.post(action='wbcreateclaim',
-                                    entity=statement['item_id'],
-                                    snaktype=statement['snaktype'],
-                                    property='P180',
-                                    value=value,
-                                    token=token)
-        except mwapi.errors.APIError as error:
-            return str(error), 500
-
-        # check to see if the local statement has a qualifier and update if it does
-        wikidata_statement_id = response['claim']['id']
-        local_qualifier = queries.query_db(queries.get_qualifier_for_statement(), params=[statement['statement_id']])
-        if local_qualifier:     
-            jsonified_qualifier = queries.jsonify_rows(local_qualifier)[0]
+        local_qualifier = queries.jsonify_rows(queries.query_db(queries.get_qualifier_for_statement(), params=[statement['statement_id']]))
+        iiif_region = local_qualifier[0]['iiif_region'] if local_qualifier else None
+
+        claim = matching_claim(claims, claimed_ids, statement, iiif_region)
+        if claim is None:
+            value = json.dumps({'entity-type': 'item', 'id': statement['value_id']})
+            try:
+                response = session.post(action='wbcreateclaim',
+                                        entity=statement['item_id'],
+                                        snaktype=statement['snaktype'],
+                                        property='P180',
+                                        value=value,
+                                        token=token)
+            except mwapi.errors.APIError as error:
+                return str(error), 500
+            claim = response['claim']
+            claims.append(claim)
+            metrics.increment('upload_edits_total', action='wbcreateclaim')
+        else:
+            metrics.increment('upload_edits_skipped_total', action='wbcreateclaim')
+        claimed_ids.add(claim['id'])
+        wikidata_statement_id = claim['id']
+
+        # add the local qualifier, unless the claim already has this region
+        if iiif_region is not None and iiif_region in claim_regions(claim):
+            metrics.increment('upload_edits_skipped_total', action='wbsetqualifier')
+        elif iiif_region is not None:
+            qualifier_hash = local_qualifier[0]['qualifier_hash']
+            if qualifier_hash not in {qualifier.get('hash') for qualifier in claim.get('qualifiers', {}).get('P2677', [])}:
+                qualifier_hash = None
             try:
                 response = session.post(action='wbsetqualifier',
                                     claim=wikidata_statement_id,
                                     property='P2677',
                                     snaktype='value',
-                                    value=('"' + jsonified_qualifier['iiif_region'] + '"'),
-                                    **({'snakhash': jsonified_qualifier['qualifier_hash']} if jsonified_qualifier['qualifier_hash'] else {}),
+                                    value=('"' + iiif_region + '"'),
+                                    **({'snakhash': qualifier_hash} if qualifier_hash else {}),
                                     summary='region drawn manually using Dura Europos Wikidata Annotation Tool',
                                     token=token)
             except mwapi.errors.APIError as error:
                 if error.code == 'no-such-qualifier':
                     return 'This region does not exist (anymore) – it may have been edited in the meantime. Please try reloading the page.', 500
                 return str(error), 500
+            claim.update(response['claim'])
+            metrics.increment('upload_edits_total', action='wbsetqualifier')
         
         # upload reference if needed
         if statement['reference_type'] and statement['reference_value']:
+            if statement_reference_key(statement) in claim_reference_keys(claim):
+                metrics.increment('upload_edits_skipped_total', action='wbsetreference')
+                continue
             # reference to be posted
             if statement['reference_type'] == 'P248':
                 # stated in (reference to wikidata object)
@@ -1651,14 +2739,118 @@ def upload_local_annotations(item_id, username):
                                         token=token)
             except mwapi.errors.APIError as error:
                 return str(error), 500
+            claim.setdefault('references', []).append(response['reference'])
+            metrics.increment('upload_edits_total', action='wbsetreference')
     return 'Success', 200
 
+def matching_claim(claims, claimed_ids, statement, iiif_region):
+    """Returns the claim on Wikidata that a local statement should be uploaded into, or None if a new one is needed.
+
+    That is a claim with the same value and region (the statement is already there),
+    or, if the local statement has a region, a claim with the same value and no region yet
+    that no other local statement of this upload went into; without a region, any claim with the same value."""
+    same_value = [claim for claim in claims if claim_value(claim) == statement_value(statement)]
+    if iiif_region is None:
+        return same_value[0] if same_value else None
+    for claim in same_value:
+        if iiif_region in claim_regions(claim):
+            return claim
+    for claim in same_value:
+        if not claim_regions(claim) and claim['id'] not in claimed_ids:
+            return claim
+    return None
+
+def statement_value(statement):
+    return statement['value_id'] if statement['snaktype'] == 'value' else statement['snaktype']
+
+def claim_value(claim):
+    if claim['mainsnak']['snaktype'] != 'value':
+        return claim['mainsnak']['snaktype']
+    return claim['mainsnak']['datavalue']['value'].get('id')
+
+def claim_regions(claim):
+    return {qualifier['datavalue']['value']
+            for qualifier in claim.get('qualifiers', {}).get('P2677', [])
+            if qualifier['snaktype'] == 'value'}
+
+def statement_reference_key(statement):
+    return (statement['reference_type'], statement['reference_value'], statement['pages_value'] or None)
+
+def claim_reference_keys(claim):
+    """Returns the (reference_type, reference_value, pages_value) keys of the stated in/reference URL references of a claim"""
+    keys = set()
+    for reference in claim.get('references', []):
+        snaks = reference['snaks']
+        pages = [snak['datavalue']['value'] for snak in snaks.get('P304', []) if snak['snaktype'] == 'value']
+        for reference_type in ('P248', 'P854'):
+            for snak in snaks.get(reference_type, []):
+                if snak['snaktype'] != 'value':
+                    continue
+                value = snak['datavalue']['value']
+                keys.add((reference_type, value['id'] if isinstance(value, dict) else value, pages[0] if pages else None))
+    return keys
+
+def run_bulk_upload(batch_id, pairs, session, token, item_links, project_lead, access_token):
+    """Approves and uploads item_id, username pairs with a few concurrent uploads, queueing an email for each upload.
+
+    The number of concurrent uploads is BULK_UPLOAD_CONCURRENCY; if Wikidata asks the tool to back off,
+    its circuit breaker makes the remaining uploads fail fast, and they can be retried later from the status page
+    (as can the uploads that fail because the project lead hit their edit rate limit).
+    The pairs stay claimed for BULK_UPLOAD_LEASE seconds after each step, so that pairs whose thread died with its process
+    are not left queued forever. Each user gets one digest of their emails (see outbox.py)."""
+
+    def set_status(item_id, username, status, message=None):
+        queries.query_db(queries.set_bulk_upload_status(), params=[status, message, batch_id, item_id, username])
+        # still running: keep the remaining pairs from being taken for interrupted
+        queries.query_db(queries.renew_bulk_upload_claim(), params=[time.time() + BULK_UPLOAD_LEASE, batch_id])
+
+    def upload(pair):
+        item_id, username = pair
+        if not queries.query_db(queries.get_approval(), params=[username, item_id]):
+            queries.query_db(queries.add_approval(), params=[username, item_id, True])
+        set_status(item_id, username, 'uploading')
+        try:
+            message, status_code = upload_local_annotations(item_id, username, session=session, token=token)
+        except UpstreamUnavailable:
+            message, status_code = 'Wikidata is unavailable or asked the tool to slow down, please try again later.', 503
+        except Exception as error:
+            message, status_code = str(error), 500
+        if status_code != 200:
+            set_status(item_id, username, 'failed', message)
+            metrics.increment('bulk_uploads_total', outcome='failed')
+            return
+        delete_local_annotations(item_id, username)
+        delete_all_comments_and_approval(item_id, username)
+        email_outbox.enqueue(username, item_id, item_links[item_id], True, project_lead, access_token)
+        set_status(item_id, username, 'uploaded')
+        metrics.increment('bulk_uploads_total', outcome='uploaded')
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=app.config['BULK_UPLOAD_CONCURRENCY']) as executor:
+        list(executor.map(upload, pairs))
+
+def item_url(item_id):
+    return "https://dura-europos-wd-annotation.toolforge.org" + str(flask.url_for('item', item_id=item_id))
+
+def approval_email(item_links, uploaded=False):
+    """Returns the subject and text of the email telling a user that their annotations of the items were approved.
+
+    item_links maps item IDs to the URLs of their pages in the tool."""
+    approved = 'approved and uploaded to Wikidata' if uploaded else 'approved'
+    if len(item_links) == 1:
+        [(item_id, link)] = item_links.items()
+        return (f"Annotations for object {item_id} approved",
+                f"Your annotations for object {item_id} have been {approved} on the Dura Europos Wikidata Annotation Tool. Please navigate to {link} or type in {item_id} into the lookup bar when you visit the homepage at https://dura-europos-wd-annotation.toolforge.org/")
+    lines = ''.join(f"\n* {item_id}: {link}" for item_id, link in item_links.items())
+    return (f"Annotations for {len(item_links)} objects approved",
+            f"Your annotations for the following objects have been {approved} on the Dura Europos Wikidata Annotation Tool:\n{lines}\n\nYou can also type the item IDs into the lookup bar when you visit the homepage at https://dura-europos-wd-annotation.toolforge.org/")
+
 def delete_local_annotations(item_id, username):
     """Deletes all local statements/qualifiers for a given item_id/username pair"""
     # fetch all of the statements that need to be deleted
     result = queries.query_db(queries.get_object_statements(), params=[item_id, username])
     all_statements = queries.jsonify_rows(result)
     for statement in all_statements:
+        qualifier_buffer.discard(statement['statement_id'])
         # delete from the statements table
         queries.query_db(queries.delete_statement(), params=[statement['statement_id']])
         # delete from the qualifiers table -> if this statement doesn't have a qualifier then this will just do nothing
@@ -1669,6 +2861,66 @@ def delete_all_comments_and_approval(item_id, username):
     queries.query_db(queries.delete_all_comments(), params=[item_id, username])
     queries.query_db(queries.delete_approval(), params=[username, item_id])
 
+@app.before_request
+def startMetrics():
+    metrics.start_request()
+
+@app.before_request
+def startEmailWorker():
+    if app.config['EMAIL_WORKER']:
+        email_outbox.start()
+
+@app.before_request
+def startDepictedIndex():
+    if app.config['DEPICTED_INDEX_WARMUP'] and not depicted_index_warmed.is_set():
+        depicted_index_warmed.set()
+        load_depicted_index()
+
+@app.before_request
+def startRecentChanges():
+    if app.config['RECENT_CHANGES'] and recent_changes.start():
+        recent_changes_health(True)
+
+@app.after_request
+def addServerTiming(response):
+    """Report where the request time went (API calls, SPARQL, sqlite) in a Server-Timing header."""
+    server_timing = metrics.finish_request(response)
+    if server_timing:
+        response.headers['Server-Timing'] = server_timing
+    return response
+
+@app.before_request
+def startProfiling():
+    # checking the query parameter first keeps the cost of this hook negligible when not profiling
+    if 'profile' in flask.request.args and profiling_allowed():
+        flask.g.profiler = profiling.SamplingProfiler(threading.get_ident()).start()
+
+@app.after_request
+def saveProfile(response):
+    name = stop_profiling()
+    if name:
+        response.headers['X-Profile'] = flask.url_for('profile', name=name)
+    return response
+
+@app.teardown_request
+def teardownProfiling(exception):
+    stop_profiling()
+
+def stop_profiling():
+    profiler = flask.g.pop('profiler', None)
+    if profiler is None:
+        return None
+    profiler.stop()
+    request_info = {
+        'url': flask.request.url,
+        'endpoint': flask.request.endpoint,
+        'method': flask.request.method,
+        'time': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+    }
+    io_summary = [{'kind': kind, 'target': target, 'name': name, 'count': count, 'duration_ms': duration * 1000, 'errors': errors}
+                  for kind, target, name, count, duration, errors in metrics.aggregate(metrics.request_timings())]
+    return profiling.save(app.config['PROFILE_DIRECTORY'], profiler, request_info, io_summary)
+
 @app.after_request
 def denyFrame(response):
     """Disallow embedding the tool’s pages in other websites.
@@ -0,0 +1,48 @@
+# prefix search over the items that are already depicted in the corpus, for the statement editor's item search
+import bisect
+import re
+import unicodedata
+
+
+WORD_START = re.compile(r'(?<=[\s\-(/,.])\w', re.UNICODE)
+
+
+def fold(text):
+    """Normalizes text for matching: case-folded, without diacritics, with single spaces"""
+    decomposed = unicodedata.normalize('NFKD', text.casefold())
+    return ' '.join(''.join(character for character in decomposed if not unicodedata.combining(character)).split())
+
+
+class DepictedIndex:
+    """A prefix index of the labels (in all languages) of depicted items, ranked by how often each item is depicted.
+
+    uses maps item IDs to their number of uses, labels maps item IDs to {language: label}.
+    A search matches the start of a label or of any word in it, so “bath” finds “Roman bath”.
+    """
+
+    def __init__(self, uses, labels):
+        self.uses = dict(uses)
+        entries = set()
+        for item_id, item_labels in labels.items():
+            for label in item_labels.values():
+                folded = fold(label)
+                entries.add((folded, item_id))
+                entries.update((folded[match.start():], item_id) for match in WORD_START.finditer(folded))
+        entries = sorted(entries)
+        self._keys = [key for key, _ in entries]
+        self._item_ids = [item_id for _, item_id in entries]
+
+    def __len__(self):
+        return len(self.uses)
+
+    def search(self, text):
+        """Returns the IDs of the items with a label or word starting with the text, most used first"""
+        prefix = fold(text)
+        if not prefix:
+            return []
+        item_ids = set()
+        for position in range(bisect.bisect_left(self._keys, prefix), len(self._keys)):
+            if not self._keys[position].startswith(prefix):
+                break
+            item_ids.add(self._item_ids[position])
+        return sorted(item_ids, key=lambda item_id: (-self.uses.get(item_id, 0), int(item_id[1:])))
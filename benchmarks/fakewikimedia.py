@@ -0,0 +1,494 @@
+# a local stand-in for the Wikidata and Commons Action APIs and the Wikidata Query Service
+import hashlib
+import http.server
+import json
+import os
+import random
+import re
+import threading
+import time
+import urllib.parse
+import uuid
+
+
+FIXTURES_PATH = os.path.join(os.path.dirname(__file__), 'fixtures', 'dura-europos.json')
+
+# the real Dura-Europos dashboard query: photographs (Q125191) in the collection Q1568434
+PHOTOGRAPH = 'Q125191'
+COLLECTION = 'Q1568434'
+
+
+def load_fixtures(path=FIXTURES_PATH, size=200, seed=0):
+    """Loads recorded fixtures (see record_fixtures.py), falling back to a synthetic corpus of the same shape"""
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return synthetic_fixtures(size, seed)
+
+
+def synthetic_fixtures(size=200, seed=0):
+    """Builds a deterministic corpus shaped like the Dura-Europos items (wbgetentities formatversion=2 JSON)"""
+    rng = random.Random(seed)
+    entities = {}
+    files = {}
+
+    def label_entity(entity_id, labels):
+        entities[entity_id] = {
+            'type': 'property' if entity_id.startswith('P') else 'item',
+            'id': entity_id,
+            'lastrevid': rng.randrange(1_000_000, 2_000_000_000),
+            'labels': {language: {'language': language, 'value': value} for language, value in labels.items()},
+            'descriptions': {},
+            'claims': {},
+        }
+
+    depicted_ids = ['Q%d' % (900_000 + n) for n in range(120)]
+    for n, depicted_id in enumerate(depicted_ids):
+        label_entity(depicted_id, {'en': f'depicted thing {n}', 'fr': f'chose représentée {n}', 'de': f'Dargestelltes {n}'})
+    for property_id, label in [('P170', 'creator'), ('P1476', 'title'), ('P571', 'inception'), ('P186', 'made from material'),
+                               ('P2048', 'height'), ('P2049', 'width'), ('P195', 'collection'), ('P276', 'location')]:
+        label_entity(property_id, {'en': label})
+    label_entity(PHOTOGRAPH, {'en': 'photograph'})
+    label_entity(COLLECTION, {'en': 'Yale University Art Gallery'})
+
+    def statement(entity_id, property_id, datavalue, datatype, qualifiers=None, rank='normal'):
+        claim = {
+            'mainsnak': {'snaktype': 'value', 'property': property_id, 'datavalue': datavalue, 'datatype': datatype},
+            'type': 'statement',
+            'id': f'{entity_id}${uuid.UUID(int=rng.getrandbits(128))}',
+            'rank': rank,
+        }
+        if qualifiers:
+            claim['qualifiers'] = qualifiers
+            claim['qualifiers-order'] = list(qualifiers)
+        return claim
+
+    def item_value(item_id):
+        return {'value': {'entity-type': 'item', 'numeric-id': int(item_id[1:]), 'id': item_id}, 'type': 'wikibase-entityid'}
+
+    def region_qualifier(region):
+        return {'P2677': [{'snaktype': 'value', 'property': 'P2677', 'hash': hashlib.sha1(region.encode()).hexdigest(),
+                           'datavalue': {'value': region, 'type': 'string'}, 'datatype': 'string'}]}
+
+    def random_region():
+        x, y = rng.randrange(0, 80), rng.randrange(0, 80)
+        return 'pct:%d,%d,%d,%d' % (x, y, rng.randrange(5, 100 - x), rng.randrange(5, 100 - y))
+
+    for n in range(size):
+        item_id = 'Q%d' % (100_000 + n)
+        image_title = f'Dura-Europos excavation photograph {n:05d}.jpg'
+        page_id = 50_000_000 + n
+        width, height = rng.choice([(4000, 3000), (3000, 4000), (6000, 4500), (2400, 1800)])
+        claims = {
+            'P31': [statement(item_id, 'P31', item_value(PHOTOGRAPH), 'wikibase-item')],
+            'P195': [statement(item_id, 'P195', item_value(COLLECTION), 'wikibase-item')],
+            'P18': [statement(item_id, 'P18', {'value': image_title, 'type': 'string'}, 'commonsMedia')],
+            'P1476': [statement(item_id, 'P1476', {'value': {'text': f'Excavation photograph {n}', 'language': 'en'}, 'type': 'monolingualtext'}, 'monolingualtext')],
+            'P571': [statement(item_id, 'P571', {'value': {'time': '+1932-00-00T00:00:00Z', 'timezone': 0, 'before': 0, 'after': 0, 'precision': 9,
+                                                           'calendarmodel': 'http://www.wikidata.org/entity/Q1985727'}, 'type': 'time'}, 'time')],
+            'P2048': [statement(item_id, 'P2048', {'value': {'amount': '+%d' % rng.randrange(8, 30), 'unit': 'http://www.wikidata.org/entity/Q174728'}, 'type': 'quantity'}, 'quantity')],
+            'P180': [statement(item_id, 'P180', item_value(depicted_id), 'wikibase-item',
+                               region_qualifier(random_region()) if rng.random() < 0.8 else None)
+                     for depicted_id in rng.sample(depicted_ids, rng.randrange(2, 12))],
+        }
+        entities[item_id] = {
+            'type': 'item',
+            'id': item_id,
+            'lastrevid': rng.randrange(1_000_000, 2_000_000_000),
+            'labels': {'en': {'language': 'en', 'value': f'Dura-Europos excavation photograph {n}'},
+                       'fr': {'language': 'fr', 'value': f'Photographie de fouilles de Doura Europos {n}'}},
+            'descriptions': {'en': {'language': 'en', 'value': 'photograph from the Yale-French excavations at Dura-Europos'}},
+            'claims': claims,
+        }
+        path = hashlib.md5(image_title.replace(' ', '_').encode()).hexdigest()
+        url = f'https://upload.wikimedia.org/wikipedia/commons/{path[0]}/{path[:2]}/{urllib.parse.quote(image_title.replace(" ", "_"))}'
+        files[image_title] = {
+            'pageid': page_id,
+            'title': 'File:' + image_title,
+            'imageinfo': {
+                'url': url,
+                'thumburl': url,
+                'thumbwidth': width,
+                'thumbheight': height,
+                'width': width,
+                'height': height,
+                'mime': 'image/jpeg',
+                'extmetadata': {
+                    'AttributionRequired': {'value': 'true'},
+                    'Artist': {'value': 'Yale-French Excavations at Dura-Europos'},
+                    'LicenseShortName': {'value': 'CC BY-SA 4.0'},
+                    'LicenseUrl': {'value': 'https://creativecommons.org/licenses/by-sa/4.0'},
+                    'Credit': {'value': 'Yale University Art Gallery'},
+                },
+            },
+            'mediainfo': {
+                'type': 'mediainfo',
+                'id': f'M{page_id}',
+                'lastrevid': rng.randrange(1_000_000, 2_000_000_000),
+                'labels': {},
+                'statements': {'P180': claims['P180'][:2]},
+            },
+        }
+
+    return {'entities': entities, 'files': files}
+
+
+class FakeWikimedia:
+    """Serves the Action API of Wikidata (/wikidata/w/api.php) and Commons (/commons/w/api.php) and WDQS (/sparql).
+
+    latency is the artificial delay in seconds per request, either a number or a dict
+    keyed by 'api', 'sparql', or an action name ('wbgetentities', 'wbcreateclaim', …).
+    Users are identified by their OAuth token key, so every stubbed OAuth session is its own user.
+    Edits (by the tool, or simulated with edit()) show up in list=recentchanges.
+    Set incident to simulate an upstream problem: 'maxlag' (API reads answer with a maxlag error),
+    'ratelimited' (API edits answer with a ratelimited error, as when a user exceeds their edit rate limit),
+    'overloaded' (everything answers HTTP 503 with Retry-After) or 'slow' (everything takes 20 seconds).
+    Emails sent with emailuser are recorded in emails, except to users in users_without_email.
+    """
+
+    def __init__(self, fixtures=None, latency=0.0, host='127.0.0.1', port=0):
+        self.fixtures = fixtures if fixtures is not None else load_fixtures()
+        self.latency = latency
+        self.incident = None
+        self.requests = 0  # all requests
+        self.edits = 0
+        self.recent_changes = []  # list=recentchanges entries of all edits, with the wiki they were made on
+        self.emails = []
+        self.users_without_email = set()
+        self._lock = threading.Lock()
+        handler = type('Handler', (_Handler,), {'fake': self})
+        self.server = http.server.ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def api_hosts(self):
+        """The API_HOSTS configuration that points the app at this server"""
+        return {
+            'www.wikidata.org': self.base_url + '/wikidata',
+            'commons.wikimedia.org': self.base_url + '/commons',
+        }
+
+    @property
+    def sparql_endpoint(self):
+        return self.base_url + '/sparql'
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def delay(self, kind, action=None):
+        latency = self.latency
+        if isinstance(latency, dict):
+            latency = latency.get(action, latency.get(kind, 0.0))
+        if latency:
+            time.sleep(latency)
+
+    def api(self, wiki, params, username):
+        action = params.get('action')
+        self.delay('api', action)
+        handler = getattr(self, 'api_' + str(action), None)
+        if handler is None:
+            return {'error': {'code': 'badvalue', 'info': f'Unrecognized value for parameter "action": {action}.'}}
+        return handler(wiki, params, username)
+
+    def api_wbgetentities(self, wiki, params, username):
+        props = params.get('props', 'info|sitelinks|aliases|labels|descriptions|claims|datatype').split('|')
+        languages = params['languages'].split('|') if 'languages' in params else None
+        entities = {}
+        for entity_id in params.get('ids', '').split('|'):
+            entity = self.entity(wiki, entity_id)
+            if entity is None:
+                entities[entity_id] = {'id': entity_id, 'missing': ''}
+                continue
+            result = {key: entity[key] for key in ('type', 'id', 'lastrevid') if key in entity}
+            for prop in ('labels', 'descriptions'):
+                if prop in props:
+                    result[prop] = {language: value for language, value in entity.get(prop, {}).items()
+                                    if languages is None or language in languages}
+            if 'claims' in props:
+                result['statements' if wiki == 'commons' else 'claims'] = entity.get('statements', entity.get('claims', {}))
+            entities[entity_id] = result
+        return {'entities': entities, 'success': 1}
+
+    def entity(self, wiki, entity_id):
+        if wiki == 'commons':
+            for file in self.fixtures['files'].values():
+                if file['mediainfo']['id'] == entity_id:
+                    return file['mediainfo']
+            return None
+        return self.fixtures['entities'].get(entity_id)
+
+    def api_query(self, wiki, params, username):
+        query = {}
+        meta = params.get('meta', '').split('|')
+        if 'tokens' in meta:
+            query['tokens'] = {'csrftoken': '+\\'}
+        if 'userinfo' in meta:
+            query['userinfo'] = {'id': 0, 'name': username, 'anon': True} if username is None else {'id': 1, 'name': username}
+        if 'allmessages' in meta:
+            query['allmessages'] = [{'name': name, 'content': content} for name, content in [
+                ('wikibase-snakview-variations-somevalue-label', 'unknown value'),
+                ('wikibase-snakview-variations-novalue-label', 'no value'),
+            ]]
+        titles = [title for title in params.get('titles', '').split('|') if title]
+        for page_id in [page_id for page_id in params.get('pageids', '').split('|') if page_id]:
+            titles += [file['title'] for file in self.fixtures['files'].values() if str(file['pageid']) == page_id]
+        if titles:
+            query['pages'] = []
+            for title in titles:
+                file = self.fixtures['files'].get(title[len('File:'):].replace('_', ' '))
+                if file is None:
+                    query['pages'].append({'ns': 6, 'title': title, 'missing': True})
+                    continue
+                page = {'pageid': file['pageid'], 'ns': 6, 'title': file['title']}
+                if 'imageinfo' in params.get('prop', ''):
+                    page['imageinfo'] = [file['imageinfo']]
+                query['pages'].append(page)
+                if title != file['title']:
+                    query.setdefault('normalized', []).append({'from': title, 'to': file['title']})
+        if 'recentchanges' in params.get('list', '').split('|'):
+            query['recentchanges'], continuation = self.list_recentchanges(wiki, params)
+            if continuation:
+                return {'continue': continuation, 'query': query}
+        return {'batchcomplete': True, 'query': query}
+
+    def api_wbsearchentities(self, wiki, params, username):
+        search = params.get('search', '').casefold()
+        language = params.get('language', 'en')
+        offset = int(params.get('continue', 0))
+        limit = int(params.get('limit', 7))
+        results = []
+        for entity_id, entity in self.fixtures['entities'].items():
+            label = entity.get('labels', {}).get(language)
+            if entity.get('type') == params.get('type', 'item') and label and label['value'].casefold().startswith(search):
+                results.append({'id': entity_id, 'title': entity_id, 'display': {'label': label},
+                                'match': {'type': 'label', 'language': language, 'text': label['value']}})
+        response = {'searchinfo': {'search': params.get('search', '')}, 'search': results[offset:offset + limit], 'success': 1}
+        if len(results) > offset + limit:
+            response['search-continue'] = offset + limit
+        return response
+
+    def api_wbformatvalue(self, wiki, params, username):
+        datavalue = json.loads(params['datavalue'])
+        value = datavalue['value']
+        if isinstance(value, dict):
+            value = value.get('id') or value.get('text') or value.get('time') or value.get('amount')
+        return {'result': f'<span>{value}</span>'}
+
+    def api_wbcreateclaim(self, wiki, params, username):
+        claim = {
+            'mainsnak': {'snaktype': params['snaktype'], 'property': params['property']},
+            'type': 'statement',
+            'id': f'{params["entity"]}${uuid.uuid4()}',
+            'rank': 'normal',
+        }
+        if params.get('value'):
+            claim['mainsnak']['datavalue'] = {'value': json.loads(params['value']), 'type': 'wikibase-entityid'}
+        self.update_claim(wiki, params['entity'], claim['id'], lambda _: claim, create=True)
+        return {'pageinfo': {'lastrevid': self.record_change(wiki, params['entity'])}, 'success': 1, 'claim': claim}
+
+    def api_wbsetqualifier(self, wiki, params, username):
+        region = json.loads(params['value'])
+        qualifier = {'snaktype': 'value', 'property': params['property'], 'hash': hashlib.sha1(region.encode()).hexdigest(),
+                     'datavalue': {'value': region, 'type': 'string'}}
+
+        def set_qualifier(claim):
+            qualifiers = [other for other in claim.get('qualifiers', {}).get(params['property'], [])
+                          if other['hash'] != params.get('snakhash')]
+            return {**claim, 'qualifiers': {**claim.get('qualifiers', {}), params['property']: qualifiers + [qualifier]}}
+
+        claim = self.update_claim(wiki, params['claim'].split('$')[0], params['claim'], set_qualifier)
+        if claim is None:
+            return {'error': {'code': 'no-such-claim', 'info': f'Claim "{params["claim"]}" not found.'}}
+        return {'pageinfo': {'lastrevid': self.record_change(wiki, params['claim'].split('$')[0])}, 'success': 1, 'claim': claim}
+
+    def api_wbsetreference(self, wiki, params, username):
+        snaks = json.loads(params['snaks'])
+        reference = {'hash': hashlib.sha1(params['snaks'].encode()).hexdigest(), 'snaks': snaks,
+                     'snaks-order': json.loads(params.get('snaks-order', 'null')) or list(snaks)}
+        claim = self.update_claim(wiki, params['statement'].split('$')[0], params['statement'],
+                                  lambda claim: {**claim, 'references': claim.get('references', []) + [reference]})
+        if claim is None:
+            return {'error': {'code': 'no-such-claim', 'info': f'Claim "{params["statement"]}" not found.'}}
+        return {'pageinfo': {'lastrevid': self.record_change(wiki, params['statement'].split('$')[0])}, 'success': 1, 'reference': reference}
+
+    def update_claim(self, wiki, entity_id, claim_id, update, create=False):
+        """Replaces a claim of an entity (or adds it, if create is true) with update(old claim or None), returning the new claim.
+
+        The claims are copied, not changed in place, so concurrent wbgetentities responses stay consistent."""
+        with self._lock:
+            entity = self.entity(wiki, entity_id.upper())
+            if entity is None:
+                return None
+            key = 'statements' if wiki == 'commons' else 'claims'
+            claims = entity.get(key, {})
+            for property_id, property_claims in claims.items():
+                for index, claim in enumerate(property_claims):
+                    if claim['id'] == claim_id:
+                        new_claim = update(claim)
+                        entity[key] = {**claims, property_id: property_claims[:index] + [new_claim] + property_claims[index + 1:]}
+                        return new_claim
+            if not create:
+                return None
+            new_claim = update(None)
+            property_id = new_claim['mainsnak']['property']
+            entity[key] = {**claims, property_id: claims.get(property_id, []) + [new_claim]}
+            return new_claim
+
+    def api_emailuser(self, wiki, params, username):
+        if params['target'] in self.users_without_email:
+            return {'error': {'code': 'noemail', 'info': 'This user has not specified a valid email address.'}}
+        with self._lock:
+            self.emails.append({'from': username, 'to': params['target'], 'subject': params['subject'], 'text': params['text']})
+        return {'emailuser': {'result': 'Success'}}
+
+    def next_revision(self):
+        with self._lock:
+            self.edits += 1
+            return 2_000_000_000 + self.edits
+
+    def edit(self, wiki, entity_id, update):
+        """Simulates an edit by someone else: update(entity) changes the entity in place. Returns the new revision ID"""
+        with self._lock:
+            update(self.entity(wiki, entity_id))
+        return self.record_change(wiki, entity_id)
+
+    def record_change(self, wiki, entity_id):
+        """Gives an edited entity a new revision ID and adds the edit to the recent changes, returning the revision ID"""
+        revid = self.next_revision()
+        with self._lock:
+            entity = self.entity(wiki, entity_id.upper())
+            if entity is None:
+                return revid
+            if wiki == 'commons':
+                file = next(file for file in self.fixtures['files'].values() if file['mediainfo'] is entity)
+                ns, title, pageid = 6, file['title'], file['pageid']
+            elif entity_id.startswith('P'):
+                ns, title, pageid = 120, 'Property:' + entity_id, int(entity_id[1:])
+            else:
+                ns, title, pageid = 0, entity_id, int(entity_id[1:])
+            self.recent_changes.append({'wiki': wiki, 'type': 'edit', 'ns': ns, 'title': title, 'pageid': pageid, 'revid': revid,
+                                        'old_revid': entity.get('lastrevid', 0), 'rcid': len(self.recent_changes) + 1,
+                                        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())})
+            entity['lastrevid'] = revid
+        return revid
+
+    def list_recentchanges(self, wiki, params):
+        """The recent changes (oldest first, as with rcdir=newer) and the continuation parameters, if there are more"""
+        namespaces = {int(namespace) for namespace in params.get('rcnamespace', '').split('|') if namespace}
+        first_rcid = int(params['rccontinue'].split('|')[1]) if 'rccontinue' in params else 0
+        limit = 500 if params.get('rclimit', '10') == 'max' else int(params.get('rclimit', '10'))
+        with self._lock:
+            changes = [change for change in self.recent_changes
+                       if change['wiki'] == wiki and change['timestamp'] >= params.get('rcstart', '') and change['rcid'] >= first_rcid and
+                       (not namespaces or change['ns'] in namespaces)]
+        continuation = None
+        if len(changes) > limit:
+            continuation = {'rccontinue': f'{changes[limit]["timestamp"]}|{changes[limit]["rcid"]}', 'continue': '-||'}
+        return [{key: value for key, value in change.items() if key != 'wiki'} for change in changes[:limit]], continuation
+
+    def sparql(self, query):
+        self.delay('sparql')
+        bindings = []
+        if f'wd:{PHOTOGRAPH}' in query:
+            # the dashboard query (a page of it, or all items)
+            limit = int(re.search(r'LIMIT (\d+)', query).group(1)) if 'LIMIT' in query else None
+            offset = int(re.search(r'OFFSET (\d+)', query).group(1)) if 'OFFSET' in query else 0
+            item_ids = sorted(entity_id for entity_id, entity in self.fixtures['entities'].items()
+                              if any(claim['mainsnak'].get('datavalue', {}).get('value', {}).get('id') == PHOTOGRAPH
+                                     for claim in entity.get('claims', {}).get('P31', [])))
+            for item_id in item_ids[offset:None if limit is None else offset + limit]:
+                bindings.append({
+                    'item': {'type': 'uri', 'value': 'http://www.wikidata.org/entity/' + item_id},
+                    'itemLabel': {'type': 'literal', 'value': item_id},
+                })
+        elif match := re.search(r'pq:P2677 "((?:[^"\\]|\\.)*)"', query):
+            # the region query
+            region = match.group(1).replace('\\"', '"').replace('\\\\', '\\')
+            for entity_id, entity in sorted(self.fixtures['entities'].items()):
+                for claim in entity.get('claims', {}).get('P180', []):
+                    if any(qualifier.get('datavalue', {}).get('value') == region for qualifier in claim.get('qualifiers', {}).get('P2677', [])):
+                        bindings.append({'item': {'type': 'uri', 'value': 'http://www.wikidata.org/entity/' + entity_id}})
+                        break
+        return {'head': {'vars': ['item']}, 'results': {'bindings': bindings}}
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    fake = None
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True  # otherwise delayed ACKs add ~40 ms to some responses
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_request({})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length).decode()
+        self.handle_request(dict(urllib.parse.parse_qsl(body, keep_blank_values=True)))
+
+    def handle_request(self, form):
+        url = urllib.parse.urlsplit(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query, keep_blank_values=True))
+        params.update(form)
+        with self.fake._lock:
+            self.fake.requests += 1
+        if self.fake.incident == 'slow':
+            time.sleep(20)
+        if self.fake.incident == 'overloaded':
+            body = b'<html><body><h1>Error: 503, Service Unavailable</h1></body></html>'
+            self.send_response(503)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('Retry-After', '10')
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        if self.fake.incident == 'maxlag' and 'maxlag' in params and url.path != '/sparql':
+            self.respond({'error': {'code': 'maxlag', 'info': 'Waiting for 10.64.48.92: 7 seconds lagged.', 'lag': 7}},
+                         headers={'Retry-After': '5'})
+            return
+        if self.fake.incident == 'ratelimited' and self.command == 'POST' and url.path != '/sparql':
+            self.respond({'error': {'code': 'ratelimited', 'info': "As an anti-abuse measure, you are limited from performing this action "
+                                                                   "too many times in a short space of time, and you have exceeded this limit."}})
+            return
+        if url.path == '/sparql':
+            self.respond(self.fake.sparql(params.get('query', '')))
+            return
+        wiki, _, rest = url.path.lstrip('/').partition('/')
+        if rest != 'w/api.php' or wiki not in {'wikidata', 'commons'}:
+            self.respond({'error': 'not found'}, status=404)
+            return
+        self.respond(self.fake.api(wiki, params, self.username()))
+
+    def username(self):
+        match = re.search(r'oauth_token="([^"]*)"', self.headers.get('Authorization', ''))
+        return urllib.parse.unquote(match.group(1)) if match else None
+
+    def respond(self, document, status=200, headers={}):
+        body = json.dumps(document).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
@@ -0,0 +1,65 @@
+# wires the app up to the local Wikimedia stand-in and a scratch sqlite database
+import mwoauth
+import os
+import sqlalchemy
+import tempfile
+
+import app as wdip
+import database
+import messages
+import queries
+
+
+def create_database(path):
+    """Creates the tool’s tables (as databasebuilder.py does) in a new sqlite file"""
+    engine = sqlalchemy.create_engine('sqlite:///' + path)
+    database.Base.metadata.create_all(engine)
+    engine.dispose()
+
+
+def configure_app(fake, database_path=None):
+    """Points the app at the fake server and a scratch database, returning the database path"""
+    if database_path is None:
+        database_fd, database_path = tempfile.mkstemp(prefix='dura-europos-benchmark-', suffix='.sqlite')
+        os.close(database_fd)
+        os.unlink(database_path)
+    create_database(database_path)
+    queries.DATABASE_URL = database_path
+
+    wdip.app.config['API_HOSTS'] = fake.api_hosts()
+    wdip.app.config['SPARQL_ENDPOINT'] = fake.sparql_endpoint
+    messages.host = fake.api_hosts()['www.wikidata.org']
+    # stubbed OAuth: the fake server does not check signatures, it only reads the token key as the user name
+    wdip.consumer_token = mwoauth.ConsumerToken('benchmark', 'benchmark')
+    return database_path
+
+
+def add_user(username, is_project_lead=False):
+    queries.query_db(queries.add_user(), params=[username, is_project_lead, False])
+
+
+def log_in(client, username):
+    """Gives a Flask test client an OAuth session for the given user, returning its CSRF token"""
+    csrf_token = 'csrf-' + username
+    with client.session_transaction() as session:
+        session['oauth_access_token'] = {'key': username, 'secret': 'secret'}
+        session['_csrf_token'] = csrf_token
+    return csrf_token
+
+
+def seed_local_statements(item_id, username, fixtures, count=5):
+    """Adds local statements with regions for an item, like a contributor annotating it"""
+    depicted_ids = sorted({claim['mainsnak']['datavalue']['value']['id']
+                           for entity in fixtures['entities'].values()
+                           for claim in entity.get('claims', {}).get('P180', [])
+                           if claim['mainsnak']['snaktype'] == 'value'})
+    for n in range(count):
+        queries.query_db(queries.add_statement_with_reference(),
+                         params=[item_id, 'P180', depicted_ids[n % len(depicted_ids)], 'value', username, 'P854', 'https://example.org/'])
+        statement_id = queries.jsonify_rows(queries.query_db(queries.get_latest_statement()))[0]['statement_id']
+        queries.query_db(queries.add_qualifier(), params=[statement_id, 'pct:%d,%d,10,10' % (n * 5, n * 5), ''])
+
+
+def corpus_item_ids(fixtures):
+    """The item IDs of the corpus (the ones with an image), in dashboard order"""
+    return sorted(entity_id for entity_id, entity in fixtures['entities'].items() if 'P18' in entity.get('claims', {}))
@@ -0,0 +1,212 @@
+# load test of the local annotation write path with simulated concurrent annotators
+#
+#   python -m benchmarks.loadtest --annotators 1,5,10,20 --duration 10
+#
+# Each annotator has its own stubbed OAuth session, opens an item page (which hands out the CSRF token),
+# then replays what students do in the editor: draw a region (add statement + add qualifier),
+# move it a few times, get a comment from a project lead, sometimes delete a region, and upload.
+# By default the tool is served in-process (threaded, like a single worker) against the
+# local Wikimedia stand-in; with --url, an already running server is targeted instead,
+# which must share --secret-key and be configured to use the stand-in started on --fake-port.
+import argparse
+import collections
+import random
+import re
+import requests
+import sys
+import threading
+import time
+import werkzeug.serving
+
+import app as wdip
+from benchmarks import fakewikimedia, harness
+from benchmarks.run import percentile
+
+
+class QuietRequestHandler(werkzeug.serving.WSGIRequestHandler):
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class Recorder:
+    """Collects latencies and outcomes per operation from all annotator threads"""
+
+    def __init__(self):
+        self.latencies = collections.defaultdict(list)
+        self.errors = collections.defaultdict(collections.Counter)
+        self._lock = threading.Lock()
+
+    def record(self, operation, duration, response):
+        error = None
+        if response is None:
+            error = 'connection error'
+        elif response.status_code == 503 and 'database is locked' in response.text:
+            error = 'database is locked'
+        elif response.status_code >= 400:
+            error = f'HTTP {response.status_code}'
+        with self._lock:
+            self.latencies[operation].append(duration)
+            if error:
+                self.errors[operation][error] += 1
+
+
+class Annotator:
+
+    def __init__(self, base_url, username, session_cookie, item_ids, depicted_ids, recorder, rng, think_time):
+        self.base_url = base_url
+        self.username = username
+        self.item_ids = item_ids
+        self.depicted_ids = depicted_ids
+        self.recorder = recorder
+        self.rng = rng
+        self.think_time = think_time
+        self.http = requests.Session()
+        self.http.cookies.set(wdip.app.config['SESSION_COOKIE_NAME'], session_cookie)
+        self.http.headers['Referer'] = base_url + '/'
+        self.csrf_token = 'csrf-' + username
+
+    def request(self, operation, method, path, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = self.http.request(method, self.base_url + path, timeout=60, **kwargs)
+        except requests.RequestException:
+            response = None
+        self.recorder.record(operation, time.perf_counter() - start, response)
+        if self.think_time:
+            time.sleep(self.rng.expovariate(1 / self.think_time))
+        return response
+
+    def region(self):
+        x, y = self.rng.randrange(0, 80), self.rng.randrange(0, 80)
+        return 'pct:%d,%d,%d,%d' % (x, y, self.rng.randrange(5, 100 - x), self.rng.randrange(5, 100 - y))
+
+    def session(self):
+        """One editing session on one item"""
+        item_id = self.rng.choice(self.item_ids)
+        response = self.request('open item', 'GET', f'/item/{item_id}')
+        if response is not None and (match := re.search(r'<span id="csrf_token"[^>]*>([^<]*)</span>', response.text)):
+            self.csrf_token = match.group(1)
+
+        statement_ids = []
+        for _ in range(self.rng.randrange(1, 6)):
+            # draw a region: the editor first adds the statement, then the region qualifier
+            data = {'entity_id': item_id, 'snaktype': 'value', 'item_id': self.rng.choice(self.depicted_ids),
+                    'property_id': 'P180', '_csrf_token': self.csrf_token}
+            if self.rng.random() < 0.3:
+                data.update(reference_type='P854', reference_value='https://example.org/excavation-report')
+            response = self.request('add statement', 'POST', '/api/v1/add_statement_local/www.wikidata.org', data=data)
+            if response is None or not response.ok:
+                continue
+            statement_id = response.json()['depicted']['statement_id']
+            statement_ids.append(statement_id)
+            self.request('add qualifier', 'POST', '/api/v2/add_qualifier_local/www.wikidata.org',
+                         data={'statement_id': statement_id, 'iiif_region': self.region(), '_csrf_token': self.csrf_token})
+            # move/resize the region a few times before settling
+            for _ in range(self.rng.randrange(0, 4)):
+                self.request('move region', 'POST', '/api/v2/add_qualifier_local/www.wikidata.org',
+                             data={'statement_id': statement_id, 'iiif_region': self.region(), '_csrf_token': self.csrf_token})
+
+        if statement_ids and self.rng.random() < 0.5:
+            self.request('comment', 'POST', '/api/v2/add_comment',
+                         data={'statement_id': statement_ids[0], 'comment': 'Please check the region.', 'item_id': item_id, 'username': self.username})
+        if statement_ids and self.rng.random() < 0.2:
+            statement_id = statement_ids.pop()
+            self.request('delete region', 'POST', '/api/v2/delete_qualifier_local', data={'statement_id': statement_id})
+            self.request('delete statement', 'POST', '/api/v1/delete_statement_local', data={'statement_id': statement_id})
+        if statement_ids and self.rng.random() < 0.3:
+            self.request('upload', 'POST', '/api/v2/upload_annotations', data={'item_id': item_id})
+
+    def run(self, deadline):
+        while time.monotonic() < deadline:
+            self.session()
+
+
+def session_cookie(secret_key, username):
+    """Forges the signed Flask session cookie of a logged-in user (stubbed OAuth)"""
+    app = wdip.app
+    if secret_key:
+        app = wdip.flask.Flask('loadtest')
+        app.secret_key = secret_key
+    serializer = app.session_interface.get_signing_serializer(app)
+    return serializer.dumps({'oauth_access_token': {'key': username, 'secret': 'secret'}, '_csrf_token': 'csrf-' + username})
+
+
+def run_level(base_url, annotators, duration, fixtures, seed, think_time, secret_key):
+    recorder = Recorder()
+    item_ids = harness.corpus_item_ids(fixtures)
+    depicted_ids = sorted({claim['mainsnak']['datavalue']['value']['id']
+                           for entity in fixtures['entities'].values()
+                           for claim in entity.get('claims', {}).get('P180', [])})
+    deadline = time.monotonic() + duration
+    threads = []
+    for n in range(annotators):
+        username = f'Student {n}'
+        annotator = Annotator(base_url, username, session_cookie(secret_key, username), item_ids, depicted_ids,
+                              recorder, random.Random(seed * 1000 + n), think_time)
+        threads.append(threading.Thread(target=annotator.run, args=(deadline,)))
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return recorder, time.perf_counter() - start
+
+
+def report(annotators, recorder, elapsed):
+    total = sum(len(latencies) for latencies in recorder.latencies.values())
+    errors = sum(sum(counter.values()) for counter in recorder.errors.values())
+    locked = sum(counter['database is locked'] for counter in recorder.errors.values())
+    print(f'\n{annotators} annotators: {total} requests in {elapsed:.1f} s = {total / elapsed:.1f} req/s, '
+          f'{errors} errors ({errors / max(total, 1):.2%}), {locked} "database is locked"')
+    print(f'  {"operation":18} {"count":>7} {"errors":>7} {"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9} {"max ms":>9}')
+    for operation, latencies in recorder.latencies.items():
+        latencies = sorted(latencies)
+        print(f'  {operation:18} {len(latencies):7} {sum(recorder.errors[operation].values()):7} '
+              f'{percentile(latencies, 0.50) * 1000:9.1f} {percentile(latencies, 0.95) * 1000:9.1f} '
+              f'{percentile(latencies, 0.99) * 1000:9.1f} {latencies[-1] * 1000:9.1f}')
+        for error, count in recorder.errors[operation].most_common():
+            print(f'      {count} × {error}')
+    return {'annotators': annotators, 'requests': total, 'throughput': total / elapsed, 'errors': errors, 'locked': locked}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Simulate concurrent annotators on the local annotation write path.')
+    parser.add_argument('--annotators', default='1,5,10,20', help='comma-separated numbers of concurrent annotators to run, one level after another')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds per level')
+    parser.add_argument('--think-time', type=float, default=0.0, help='mean pause between an annotator’s requests, in seconds')
+    parser.add_argument('--latency', type=float, default=0.0, help='artificial upstream latency per API call, in seconds')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--url', help='target an already running server instead of serving the tool in-process')
+    parser.add_argument('--secret-key', help='SECRET_KEY of the server given with --url, to forge its session cookies')
+    parser.add_argument('--fake-port', type=int, default=0, help='port for the Wikimedia stand-in')
+    parser.add_argument('--fixtures', default=fakewikimedia.FIXTURES_PATH)
+    args = parser.parse_args(argv)
+
+    fixtures = fakewikimedia.load_fixtures(args.fixtures)
+    with fakewikimedia.FakeWikimedia(fixtures, latency=args.latency, port=args.fake_port) as fake:
+        server = None
+        if args.url:
+            base_url = args.url.rstrip('/')
+            print(f'Wikimedia stand-in at {fake.base_url}; the target must use API_HOSTS {fake.api_hosts()}')
+        else:
+            database_path = harness.configure_app(fake)
+            # render the authentication area so that annotators pick up their CSRF token like browsers do
+            wdip.app.config['OAUTH'] = {'consumer_key': 'benchmark', 'consumer_secret': 'benchmark'}
+            server = werkzeug.serving.make_server('127.0.0.1', 0, wdip.app, threaded=True, request_handler=QuietRequestHandler)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            base_url = f'http://127.0.0.1:{server.server_port}'
+            print(f'serving the tool at {base_url} with database {database_path}')
+
+        try:
+            for annotators in [int(level) for level in args.annotators.split(',')]:
+                recorder, elapsed = run_level(base_url, annotators, args.duration, fixtures, args.seed, args.think_time, args.secret_key)
+                report(annotators, recorder, elapsed)
+        finally:
+            if server is not None:
+                server.shutdown()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,83 @@
+# records fixtures of real Dura-Europos items for the benchmarks (needs network access)
+#
+#   python -m benchmarks.record_fixtures --items 200
+#
+# writes benchmarks/fixtures/dura-europos.json in the format of fakewikimedia.synthetic_fixtures()
+import argparse
+import json
+import os
+import requests
+import toolforge
+
+import upstream
+from benchmarks import fakewikimedia
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Record Dura-Europos items from Wikidata and Commons as benchmark fixtures.')
+    parser.add_argument('--items', type=int, default=200, help='number of dashboard items to record')
+    parser.add_argument('--output', default=fakewikimedia.FIXTURES_PATH)
+    args = parser.parse_args(argv)
+
+    user_agent = toolforge.set_user_agent('dura-europos-wd-annotation', email=None)
+    sparql_session = requests.Session()
+    sparql_session.headers.update({'Accept': 'application/json', 'User-Agent': user_agent})
+    wikidata = upstream.Session('https://www.wikidata.org', user_agent=user_agent, formatversion=2)
+    commons = upstream.Session('https://commons.wikimedia.org', user_agent=user_agent, formatversion=2)
+
+    query = '''SELECT DISTINCT ?item WHERE {
+                 ?item p:P31/ps:P31 wd:%s;
+                       p:P195/ps:P195/wdt:P279* wd:%s;
+                       p:P18 [].
+               }
+               ORDER BY ASC(?item)
+               LIMIT %d''' % (fakewikimedia.PHOTOGRAPH, fakewikimedia.COLLECTION, args.items)
+    bindings = upstream.sparql(sparql_session, 'https://query.wikidata.org/sparql', query)['results']['bindings']
+    item_ids = [binding['item']['value'][len('http://www.wikidata.org/entity/'):] for binding in bindings]
+
+    entities = {}
+
+    def fetch(entity_ids, props):
+        entity_ids = sorted(set(entity_ids) - set(entities))
+        for chunk in [entity_ids[i:i + 50] for i in range(0, len(entity_ids), 50)]:
+            response = wikidata.get(action='wbgetentities', ids=chunk, props=props)
+            for entity_id, entity in response['entities'].items():
+                if 'missing' not in entity:
+                    entities[entity_id] = entity
+
+    fetch(item_ids, ['info', 'labels', 'descriptions', 'claims'])
+    referenced_ids = {fakewikimedia.PHOTOGRAPH, fakewikimedia.COLLECTION}
+    for item_id in item_ids:
+        for property_id, statements in entities[item_id]['claims'].items():
+            referenced_ids.add(property_id)
+            for statement in statements:
+                value = statement['mainsnak'].get('datavalue', {}).get('value')
+                if isinstance(value, dict) and 'id' in value:
+                    referenced_ids.add(value['id'])
+    fetch(referenced_ids, ['info', 'labels'])
+
+    files = {}
+    for item_id in item_ids:
+        image_title = entities[item_id]['claims']['P18'][0]['mainsnak']['datavalue']['value']
+        response = commons.get(action='query', titles=['File:' + image_title], prop='imageinfo',
+                               iiprop=['url', 'size', 'mime', 'extmetadata'], iiurlwidth=8000, iiextmetadatalanguage='en')
+        page = response['query']['pages'][0]
+        if page.get('missing'):
+            continue
+        mediainfo_id = 'M%d' % page['pageid']
+        mediainfo = commons.get(action='wbgetentities', ids=[mediainfo_id], props=['info', 'claims'])['entities'][mediainfo_id]
+        files[image_title] = {
+            'pageid': page['pageid'],
+            'title': page['title'],
+            'imageinfo': page['imageinfo'][0],
+            'mediainfo': {**mediainfo, 'labels': {}, 'statements': mediainfo.get('statements') or {}},
+        }
+
+    os.makedirs(os.path.dirname(args.output), exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump({'entities': entities, 'files': files}, f)
+    print(f'recorded {len(item_ids)} items, {len(entities)} entities and {len(files)} files to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
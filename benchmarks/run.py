@@ -0,0 +1,169 @@
+# offline benchmarks of the main pages against a local Wikibase/Commons/WDQS stand-in
+#
+#   python -m benchmarks.run                       # all scenarios, no artificial latency
+#   python -m benchmarks.run --latency 0.05 --concurrency 4 item manifest
+#   python -m benchmarks.run --json results.json   # record results…
+#   python -m benchmarks.run --compare results.json  # …and later fail on p95 regressions
+import argparse
+import concurrent.futures
+import json
+import math
+import sys
+import threading
+import time
+
+import app as wdip
+from benchmarks import fakewikimedia, harness
+
+
+class Scenario:
+    """A benchmarked request; setup runs before each request and is not timed"""
+
+    def __init__(self, name, request, setup=None, username=None):
+        self.name = name
+        self.request = request
+        self.setup = setup
+        self.username = username
+
+
+def scenarios(fixtures):
+    item_ids = harness.corpus_item_ids(fixtures)
+    pages = max(1, len(item_ids) // 10)
+
+    def item_id(iteration):
+        return item_ids[iteration % len(item_ids)]
+
+    def upload_setup(iteration):
+        harness.seed_local_statements(item_id(iteration), 'Benchmark uploader', fixtures)
+
+    return {
+        'item': Scenario('item', lambda client, i: client.get(f'/item/{item_id(i)}')),
+        'dashboard': Scenario('dashboard', lambda client, i: client.get(f'/dashboard/{1 + i % pages}')),
+        'project-lead-dashboard': Scenario('project-lead-dashboard', lambda client, i: client.get('/projectleaddashboard/1'),
+                                           username='Benchmark lead'),
+        'manifest': Scenario('manifest', lambda client, i: client.get(f'/iiif/{item_id(i)}/P18/manifest.json')),
+        'annotations': Scenario('annotations', lambda client, i: client.get(f'/iiif/{item_id(i)}/P18/list/annotations.json')),
+        'upload': Scenario('upload', lambda client, i: client.post('/api/v2/upload_annotations', data={'item_id': item_id(i)}),
+                           setup=upload_setup, username='Benchmark uploader'),
+    }
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    # nearest-rank method
+    index = min(len(sorted_values) - 1, max(0, math.ceil(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def run_scenario(scenario, requests, concurrency, warmup, before_measuring=None):
+    local = threading.local()
+
+    def client():
+        if not hasattr(local, 'client'):
+            local.client = wdip.app.test_client()
+            if scenario.username:
+                harness.log_in(local.client, scenario.username)
+        return local.client
+
+    def one(iteration):
+        if scenario.setup:
+            scenario.setup(iteration)
+        start = time.perf_counter()
+        response = scenario.request(client(), iteration)
+        duration = time.perf_counter() - start
+        return duration, response.status_code < 400
+
+    for iteration in range(warmup):
+        one(iteration)
+    if before_measuring:
+        before_measuring()
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(one, range(warmup, warmup + requests)))
+    elapsed = time.perf_counter() - start
+
+    durations = sorted(duration for duration, _ in results)
+    return {
+        'requests': requests,
+        'errors': sum(1 for _, ok in results if not ok),
+        'throughput': requests / elapsed,
+        'mean_ms': sum(durations) / len(durations) * 1000,
+        'p50_ms': percentile(durations, 0.50) * 1000,
+        'p95_ms': percentile(durations, 0.95) * 1000,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Prints p95 changes against a baseline, returning whether any scenario regressed beyond the tolerance"""
+    regressed = False
+    for name, result in results.items():
+        if name not in baseline['results']:
+            continue
+        before, after = baseline['results'][name]['p95_ms'], result['p95_ms']
+        change = (after - before) / before if before else 0.0
+        marker = ''
+        if change > tolerance:
+            marker = '  REGRESSION'
+            regressed = True
+        print(f'{name:24} p95 {before:9.1f} ms -> {after:9.1f} ms ({change:+.0%}){marker}')
+    return regressed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the tool against a local Wikibase/Commons/WDQS stand-in.')
+    parser.add_argument('scenarios', nargs='*', help='scenarios to run (default: all)')
+    parser.add_argument('--requests', type=int, default=50, help='timed requests per scenario')
+    parser.add_argument('--warmup', type=int, default=5, help='untimed requests per scenario before measuring')
+    parser.add_argument('--concurrency', type=int, default=1, help='concurrent clients')
+    parser.add_argument('--latency', type=float, default=0.0, help='artificial upstream latency per API call, in seconds')
+    parser.add_argument('--sparql-latency', type=float, default=None, help='artificial WDQS latency (default: same as --latency)')
+    parser.add_argument('--fixtures', default=fakewikimedia.FIXTURES_PATH, help='recorded fixtures (synthetic corpus if missing)')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--compare', help='compare p95 latencies with results written earlier by --json')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative p95 increase for --compare')
+    parser.add_argument('--incident', choices=['maxlag', 'overloaded', 'slow'],
+                        help='simulate an upstream incident after the warmup of each scenario')
+    args = parser.parse_args(argv)
+
+    fixtures = fakewikimedia.load_fixtures(args.fixtures)
+    latency = {'api': args.latency, 'sparql': args.latency if args.sparql_latency is None else args.sparql_latency}
+    available = scenarios(fixtures)
+    names = args.scenarios or list(available)
+    for name in names:
+        if name not in available:
+            parser.error(f'unknown scenario {name!r}, expected one of: {", ".join(available)}')
+
+    with fakewikimedia.FakeWikimedia(fixtures, latency=latency) as fake:
+        harness.configure_app(fake)
+        harness.add_user('Benchmark lead', is_project_lead=True)
+        harness.add_user('Benchmark uploader')
+        for item_id in harness.corpus_item_ids(fixtures)[:20]:
+            harness.seed_local_statements(item_id, 'Benchmark annotator', fixtures, count=3)
+
+        results = {}
+        print(f'{"scenario":24} {"req/s":>9} {"mean ms":>9} {"p50 ms":>9} {"p95 ms":>9} {"errors":>7}')
+        for name in names:
+            fake.incident = None
+
+            def start_incident():
+                fake.incident = args.incident
+
+            result = results[name] = run_scenario(available[name], args.requests, args.concurrency, args.warmup, start_incident)
+            print(f'{name:24} {result["throughput"]:9.1f} {result["mean_ms"]:9.1f} {result["p50_ms"]:9.1f} {result["p95_ms"]:9.1f} {result["errors"]:7}')
+
+    settings = {key: getattr(args, key) for key in ('requests', 'warmup', 'concurrency', 'latency', 'sparql_latency', 'incident')}
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'settings': settings, 'results': results}, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
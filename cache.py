@@ -0,0 +1,157 @@
+# stale-while-revalidate caching of upstream data
+import collections
+import concurrent.futures
+import threading
+import time
+
+import metrics
+
+
+# background refreshes of all caches share a few threads, so an upstream incident cannot pile them up
+_refresh_executor = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix='cache-refresh')
+
+# all caches, by name
+caches = {}
+
+
+def clear_all():
+    for named_cache in caches.values():
+        named_cache.clear()
+
+
+class StaleWhileRevalidateCache:
+    """An LRU cache whose entries are fresh for ttl seconds and then stale for another stale_ttl seconds.
+
+    Fresh entries are returned directly. Stale entries are returned as well, but a background
+    refresh is started (at most one per key at a time), so that a slow or overloaded upstream
+    only delays the refresh, not the request. Missing entries are loaded synchronously;
+    if that fails and an expired entry is still around, it is returned instead (stale-if-error).
+    """
+
+    def __init__(self, name, maxsize, ttl, stale_ttl):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self._entries = collections.OrderedDict()  # key -> (value, loaded_at)
+        self._refreshing = set()
+        self._lock = threading.RLock()
+        caches[name] = self
+
+    def get(self, key, load):
+        """Returns the value for the key, calling load() to (re)load it"""
+        return self.get_many([key], lambda keys: {key: load()})[key]
+
+    def get_many(self, keys, load_many):
+        """Returns a dict with the values for all the keys, calling load_many(keys) to (re)load a batch of them.
+
+        load_many must return a dict with a value for each of the keys it was given.
+        """
+        now = time.monotonic()
+        values = {}
+        stale_keys = []
+        missing_keys = []
+        expired = {}
+        with self._lock:
+            for key in dict.fromkeys(keys):
+                entry = self._entries.get(key)
+                if entry is None:
+                    missing_keys.append(key)
+                    continue
+                value, loaded_at = entry
+                self._entries.move_to_end(key)
+                age = now - loaded_at
+                if age < self.ttl:
+                    values[key] = value
+                elif age < self.ttl + self.stale_ttl:
+                    values[key] = value
+                    stale_keys.append(key)
+                else:
+                    expired[key] = value
+                    missing_keys.append(key)
+        self._count('fresh', len(values) - len(stale_keys))
+        self._count('stale', len(stale_keys))
+
+        if stale_keys:
+            self._refresh(stale_keys, load_many)
+        if missing_keys:
+            self._count('miss', len(missing_keys))
+            try:
+                loaded = load_many(missing_keys)
+            except Exception:
+                if len(expired) < len(missing_keys):
+                    raise
+                self._count('error', len(missing_keys))
+                loaded = expired
+            else:
+                self.put_many(loaded)
+            values.update(loaded)
+        return values
+
+    def get_or_load_later(self, key, load, default=None):
+        """Returns the value for the key like get(), but if it is missing or expired, loads it
+        with load() in the background and returns default, for values too slow to load in a request"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None and now - entry[1] < self.ttl + self.stale_ttl:
+            return self.get(key, load)
+        self._count('miss', 1)
+        self._refresh([key], lambda keys: {key: load()})
+        return default
+
+    def put_many(self, values, age=0):
+        """Adds or replaces entries, as if they had been loaded age seconds ago"""
+        loaded_at = time.monotonic() - age
+        with self._lock:
+            for key, value in values.items():
+                self._entries[key] = (value, loaded_at)
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def peek(self, key, default=None):
+        """Returns the cached value for the key, however old, without loading it"""
+        with self._lock:
+            entry = self._entries.get(key)
+        return default if entry is None else entry[0]
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def invalidate_where(self, predicate):
+        """Removes all entries whose key matches the predicate"""
+        with self._lock:
+            for key in [key for key in self._entries if predicate(key)]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _refresh(self, keys, load_many):
+        with self._lock:
+            keys = [key for key in keys if key not in self._refreshing]
+            self._refreshing.update(keys)
+        if not keys:
+            return
+
+        def refresh():
+            try:
+                self.put_many(load_many(keys))
+            except Exception:
+                # keep serving the stale values; the next request after the stale period loads synchronously
+                self._count('refresh_error', len(keys))
+            finally:
+                with self._lock:
+                    self._refreshing.difference_update(keys)
+
+        _refresh_executor.submit(refresh)
+
+    def _count(self, outcome, amount):
+        if amount:
+            metrics.increment('cache_lookups_total', amount, cache=self.name, outcome=outcome)
@@ -0,0 +1,32 @@
+import pytest
+
+import app as wdip
+import cache
+import messages
+import recentchanges
+import upstream
+import queries
+from benchmarks import fakewikimedia, harness
+
+
+@pytest.fixture
+def fake_wikimedia(monkeypatch, tmp_path):
+    """The app pointed at a local Wikimedia stand-in with a small synthetic corpus and a scratch database"""
+    monkeypatch.setattr(queries, 'DATABASE_URL', queries.DATABASE_URL)
+    monkeypatch.setattr(messages, 'host', messages.host)
+    monkeypatch.setattr(wdip, 'consumer_token', None, raising=False)
+    monkeypatch.setitem(wdip.app.config, 'API_HOSTS', {})
+    monkeypatch.setitem(wdip.app.config, 'SPARQL_ENDPOINT', wdip.app.config['SPARQL_ENDPOINT'])
+    monkeypatch.setattr(upstream, '_breakers', {})
+    monkeypatch.setitem(wdip.app.config, 'EMAIL_WORKER', False)  # tests send the outbox with send_due()
+    monkeypatch.setitem(wdip.app.config, 'RECENT_CHANGES', False)  # tests poll the recent changes with poll()
+    monkeypatch.setattr(wdip, 'recent_changes', recentchanges.RecentChanges(
+        wdip.anonymous_session, wdip.invalidate_changed_page, wdip.RECENT_CHANGES_NAMESPACES, on_health=wdip.recent_changes_health))
+    monkeypatch.setattr(wdip.entity_cache, 'ttl', wdip.entity_cache.ttl)
+    monkeypatch.setattr(wdip, 'search_limiter', upstream.RateLimiter(wdip.app.config['SEARCH_RATE'], wdip.app.config['SEARCH_BURST']))
+    cache.clear_all()
+    with fakewikimedia.FakeWikimedia(fakewikimedia.synthetic_fixtures(size=30)) as fake:
+        harness.configure_app(fake, str(tmp_path / 'table.sqlite'))
+        yield fake
+        wdip.qualifier_buffer.flush()
+    cache.clear_all()
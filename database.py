@@ -1,5 +1,5 @@
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, String, Boolean, Integer
+from sqlalchemy import Column, String, Boolean, Integer, Float, DDL, Index, event
 from sqlalchemy.orm import relationship
 
 Base = declarative_base()
@@ -30,20 +30,64 @@ class Statements(Base):
 
     pages_value = Column(String, nullable=True)
 
+    created = Column(String, nullable=True)  # ISO 8601 UTC timestamp, set by the trigger below
+
+# timestamps of new statements, as a trigger rather than a column default so that existing databases can be upgraded
+statement_created_ddl = """CREATE TRIGGER IF NOT EXISTS statements_created AFTER INSERT ON statements WHEN NEW.created IS NULL BEGIN
+           UPDATE statements SET created = strftime('%Y-%m-%dT%H:%M:%SZ', 'now') WHERE statement_id = NEW.statement_id;
+       END"""
+event.listen(Statements.__table__, 'after_create', DDL(statement_created_ddl.replace('%', '%%')))
+
 class Qualifiers(Base):
     """This table holds information about the qualifiers (associates statement with the annotated region)"""
     __tablename__ = 'qualifiers'
 
     statement_id = Column(String, primary_key=True)
-    iiif_region = Column(String)
+    iiif_region = Column(String, index=True)  # for finding the items that share a region
     qualifier_hash = Column(String, nullable=True)
 
+# R-tree over the regions of the local statements, kept up to date by triggers on the qualifiers table.
+# Dimensions: the numeric item ID (so that queries about one object only touch its regions),
+# and the pct: region in hundredths of a percent (rounded outwards); the ID is the statement ID.
+# Regions that are not pct:x,y,w,h with a width and height of at least 0 are not indexed.
+_region_from_qualifier = """
+    SELECT statements.statement_id,
+           CAST(substr(statements.item_id, 2) AS INTEGER), CAST(substr(statements.item_id, 2) AS INTEGER),
+           CAST(x * 100 AS INTEGER), CAST(x2 * 100 AS INTEGER) + (x2 * 100 > CAST(x2 * 100 AS INTEGER)),
+           CAST(y * 100 AS INTEGER), CAST(y2 * 100 AS INTEGER) + (y2 * 100 > CAST(y2 * 100 AS INTEGER))
+    FROM statements, (SELECT region,
+                             json_extract(region, '$[0]') AS x, json_extract(region, '$[0]') + json_extract(region, '$[2]') AS x2,
+                             json_extract(region, '$[1]') AS y, json_extract(region, '$[1]') + json_extract(region, '$[3]') AS y2
+                      FROM (SELECT '[' || substr(NEW.iiif_region, 5) || ']' AS region))
+    WHERE statements.statement_id = NEW.statement_id
+      AND NEW.iiif_region LIKE 'pct:%' AND json_valid(region) AND json_array_length(region) = 4
+      AND json_extract(region, '$[2]') >= 0 AND json_extract(region, '$[3]') >= 0
+"""
+region_index_triggers = ['qualifiers_region_index_insert', 'qualifiers_region_index_update', 'qualifiers_region_index_delete']
+region_index_ddl = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS region_index USING rtree_i32(
+           id, min_item, max_item, min_x, max_x, min_y, max_y)""",
+    """CREATE TRIGGER IF NOT EXISTS qualifiers_region_index_insert AFTER INSERT ON qualifiers BEGIN
+           INSERT OR REPLACE INTO region_index %s;
+       END""" % _region_from_qualifier,
+    """CREATE TRIGGER IF NOT EXISTS qualifiers_region_index_update AFTER UPDATE OF iiif_region ON qualifiers BEGIN
+           DELETE FROM region_index WHERE id = OLD.statement_id;
+           INSERT OR REPLACE INTO region_index %s;
+       END""" % _region_from_qualifier,
+    """CREATE TRIGGER IF NOT EXISTS qualifiers_region_index_delete AFTER DELETE ON qualifiers BEGIN
+           DELETE FROM region_index WHERE id = OLD.statement_id;
+       END""",
+]
+for statement in region_index_ddl:
+    event.listen(Qualifiers.__table__, 'after_create', DDL(statement.replace('%', '%%')))
+event.listen(Qualifiers.__table__, 'before_drop', DDL('DROP TABLE IF EXISTS region_index'))
+
 class Comments(Base):
     """This table holds information about the comments that project leads leave on specific statements."""
     __tablename__ = 'comments'
 
     comment_id = Column(Integer, primary_key=True, autoincrement=True)
-    statement_id = Column(String)
+    statement_id = Column(String, index=True)
     comment = Column(String)
     project_lead_username = Column(String)
     item_id = Column(String)
@@ -56,4 +100,104 @@ class Approvals(Base):
     approval_id = Column(Integer, primary_key=True, autoincrement=True)
     username = Column(String)
     item_id = Column(String)
-    approved = Column(Boolean)
\ No newline at end of file
+    approved = Column(Boolean)
+
+class BulkUploads(Base):
+    """This table holds the progress of bulk approvals and uploads by project leads, one row per item_id and username pair"""
+    __tablename__ = 'bulk_uploads'
+
+    bulk_upload_id = Column(Integer, primary_key=True, autoincrement=True)
+    batch_id = Column(String, index=True)
+    item_id = Column(String)
+    username = Column(String)
+    project_lead_username = Column(String)
+    status = Column(String)  # queued, uploading, uploaded or failed
+    message = Column(String, nullable=True)
+    claimed_until = Column(Float, nullable=True)  # UNIX timestamp, renewed by the process running the batch while it is unfinished
+
+class EmailOutbox(Base):
+    """This table holds the approval emails waiting to be sent, one row per approved item_id and username pair.
+
+    The emails are sent on behalf of the project lead, but their OAuth access token is not stored here (see outbox.py)."""
+    __tablename__ = 'email_outbox'
+
+    email_id = Column(Integer, primary_key=True, autoincrement=True)
+    username = Column(String, index=True)  # the recipient
+    item_id = Column(String)
+    item_url = Column(String)
+    uploaded = Column(Boolean)
+    project_lead_username = Column(String)
+    status = Column(String, index=True)  # pending, sent or failed
+    attempts = Column(Integer, default=0)
+    created = Column(Float)  # UNIX timestamps
+    send_after = Column(Float)
+    claimed_by = Column(String, nullable=True)
+    claimed_until = Column(Float, nullable=True)
+    last_error = Column(String, nullable=True)
+
+class EntityStore(Base):
+    """This table holds compact entity data (see entities.py) loaded from a Wikidata dump by dumpimporter.py,
+    which seeds the entity cache until the data is refreshed from the API"""
+    __tablename__ = 'entity_store'
+
+    entity_id = Column(String, primary_key=True)
+    props = Column(String)  # the wbgetentities props the data covers, e.g. claims|descriptions|labels
+    data = Column(String)  # JSON of entities.Entity.to_record()
+    lastrevid = Column(Integer)
+
+class AnnotationVersions(Base):
+    """This table holds a version number per item_id and username pair, increased by triggers whenever
+    the local statements, regions, comments or approval of that user on that item change"""
+    __tablename__ = 'annotation_versions'
+
+    item_id = Column(String, primary_key=True)
+    username = Column(String, primary_key=True)
+    version = Column(Integer)
+
+class AnnotationChanges(Base):
+    """This table logs what changed in each annotation version (written by the same triggers), for the delta endpoint.
+
+    Only the last ANNOTATION_CHANGES_KEPT versions of each item_id and username pair are kept; older versions get full replies."""
+    __tablename__ = 'annotation_changes'
+    __table_args__ = (Index('ix_annotation_changes_item_id_username_version', 'item_id', 'username', 'version'),)
+
+    change_id = Column(Integer, primary_key=True, autoincrement=True)
+    item_id = Column(String)
+    username = Column(String)
+    version = Column(Integer)
+    kind = Column(String)  # statement (including its region), comment or approval
+    key = Column(String)  # the statement_id or comment_id; empty for the approval
+
+ANNOTATION_CHANGES_KEPT = 1000
+
+# table -> (the kind of change, its key, and the item_id and username pair a row belongs to)
+_annotation_owners = {
+    'statements': ('statement', '{row}.statement_id', "SELECT {row}.item_id AS item_id, {row}.username AS username"),
+    'qualifiers': ('statement', '{row}.statement_id', "SELECT item_id, username FROM statements WHERE statements.statement_id = {row}.statement_id"),
+    'comments': ('comment', '{row}.comment_id', "SELECT {row}.item_id AS item_id, {row}.username AS username"),
+    'approvals': ('approval', "''", "SELECT {row}.item_id AS item_id, {row}.username AS username"),
+}
+_annotation_change = """CREATE TRIGGER IF NOT EXISTS {table}_annotation_version_{event} AFTER {event} ON {table} BEGIN
+           INSERT INTO annotation_versions (item_id, username, version) SELECT item_id, username, 1 FROM ({owner}) WHERE true
+           ON CONFLICT (item_id, username) DO UPDATE SET version = version + 1;
+           INSERT INTO annotation_changes (item_id, username, version, kind, key)
+           SELECT owner.item_id, owner.username, annotation_versions.version, '{kind}', CAST({key} AS TEXT)
+           FROM ({owner}) AS owner
+           JOIN annotation_versions ON annotation_versions.item_id = owner.item_id AND annotation_versions.username = owner.username;
+           DELETE FROM annotation_changes WHERE change_id IN (
+               SELECT annotation_changes.change_id
+               FROM ({owner}) AS owner
+               JOIN annotation_versions ON annotation_versions.item_id = owner.item_id AND annotation_versions.username = owner.username
+               JOIN annotation_changes ON annotation_changes.item_id = owner.item_id AND annotation_changes.username = owner.username
+               WHERE annotation_changes.version <= annotation_versions.version - {kept});
+       END"""
+annotation_version_triggers = []
+annotation_version_ddl = []
+for _table, (_kind, _key, _owner) in _annotation_owners.items():
+    for _event, _row in [('insert', 'NEW'), ('update', 'NEW'), ('delete', 'OLD')]:
+        annotation_version_triggers.append(f'{_table}_annotation_version_{_event}')
+        annotation_version_ddl.append(_annotation_change.format(table=_table, event=_event, kind=_kind, kept=ANNOTATION_CHANGES_KEPT,
+                                                                key=_key.format(row=_row), owner=_owner.format(row=_row)))
+# the annotation tables are created after the tables the triggers are on
+for statement in annotation_version_ddl:
+    event.listen(AnnotationChanges.__table__, 'after_create', DDL(statement.replace('%', '%%')))
@@ -1,8 +1,9 @@
-from sys import stderr, exit
+from sys import argv, stderr, exit
 from sqlite3 import connect as sqlite_connect
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
-from database import Base, Users, Statements, Qualifiers
+from database import Base, Users, Statements, Qualifiers, ANNOTATION_CHANGES_KEPT, annotation_version_ddl, annotation_version_triggers, region_index_ddl, region_index_triggers, statement_created_ddl
+from queries import prune_annotation_changes
 from consts import *
 
 if __name__ == "__main__":
@@ -11,8 +12,41 @@ if __name__ == "__main__":
         engine = create_engine('sqlite://', creator=lambda: sqlite_connect('file:' + FILENAME + '.sqlite?mode=rwc', uri=True))
         Session = sessionmaker(bind=engine)
         session = Session()
-        Base.metadata.drop_all(engine)
-        Base.metadata.create_all(engine)
+        if argv[1:] == ['--upgrade']:
+            # upgrade an existing database: create the tables, columns, indexes and triggers added since it was built
+            # (each step checks what is there already, so it can be run again)
+            Base.metadata.create_all(engine)
+            with engine.begin() as connection:
+                connection.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_qualifiers_iiif_region ON qualifiers (iiif_region)')
+                columns = [row[1] for row in connection.exec_driver_sql('PRAGMA table_info(statements)')]
+                if 'created' not in columns:
+                    connection.exec_driver_sql('ALTER TABLE statements ADD COLUMN created VARCHAR')
+                connection.exec_driver_sql(statement_created_ddl)
+                columns = [row[1] for row in connection.exec_driver_sql('PRAGMA table_info(bulk_uploads)')]
+                if 'claimed_until' not in columns:
+                    connection.exec_driver_sql('ALTER TABLE bulk_uploads ADD COLUMN claimed_until FLOAT')
+                for trigger in annotation_version_triggers:
+                    connection.exec_driver_sql(f'DROP TRIGGER IF EXISTS {trigger}')  # replaced by newer versions
+                has_region_index = connection.exec_driver_sql("SELECT 1 FROM sqlite_master WHERE name = 'region_index'").fetchall()
+                for trigger in region_index_triggers:
+                    connection.exec_driver_sql(f'DROP TRIGGER IF EXISTS {trigger}')  # replaced by newer versions
+                for statement in region_index_ddl:
+                    connection.exec_driver_sql(statement)
+                if not has_region_index:
+                    # index the regions the database already has (before the annotation version triggers are back, these are no changes)
+                    connection.exec_driver_sql('UPDATE qualifiers SET iiif_region = iiif_region')
+                for statement in annotation_version_ddl:
+                    connection.exec_driver_sql(statement)
+                connection.exec_driver_sql(prune_annotation_changes(), (ANNOTATION_CHANGES_KEPT,))
+                connection.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_comments_statement_id ON comments (statement_id)')
+                # access tokens are no longer stored in the outbox
+                columns = [row[1] for row in connection.exec_driver_sql('PRAGMA table_info(email_outbox)')]
+                for column in ['access_token_key', 'access_token_secret']:
+                    if column in columns:
+                        connection.exec_driver_sql(f'ALTER TABLE email_outbox DROP COLUMN {column}')
+        else:
+            Base.metadata.drop_all(engine)
+            Base.metadata.create_all(engine)
 
         engine.dispose()
     except Exception as ex:
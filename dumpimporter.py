@@ -0,0 +1,140 @@
+# seeding of the entity store from a Wikidata JSON dump, so that the entity cache does not have to be warmed item by item through the API
+import argparse
+import bz2
+import gzip
+import json
+import re
+
+import entities
+import queries
+
+
+CHUNK_SIZE = 1000  # entities per transaction
+# the corpus, as in the dashboard query: photographs (Q125191) in the collection Q1568434 that have an image
+INSTANCE_OF = 'Q125191'
+COLLECTION = 'Q1568434'
+CORPUS_PROPS = 'claims|descriptions|labels'
+LABEL_PROPS = 'labels'
+# the entity ID of a line with a single entity: dumps start every entity with "type" and "id"
+ENTITY_ID = re.compile(r'"id"\s*:\s*"([A-Z][0-9]+)"')
+
+
+def open_dump(path):
+    """Opens a dump for reading as text, decompressing .gz and .bz2 files on the fly"""
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8')
+    if path.endswith('.bz2'):
+        return bz2.open(path, 'rt', encoding='utf-8')
+    return open(path, encoding='utf-8')
+
+
+def read_entities(lines, wanted=None):
+    """Yields the entities of a Wikidata JSON dump (a JSON array with one entity per line), line by line.
+
+    Lines with one Special:EntityData document ({"entities": {...}}) each, and NDJSON, are read as well.
+    If wanted(line, entity_id) is given, lines it returns false for are skipped without being parsed."""
+    for line in lines:
+        line = line.strip()
+        if line.endswith(','):
+            line = line[:-1]
+        if line in ('', '[', ']'):
+            continue
+        if wanted is not None and not line.startswith('{"entities"'):
+            match = ENTITY_ID.search(line)
+            if match and not wanted(line, match.group(1)):
+                continue
+        document = json.loads(line)
+        if 'entities' in document and 'id' not in document:
+            yield from document['entities'].values()
+        else:
+            yield document
+
+
+def item_values(claims, property_id):
+    return {claim['mainsnak']['datavalue']['value'].get('id') for claim in claims.get(property_id, [])
+            if claim['mainsnak']['snaktype'] == 'value' and claim['mainsnak']['datavalue']['type'] == 'wikibase-entityid'}
+
+
+def in_corpus(entity_data, collections):
+    """Whether an entity is in the corpus: an instance of photograph in one of the collections, with an image"""
+    claims = entity_data.get('claims', {})
+    return INSTANCE_OF in item_values(claims, 'P31') and bool(collections & item_values(claims, 'P195')) and bool(claims.get('P18'))
+
+
+def import_dump(open_lines, languages, depicted_properties, collections=(COLLECTION,), chunk_size=CHUNK_SIZE):
+    """Loads the corpus items, and the labels of the entities they refer to, from a dump into the entity store.
+
+    open_lines() opens the dump as a file (or any context manager iterating over its lines). It is read twice,
+    once for the corpus items and once for the labels of their depicted items and metadata properties,
+    which can come anywhere in the dump.
+    Only the labels and descriptions in the given languages are kept. Returns the numbers of items and labels stored."""
+    collections = set(collections)
+    needles = ['"' + INSTANCE_OF + '"', *('"' + collection + '"' for collection in collections)]
+    corpus = set()
+    referenced = set()
+
+    def corpus_line(line, entity_id):
+        # cheap substring checks first, most of a full dump is neither a photograph nor in the collections
+        return entity_id.startswith('Q') and needles[0] in line and any(needle in line for needle in needles[1:])
+
+    def corpus_entities():
+        with open_lines() as lines:
+            for entity_data in read_entities(lines, corpus_line):
+                if in_corpus(entity_data, collections):
+                    entity = entities.Entity.from_json(entity_data, depicted_properties, languages)
+                    corpus.add(entity.entity_id)
+                    referenced.update(depicted.item_id for depicted in entity.depicteds if depicted.item_id)
+                    referenced.update(entity.metadata)
+                    yield entity_data, entity, CORPUS_PROPS
+
+    items = store(corpus_entities(), chunk_size)
+
+    def label_entities():
+        wanted = referenced - corpus
+        with open_lines() as lines:
+            for entity_data in read_entities(lines, lambda line, entity_id: entity_id in wanted):
+                if entity_data['id'] in wanted:
+                    labels_only = {'id': entity_data['id'], 'lastrevid': entity_data.get('lastrevid', 0), 'labels': entity_data.get('labels', {})}
+                    yield entity_data, entities.Entity.from_json(labels_only, depicted_properties, languages), LABEL_PROPS
+
+    labels = store(label_entities(), chunk_size) if referenced - corpus else 0
+    return items, labels
+
+
+def store(projected, chunk_size):
+    count = 0
+    chunk = []
+    for entity_data, entity, props in projected:
+        chunk.append([entity.entity_id, props, json.dumps(entity.to_record(), ensure_ascii=False), entity_data.get('lastrevid', 0)])
+        if len(chunk) == chunk_size:
+            count += write_chunk(chunk)
+            chunk = []
+    if chunk:
+        count += write_chunk(chunk)
+    return count
+
+
+def write_chunk(chunk):
+    with queries.transaction() as connection:
+        queries.query_db_many(queries.put_stored_entity(), chunk, connection=connection)
+    return len(chunk)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load the corpus items and the labels they need from a Wikidata JSON dump '
+                                                 '(or Special:EntityData files, one per line), optionally .gz or .bz2 compressed.')
+    parser.add_argument('dump')
+    parser.add_argument('--database', default=queries.DATABASE_URL)
+    parser.add_argument('--collection', action='append', default=[COLLECTION],
+                        help='also include items in this collection, e.g. a subcollection of Q1568434 (repeatable)')
+    args = parser.parse_args(argv)
+
+    import app as wdip  # not at the top, only for the configuration
+    queries.DATABASE_URL = args.database
+    items, labels = import_dump(lambda: open_dump(args.dump), wdip.app.config['ENTITY_LANGUAGES'], wdip.depicted_properties,
+                                collections=args.collection)
+    print(f'stored {items} items and {labels} labels')
+
+
+if __name__ == '__main__':
+    main()
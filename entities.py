@@ -0,0 +1,194 @@
+# compact projections of wbgetentities entity data, holding only what the tool uses; these are what the entity cache holds
+import json
+
+
+# property IDs based on https://www.wikidata.org/wiki/Wikidata:WikiProject_Visual_arts/Item_structure#Describing_individual_objects
+METADATA_PROPERTY_IDS = (
+    'P170',  # creator
+    'P1476',  # title
+    'P571',  # inception
+    'P186',  # material used
+    'P2079',  # fabrication method
+    'P2048',  # height
+    'P2049',  # width
+    'P2610',  # thickness
+    'P88',  # commissioned by
+    'P1071',  # location of final assembly
+    'P127',  # owned by
+    'P1259',  # coordinates of the point of view
+    'P195',  # collection
+    'P276',  # location
+    'P635',  # coordinate location
+    'P1684',  # inscription
+    'P136',  # genre
+    'P135',  # movement
+    'P921',  # main subject
+    'P144',  # based on
+    'P941',  # inspired by
+)
+
+
+class Depicted:
+    """A depicted statement (e.g. P180) with its P2677 region, if it has one"""
+
+    __slots__ = ('statement_id', 'property_id', 'snaktype', 'item_id', 'iiif_region', 'qualifier_hash')
+
+    def __init__(self, statement_id, property_id, snaktype, item_id=None, iiif_region=None, qualifier_hash=None):
+        self.statement_id = statement_id
+        self.property_id = property_id
+        self.snaktype = snaktype
+        self.item_id = item_id
+        self.iiif_region = iiif_region
+        self.qualifier_hash = qualifier_hash
+
+    def to_dict(self):
+        """The depicted dict the templates and the JavaScript use, without unset keys"""
+        depicted = {
+            'snaktype': self.snaktype,
+            'statement_id': self.statement_id,
+            'property_id': self.property_id,
+        }
+        if self.item_id is not None:
+            depicted['item_id'] = self.item_id
+        if self.iiif_region is not None:
+            depicted['iiif_region'] = self.iiif_region
+            depicted['qualifier_hash'] = self.qualifier_hash
+        return depicted
+
+
+class Entity:
+    """The parts of an entity the tool uses.
+
+    labels and descriptions map language codes to strings; images maps each commonsMedia property
+    to its best value (a datavalue dict); metadata maps each of the METADATA_PROPERTY_IDS the entity has
+    to a tuple of its best values, as JSON with sorted keys (the form wbformatvalue takes them in);
+    depicteds is a tuple of Depicted for the depicted properties."""
+
+    __slots__ = ('entity_id', 'lastrevid', 'missing', 'labels', 'descriptions', 'images', 'metadata', 'depicteds')
+
+    def __init__(self, entity_id, lastrevid=0, missing=False, labels=None, descriptions=None, images=None, metadata=None, depicteds=()):
+        self.entity_id = entity_id
+        self.lastrevid = lastrevid
+        self.missing = missing
+        self.labels = labels or {}
+        self.descriptions = descriptions or {}
+        self.images = images or {}
+        self.metadata = metadata or {}
+        self.depicteds = depicteds
+
+    @classmethod
+    def from_json(cls, entity_data, depicted_properties, languages=None):
+        """Projects the wbgetentities (or dump) JSON of an item or MediaInfo entity, optionally keeping only some languages"""
+        if 'missing' in entity_data:
+            return cls(entity_data['id'], missing=True)
+        statements = entity_data.get('claims', entity_data.get('statements', {}))
+        if statements == []:
+            statements = {}  # T222159
+        images = {}
+        for property_id, property_statements in statements.items():
+            if property_statements and property_statements[0]['mainsnak'].get('datatype', 'commonsMedia') == 'commonsMedia':
+                datavalue = best_value(property_statements)
+                if datavalue is not None:
+                    images[property_id] = datavalue
+        metadata = {}
+        for property_id in METADATA_PROPERTY_IDS:
+            datavalues = best_values(statements.get(property_id, []))
+            if datavalues:
+                metadata[property_id] = tuple(json.dumps(datavalue, sort_keys=True) for datavalue in datavalues)
+        depicteds = []
+        for property_id in depicted_properties:
+            for statement in statements.get(property_id, []):
+                depicteds.append(project_depicted(statement, property_id))
+        return cls(
+            entity_data['id'],
+            lastrevid=entity_data.get('lastrevid', 0),
+            labels=language_values(entity_data.get('labels', {}), languages),
+            descriptions=language_values(entity_data.get('descriptions', {}), languages),
+            images=images,
+            metadata=metadata,
+            depicteds=tuple(depicteds),
+        )
+
+    def to_record(self):
+        """A JSON-serializable form of the projection, for the entity store"""
+        return {
+            'id': self.entity_id,
+            'lastrevid': self.lastrevid,
+            'labels': self.labels,
+            'descriptions': self.descriptions,
+            'images': self.images,
+            'metadata': self.metadata,
+            'depicteds': [[getattr(depicted, name) for name in Depicted.__slots__] for depicted in self.depicteds],
+        }
+
+    @classmethod
+    def from_record(cls, record):
+        return cls(
+            record['id'],
+            lastrevid=record.get('lastrevid', 0),
+            labels=record['labels'],
+            descriptions=record['descriptions'],
+            images=record['images'],
+            metadata={property_id: tuple(values) for property_id, values in record['metadata'].items()},
+            depicteds=tuple(Depicted(*depicted) for depicted in record['depicteds']),
+        )
+
+
+def language_values(language_strings, languages=None):
+    return {language_code: language_string['value'] for language_code, language_string in language_strings.items()
+            if languages is None or language_code in languages}
+
+
+def project_depicted(statement, property_id):
+    snaktype = statement['mainsnak']['snaktype']
+    depicted = Depicted(statement['id'], property_id, snaktype)
+    if snaktype == 'value':
+        depicted.item_id = statement['mainsnak']['datavalue']['value']['id']
+    for qualifier in statement.get('qualifiers', {}).get('P2677', []):
+        if qualifier['snaktype'] != 'value':
+            continue
+        depicted.iiif_region = qualifier['datavalue']['value']
+        depicted.qualifier_hash = qualifier['hash']
+        break
+    return depicted
+
+
+def best_value(statements):
+    """The datavalue of the first preferred statement, else the last normal one, else the last deprecated one"""
+    normal_value = None
+    deprecated_value = None
+
+    for statement in statements:
+        if statement['mainsnak']['snaktype'] != 'value':
+            continue
+
+        datavalue = statement['mainsnak']['datavalue']
+        if statement['rank'] == 'preferred':
+            return datavalue
+        if statement['rank'] == 'normal':
+            normal_value = datavalue
+        else:
+            deprecated_value = datavalue
+
+    return normal_value or deprecated_value
+
+
+def best_values(statements):
+    """The datavalues of the preferred statements, else of the normal ones, else of the deprecated ones"""
+    preferred_values = []
+    normal_values = []
+    deprecated_values = []
+
+    for statement in statements:
+        if statement['mainsnak']['snaktype'] != 'value':
+            continue
+
+        datavalue = statement['mainsnak']['datavalue']
+        if statement['rank'] == 'preferred':
+            preferred_values.append(datavalue)
+        elif statement['rank'] == 'normal':
+            normal_values.append(datavalue)
+        else:
+            deprecated_values.append(datavalue)
+
+    return preferred_values or normal_values or deprecated_values
@@ -7,3 +7,21 @@ class WrongDataValueType(Exception):
         Exception.__init__(self)
         self.expected_data_value_type = expected_data_value_type
         self.actual_data_value_type = actual_data_value_type
+
+class UpstreamUnavailable(Exception):
+    """Wikidata, Commons or the query service is failing, overloaded or asked us to back off."""
+    status_code = 503
+
+    def __init__(self, host, retry_after=None):
+        Exception.__init__(self, f'{host} is unavailable')
+        self.host = host
+        self.retry_after = retry_after
+
+class InvalidOperation(Exception):
+    """One operation of a batch request is malformed or refers to something that does not exist."""
+    status_code = 400
+
+    def __init__(self, index, message):
+        Exception.__init__(self, message)
+        self.index = index
+        self.message = message
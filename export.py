@@ -0,0 +1,146 @@
+# streaming export of the local annotations, used by the export endpoint and as a command line tool
+import argparse
+import csv
+import io
+import json
+import sys
+
+import queries
+
+
+CHUNK_SIZE = 1000  # statements per read
+CSV_COLUMNS = ['statement_id', 'item_id', 'property_id', 'value_id', 'snaktype', 'username', 'reference_type', 'reference_value',
+               'pages_value', 'created', 'iiif_region', 'approved', 'comments']
+MEDIA_TYPES = {  # format -> (media type, file name extension)
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+    'csv': ('text/csv', 'csv'),
+    'quickstatements': ('text/plain', 'txt'),
+    'wbeditentity': ('application/x-ndjson', 'ndjson'),
+}
+
+
+def statements(username=None, item_id=None, approved=None, since=None, until=None, chunk_size=CHUNK_SIZE):
+    """Yields the local statements matching the filters as dicts, in statement ID order.
+
+    The statements are read in chunks after the last statement ID seen, each in its own short read,
+    so memory use does not grow with the export, and a slow client does not keep the database
+    locked against writers (as one long-running cursor would)."""
+    params = {'username': username, 'item_id': item_id, 'approved': approved, 'since': since, 'until': until,
+              'after': 0, 'limit': chunk_size}
+    while True:
+        rows = queries.query_db(queries.get_export_statements(), params=params)
+        for row in rows:
+            statement = dict(row)
+            statement['approved'] = bool(statement['approved'])
+            statement['comments'] = json.loads(statement['comments'])
+            yield statement
+        if len(rows) < chunk_size:
+            return
+        params['after'] = rows[-1]['statement_id']
+
+
+def ndjson(statements):
+    for statement in statements:
+        yield json.dumps(statement) + '\n'
+
+
+def csv_lines(statements):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(CSV_COLUMNS)
+    for statement in statements:
+        writer.writerow([json.dumps(statement[column]) if column == 'comments' else statement[column] for column in CSV_COLUMNS])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def quickstatements(statements):
+    """QuickStatements (version 1) commands, one line per statement with its region and reference"""
+    for statement in statements:
+        value = statement['value_id'] if statement['snaktype'] == 'value' else statement['snaktype']
+        command = [statement['item_id'], statement['property_id'], value]
+        if statement['iiif_region']:
+            command += ['P2677', json.dumps(statement['iiif_region'])]
+        if statement['reference_type'] and statement['reference_value']:
+            if statement['reference_type'] == 'P248':
+                command += ['S248', statement['reference_value']]
+            else:
+                command += ['S' + statement['reference_type'][1:], json.dumps(statement['reference_value'])]
+            if statement['pages_value']:
+                command += ['S304', json.dumps(statement['pages_value'])]
+        yield '\t'.join(command) + '\n'
+
+
+def wbeditentity(statements):
+    """wbeditentity data, one line per statement, adding it as a new claim"""
+    for statement in statements:
+        yield json.dumps({'id': statement['item_id'], 'claims': [claim(statement)]}) + '\n'
+
+
+def claim(statement):
+    """Returns the Wikibase JSON of a local statement with its region and reference"""
+    mainsnak = {'snaktype': statement['snaktype'], 'property': statement['property_id']}
+    if statement['snaktype'] == 'value':
+        mainsnak['datavalue'] = item_value(statement['value_id'])
+    wikibase_claim = {'type': 'statement', 'rank': 'normal', 'mainsnak': mainsnak}
+    if statement['iiif_region']:
+        wikibase_claim['qualifiers'] = {'P2677': [string_snak('P2677', statement['iiif_region'])]}
+    if statement['reference_type'] and statement['reference_value']:
+        reference_type = statement['reference_type']
+        if reference_type == 'P248':
+            snaks = {'P248': [{'snaktype': 'value', 'property': 'P248', 'datavalue': item_value(statement['reference_value'])}]}
+        else:
+            snaks = {reference_type: [string_snak(reference_type, statement['reference_value'])]}
+        if statement['pages_value']:
+            snaks['P304'] = [string_snak('P304', statement['pages_value'])]
+        wikibase_claim['references'] = [{'snaks': snaks, 'snaks-order': list(snaks)}]
+    return wikibase_claim
+
+
+def item_value(item_id):
+    return {'value': {'entity-type': 'item', 'id': item_id}, 'type': 'wikibase-entityid'}
+
+
+def string_snak(property_id, value):
+    return {'snaktype': 'value', 'property': property_id, 'datavalue': {'value': value, 'type': 'string'}}
+
+
+FORMATS = {
+    'ndjson': ndjson,
+    'csv': csv_lines,
+    'quickstatements': quickstatements,
+    'wbeditentity': wbeditentity,
+}
+
+
+def parse_approved(value):
+    """Parses the approved filter: yes/true/1, no/false/0, or empty for both"""
+    if value in (None, ''):
+        return None
+    if value.lower() in {'yes', 'true', '1'}:
+        return True
+    if value.lower() in {'no', 'false', '0'}:
+        return False
+    raise ValueError(f'approved must be yes or no, not {value!r}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Export the local annotations.')
+    parser.add_argument('--format', choices=list(FORMATS), default='ndjson')
+    parser.add_argument('--database', default=queries.DATABASE_URL)
+    parser.add_argument('--username')
+    parser.add_argument('--item-id')
+    parser.add_argument('--approved', type=parse_approved, help='yes or no (default: both)')
+    parser.add_argument('--since', help='only statements created at or after this date (YYYY-MM-DD or ISO 8601 timestamp, UTC)')
+    parser.add_argument('--until', help='only statements created before this date')
+    args = parser.parse_args(argv)
+
+    queries.DATABASE_URL = args.database
+    for chunk in FORMATS[args.format](statements(args.username, args.item_id, args.approved, args.since, args.until)):
+        sys.stdout.write(chunk)
+
+
+if __name__ == '__main__':
+    main()
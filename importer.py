@@ -0,0 +1,166 @@
+# bulk import of region annotations from CSV files or IIIF annotation lists, used by the import endpoint and as a command line tool
+import argparse
+import csv
+import io
+import json
+import re
+import sys
+import time
+
+import queries
+import regions
+
+
+CHUNK_SIZE = 10000  # statements per transaction
+ITEM_ID = re.compile(r'^Q[1-9][0-9]*$')
+PROPERTY_ID = re.compile(r'^P[1-9][0-9]*$')
+ENTITY_URL = re.compile(r'/entity/(Q[1-9][0-9]*)$')
+IIIF_ITEM_URL = re.compile(r'/iiif/(Q[1-9][0-9]*)/')
+XYWH = re.compile(r'^(?:xywh=)?(?:pixel:)?([0-9.]+),([0-9.]+),([0-9.]+),([0-9.]+)$')
+SNAKTYPES = {'value', 'somevalue', 'novalue'}
+REFERENCE_TYPES = {'P248', 'P854'}
+
+
+def read(text):
+    """Reads annotation rows from the text of a CSV file or an sc:AnnotationList JSON document"""
+    if text.lstrip().startswith('{'):
+        return list(read_annotation_list(json.loads(text)))
+    return list(read_csv(text))
+
+
+def read_csv(text):
+    """Reads annotation rows from CSV with a header row, with the columns of the CSV export.
+
+    Either iiif_region (pct:x,y,w,h) or xywh (pixels of the item's image) can be given;
+    property_id defaults to P180, snaktype to value, and username to the importing user."""
+    for row in csv.DictReader(io.StringIO(text)):
+        yield {column.strip(): value.strip() or None for column, value in row.items() if column and isinstance(value, str)}
+
+
+def read_annotation_list(document):
+    """Reads annotation rows from an sc:AnnotationList like /iiif/<item_id>/list/annotations.json"""
+    list_item = IIIF_ITEM_URL.search(document.get('@id', ''))
+    for annotation in document.get('resources', []):
+        target = annotation.get('on', '')
+        if isinstance(target, dict):
+            # a SpecificResource with a FragmentSelector
+            target = target.get('full', '') + '#' + target.get('selector', {}).get('value', '')
+        canvas, _, fragment = target.partition('#')
+        item = IIIF_ITEM_URL.search(canvas) or list_item
+        value = ENTITY_URL.search(annotation.get('resource', {}).get('@id', ''))
+        yield {
+            'item_id': item.group(1) if item else None,
+            'value_id': value.group(1) if value else None,
+            'xywh': fragment or None,
+        }
+
+
+def pct_region(iiif_region):
+    """Parses and checks a pct:x,y,w,h region, returning it normalized, or None"""
+    region = regions.parse_pct_region(iiif_region)
+    return format_pct(region) if region is not None else None
+
+
+def pixel_region(xywh, width, height):
+    """Converts an x,y,w,h pixel region of an image of the given size into a pct: region, or returns None"""
+    match = XYWH.match(xywh)
+    if not match:
+        return None
+    x, y, w, h = (float(part) for part in match.groups())
+    if w <= 0 or h <= 0 or x + w > width or y + h > height:
+        return None
+    return format_pct([x * 100 / width, y * 100 / height, w * 100 / width, h * 100 / height])
+
+
+def format_pct(region):
+    """Formats a pct region in hundredths of a percent, the precision of the region index, or returns None
+    if that leaves it without a width or height"""
+    formatted = 'pct:' + ','.join(('%.2f' % part).rstrip('0').rstrip('.') for part in region)
+    return formatted if regions.parse_pct_region(formatted) else None
+
+
+def import_annotations(rows, username, existing_items, image_sizes, skip_invalid=False, chunk_size=CHUNK_SIZE):
+    """Validates annotation rows and adds them as local statements with qualifiers.
+
+    existing_items(item_ids) returns the subset of the item IDs that exist, and image_sizes(item_ids)
+    the (width, height) of the items' images, for converting pixel regions; both should be batched and cached.
+    Returns the number of imported statements and a list of (row number, error) pairs; if there are errors,
+    nothing is imported unless skip_invalid is true. The statements are inserted with executemany,
+    chunk_size statements per transaction, so other writers only wait for one chunk at a time."""
+    rows = list(rows)
+    errors = {}
+    for number, row in enumerate(rows, start=1):
+        row['property_id'] = row.get('property_id') or 'P180'
+        row['snaktype'] = row.get('snaktype') or 'value'
+        row['username'] = row.get('username') or username
+        if not ITEM_ID.match(row.get('item_id') or ''):
+            errors[number] = f'invalid item ID {row.get("item_id")!r}'
+        elif not PROPERTY_ID.match(row['property_id']):
+            errors[number] = f'invalid property ID {row["property_id"]!r}'
+        elif row['snaktype'] not in SNAKTYPES:
+            errors[number] = f'invalid snaktype {row["snaktype"]!r}'
+        elif row['snaktype'] == 'value' and not ITEM_ID.match(row.get('value_id') or ''):
+            errors[number] = f'invalid value {row.get("value_id")!r}'
+        elif row.get('reference_type') and row['reference_type'] not in REFERENCE_TYPES:
+            errors[number] = f'invalid reference type {row["reference_type"]!r}'
+        elif row.get('iiif_region') and not pct_region(row['iiif_region']):
+            errors[number] = f'invalid region {row["iiif_region"]!r}'
+        if row['snaktype'] != 'value':
+            row['value_id'] = None
+
+    valid = [(number, row) for number, row in enumerate(rows, start=1) if number not in errors]
+    entity_ids = {row['item_id'] for _, row in valid} | {row['value_id'] for _, row in valid if row['value_id']}
+    existing = existing_items(sorted(entity_ids)) if entity_ids else set()
+    sizes = image_sizes(sorted({row['item_id'] for _, row in valid if row.get('xywh') and not row.get('iiif_region')}))
+    for number, row in valid:
+        missing = [entity_id for entity_id in (row['item_id'], row['value_id']) if entity_id and entity_id not in existing]
+        if missing:
+            errors[number] = f'{missing[0]} does not exist'
+        elif row.get('iiif_region'):
+            row['iiif_region'] = pct_region(row['iiif_region'])
+        elif row.get('xywh'):
+            size = sizes.get(row['item_id'])
+            row['iiif_region'] = pixel_region(row['xywh'], *size) if size else None
+            if row['iiif_region'] is None:
+                errors[number] = (f'invalid pixel region {row["xywh"]!r}' if size
+                                  else f'{row["item_id"]} has no image to convert the pixel region with')
+
+    if errors and not skip_invalid:
+        return 0, sorted(errors.items())
+    valid = [row for number, row in enumerate(rows, start=1) if number not in errors]
+    created = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+    for start in range(0, len(valid), chunk_size):
+        chunk = valid[start:start + chunk_size]
+        with queries.transaction() as connection:
+            # the write lock is held, so the statement IDs after the current maximum are ours
+            first_id = queries.query_db(queries.get_max_statement_id(), connection=connection)[0]['statement_id'] + 1
+            queries.query_db_many(queries.add_imported_statement(), [
+                [first_id + index, row['item_id'], row['property_id'], row['value_id'], row['snaktype'], row['username'],
+                 row.get('reference_type'), row.get('reference_value'), row.get('pages_value'), created]
+                for index, row in enumerate(chunk)], connection=connection)
+            queries.query_db_many(queries.add_qualifier(), [
+                [first_id + index, row['iiif_region'], '']
+                for index, row in enumerate(chunk) if row.get('iiif_region')], connection=connection)
+    return len(valid), sorted(errors.items())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Import region annotations from a CSV file or a IIIF annotation list.')
+    parser.add_argument('file', type=argparse.FileType('r', encoding='utf-8'))
+    parser.add_argument('--username', required=True, help='the user to attribute rows without a username column to')
+    parser.add_argument('--database', default=queries.DATABASE_URL)
+    parser.add_argument('--skip-invalid', action='store_true', help='import the valid rows even if some rows are invalid')
+    args = parser.parse_args(argv)
+
+    import app as wdip  # not at the top, the app imports this module
+    queries.DATABASE_URL = args.database
+    imported, errors = import_annotations(read(args.file.read()), args.username, wdip.existing_items, wdip.item_image_sizes,
+                                          skip_invalid=args.skip_invalid)
+    for number, error in errors:
+        print(f'row {number}: {error}', file=sys.stderr)
+    print(f'imported {imported} statements')
+    return 1 if errors and not args.skip_invalid else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
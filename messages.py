@@ -1,7 +1,11 @@
 import cachetools
-import mwapi
 import threading
 
+import upstream
+
+
+# base URL of Wikidata, can be pointed at a local stand-in (see benchmarks/)
+host = 'https://www.wikidata.org'
 
 _messages_cache = cachetools.TTLCache(maxsize=1024, ttl=24 * 60 * 60)
 _messages_cache_lock = threading.RLock()
@@ -10,7 +14,7 @@ _messages_cache_lock = threading.RLock()
 @cachetools.cached(cache=_messages_cache,
                    lock=_messages_cache_lock)
 def _load_messages(language):
-    session = mwapi.Session('https://www.wikidata.org')
+    session = upstream.Session(host)
     response = session.get(action='query',
                            meta='allmessages',
                            ammessages=['wikibase-snakview-variations-somevalue-label',
@@ -0,0 +1,184 @@
+# instrumentation of outbound API calls and sqlite statements
+import collections
+import contextlib
+import flask
+import threading
+import time
+
+
+# histogram bucket upper bounds, in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram:
+    """A cumulative latency histogram with error counts, in the Prometheus style"""
+
+    __slots__ = ('buckets', 'count', 'sum', 'errors')
+
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.errors = collections.Counter()
+
+    def observe(self, duration, error=None):
+        for index, bound in enumerate(BUCKETS):
+            if duration <= bound:
+                self.buckets[index] += 1
+        self.count += 1
+        self.sum += duration
+        if error:
+            self.errors[error] += 1
+
+
+# process-wide histograms, keyed by (kind, target, name):
+# kind is 'api', 'sparql', 'sql' or 'request',
+# target is the host (or 'sqlite', or the Flask endpoint for requests),
+# name is the API action, the statement name, or the HTTP method
+_histograms = {}
+_histograms_lock = threading.Lock()
+
+# process-wide counters, keyed by (metric name, sorted label items)
+_counters = collections.Counter()
+
+
+def observe(kind, target, name, duration, error=None):
+    """Records one timed operation, both process-wide and for the current request"""
+    key = (kind, target, name)
+    with _histograms_lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = Histogram()
+        histogram.observe(duration, error)
+
+    if kind != 'request' and flask.has_request_context():
+        timings = flask.g.setdefault('metrics_timings', [])
+        timings.append((kind, target, name, duration, error))
+
+
+def increment(metric, amount=1, **labels):
+    """Increments a process-wide counter, e.g. increment('cache_lookups_total', cache='entities', outcome='stale')"""
+    with _histograms_lock:
+        _counters[(metric, tuple(sorted(labels.items())))] += amount
+
+
+@contextlib.contextmanager
+def timed(kind, target, name):
+    """Times the body of the with statement, recording the exception type if it raises"""
+    start = time.perf_counter()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        observe(kind, target, name, time.perf_counter() - start, error)
+
+
+def start_request():
+    flask.g.metrics_start = time.perf_counter()
+
+
+def finish_request(response):
+    """Records the duration of the current request and returns its Server-Timing header value"""
+    start = flask.g.pop('metrics_start', None)
+    if start is None:
+        return None
+    duration = time.perf_counter() - start
+    error = str(response.status_code) if response.status_code >= 500 else None
+    observe('request', flask.request.endpoint or 'unknown', flask.request.method, duration, error)
+    return server_timing(request_timings(), duration)
+
+
+def request_timings():
+    """Returns the (kind, target, name, duration, error) tuples recorded during the current request"""
+    return flask.g.get('metrics_timings', [])
+
+
+def aggregate(timings):
+    """Sums up request timings per operation, returning (kind, target, name, count, duration, errors) tuples"""
+    aggregated = {}
+    for kind, target, name, duration, error in timings:
+        entry = aggregated.setdefault((kind, target, name), [0, 0.0, 0])
+        entry[0] += 1
+        entry[1] += duration
+        if error:
+            entry[2] += 1
+    return [(kind, target, name, count, duration, errors) for (kind, target, name), (count, duration, errors) in aggregated.items()]
+
+
+def server_timing(timings, total):
+    """Formats request timings as a Server-Timing header value, aggregated per operation"""
+    metrics = []
+    for kind, target, name, count, duration, errors in aggregate(timings):
+        description = f'{target} {name} x{count}'
+        if errors:
+            description += f' ({errors} failed)'
+        metrics.append('%s;dur=%.1f;desc="%s"' % (_token(kind + '-' + name), duration * 1000, _quote(description)))
+    metrics.append('total;dur=%.1f' % (total * 1000))
+    return ', '.join(metrics)
+
+
+def prometheus_text():
+    """Renders all histograms in the Prometheus text exposition format"""
+    with _histograms_lock:
+        snapshot = [(key, list(histogram.buckets), histogram.count, histogram.sum, dict(histogram.errors))
+                    for key, histogram in sorted(_histograms.items())]
+
+    names = {
+        'api': ('outbound_api', 'Wikibase/MediaWiki Action API calls', 'host', 'action'),
+        'sparql': ('outbound_sparql', 'SPARQL queries', 'host', 'operation'),
+        'sql': ('sqlite_statement', 'sqlite statements', 'database', 'statement'),
+        'request': ('http_request', 'incoming requests', 'endpoint', 'method'),
+    }
+    lines = []
+    for kind, (metric, help_text, target_label, name_label) in names.items():
+        entries = [entry for entry in snapshot if entry[0][0] == kind]
+        if not entries:
+            continue
+        lines.append(f'# HELP {metric}_duration_seconds Latency of {help_text}.')
+        lines.append(f'# TYPE {metric}_duration_seconds histogram')
+        for (_, target, name), buckets, count, total, _ in entries:
+            labels = f'{target_label}="{_escape(target)}",{name_label}="{_escape(name)}"'
+            for bound, bucket in zip(BUCKETS, buckets):
+                lines.append(f'{metric}_duration_seconds_bucket{{{labels},le="{bound}"}} {bucket}')
+            lines.append(f'{metric}_duration_seconds_bucket{{{labels},le="+Inf"}} {count}')
+            lines.append(f'{metric}_duration_seconds_sum{{{labels}}} {total}')
+            lines.append(f'{metric}_duration_seconds_count{{{labels}}} {count}')
+        lines.append(f'# HELP {metric}_errors_total Failed {help_text}, by error.')
+        lines.append(f'# TYPE {metric}_errors_total counter')
+        for (_, target, name), _, _, _, errors in entries:
+            for error, count in sorted(errors.items()):
+                labels = f'{target_label}="{_escape(target)}",{name_label}="{_escape(name)}",error="{_escape(error)}"'
+                lines.append(f'{metric}_errors_total{{{labels}}} {count}')
+
+    with _histograms_lock:
+        counters = sorted(_counters.items())
+    previous_metric = None
+    for (metric, labels), count in counters:
+        if metric != previous_metric:
+            lines.append(f'# TYPE {metric} counter')
+            previous_metric = metric
+        labels = ','.join(f'{name}="{_escape(value)}"' for name, value in labels)
+        lines.append(f'{metric}{{{labels}}} {count}')
+    return '\n'.join(lines) + '\n'
+
+
+def reset():
+    """Forgets all recorded histograms (used by tests and benchmarks)"""
+    with _histograms_lock:
+        _histograms.clear()
+        _counters.clear()
+
+
+def _token(name):
+    return ''.join(c if c.isalnum() or c in '-_.' else '_' for c in name)
+
+
+def _quote(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -0,0 +1,107 @@
+# persistent outbox of approval emails, sent in per-user digests by a background worker
+import collections
+import mwapi
+import secrets
+import threading
+import time
+
+import metrics
+import queries
+
+
+# emailuser errors that will not go away by trying again
+PERMANENT_ERRORS = {'noemail', 'nowikiemail', 'usermaildisabled', 'nosuchuser', 'notarget', 'blockedfrommail', 'mailnologin'}
+CLAIM_TIMEOUT = 300  # seconds after which emails claimed by a worker that never reported back are sent by another one
+
+
+class NoSender(Exception):
+    """No credentials to send a digest with in this process, e.g. it was queued by another worker process"""
+
+
+class Outbox:
+    """Queues approval emails in the email_outbox table and sends them from a background thread.
+
+    enqueue() only inserts a row, so approving does not wait for the MediaWiki emailuser API.
+    The first email queued for a user is due after window seconds; the worker then sends all
+    pending emails of that user, including later ones, as one digest with send(username, emails).
+    If sending fails, the digest is retried with exponential backoff up to max_attempts times,
+    unless the error is permanent (e.g. the user has no email address).
+    Rows are claimed in a transaction, so several worker processes can share the table.
+    The project leads' OAuth access tokens are never stored in the table, only in the memory of the process,
+    see access_token(); a process that has none for a digest raises NoSender, and it is retried (maybe by another process).
+    """
+
+    def __init__(self, send, window, interval=10, max_attempts=5, backoff=60):
+        self.send = send
+        self.window = window
+        self.interval = interval
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self._thread = None
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._access_tokens = {}  # project lead -> their latest OAuth access token
+
+    def enqueue(self, username, item_id, item_url, uploaded, project_lead, access_token=None, connection=None):
+        now = time.time()
+        if access_token is not None:
+            with self._lock:
+                self._access_tokens[project_lead] = access_token
+        queries.query_db(queries.add_outbox_email(), params=[username, item_id, item_url, uploaded, project_lead, now, now + self.window],
+                         connection=connection)
+        metrics.increment('emails_total', outcome='queued')
+        if self.window <= 0:
+            self._wake.set()
+
+    def access_token(self, project_lead):
+        """Returns the access token a project lead queued emails with in this process, or None"""
+        with self._lock:
+            return self._access_tokens.get(project_lead)
+
+    def start(self):
+        """Starts the worker thread, unless it is already running"""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='email-outbox', daemon=True)
+                self._thread.start()
+
+    def send_due(self, now=None):
+        """Sends the digests that are due, returning how many were sent"""
+        now = time.time() if now is None else now
+        claim = secrets.token_hex(8)
+        with queries.transaction() as connection:
+            queries.query_db(queries.claim_outbox_emails(), params=[claim, now + CLAIM_TIMEOUT, now, now], connection=connection)
+            emails = queries.jsonify_rows(queries.query_db(queries.get_claimed_outbox_emails(), params=[claim], connection=connection))
+        emails_by_user = collections.defaultdict(list)
+        for email in emails:
+            emails_by_user[email['username']].append(email)
+
+        sent = 0
+        for username, user_emails in emails_by_user.items():
+            try:
+                self.send(username, user_emails)
+            except Exception as error:
+                attempts = max(email['attempts'] for email in user_emails) + 1
+                permanent = isinstance(error, mwapi.errors.APIError) and error.code in PERMANENT_ERRORS
+                if permanent or attempts >= self.max_attempts:
+                    queries.query_db(queries.set_outbox_emails_failed(), params=[str(error), claim, username])
+                    metrics.increment('emails_total', len(user_emails), outcome='failed')
+                else:
+                    retry_at = time.time() + self.backoff * 2 ** (attempts - 1)
+                    queries.query_db(queries.retry_outbox_emails(), params=[str(error), retry_at, claim, username])
+                    metrics.increment('emails_total', len(user_emails), outcome='retried')
+                continue
+            queries.query_db(queries.set_outbox_emails_sent(), params=[claim, username])
+            metrics.increment('emails_total', len(user_emails), outcome='sent')
+            metrics.increment('email_digests_total')
+            sent += 1
+        return sent
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.send_due()
+            except Exception:
+                pass  # e.g. the database is locked; the emails are still there next time
@@ -0,0 +1,122 @@
+# on-demand sampling profiler for single requests
+import collections
+import json
+import os
+import re
+import secrets
+import sys
+import threading
+import time
+
+
+class SamplingProfiler:
+    """Samples the stack of one thread at a fixed interval.
+
+    The samples are kept as folded stacks (root frame first, frames separated by semicolons),
+    the input format of flamegraph.pl, speedscope and similar flame graph viewers.
+    Nothing is traced between samples, so the profiled code runs at (almost) full speed.
+    """
+
+    def __init__(self, thread_id=None, interval=0.001):
+        self.thread_id = thread_id if thread_id is not None else threading.get_ident()
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.duration = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+        self._start = None
+
+    def start(self):
+        self._start = time.perf_counter()
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self.duration is None:
+            self._stop.set()
+            self._thread.join()
+            self.duration = time.perf_counter() - self._start
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame))
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def folded(self):
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+    def functions(self, limit=30):
+        """Returns the functions with the most samples, as (name, self samples, total samples) tuples"""
+        self_samples = collections.Counter()
+        total_samples = collections.Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(';')
+            self_samples[frames[-1]] += count
+            for frame in set(frames):
+                total_samples[frame] += count
+        return [(frame, self_samples[frame], total) for frame, total in total_samples.most_common(limit)]
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    filename = code.co_filename
+    for path in sys.path:
+        if path and filename.startswith(path + os.sep):
+            filename = filename[len(path) + 1:]
+            break
+    return f'{code.co_name} ({filename}:{code.co_firstlineno})'.replace(';', ',')
+
+
+_name_pattern = re.compile(r'[0-9]{8}-[0-9]{6}-[A-Za-z0-9_.]+-[0-9a-f]{6}')
+
+
+def save(directory, profiler, request_info, io_summary):
+    """Writes a finished profile (folded stacks plus a JSON summary) into the directory, returning its name"""
+    os.makedirs(directory, exist_ok=True)
+    endpoint = re.sub(r'[^A-Za-z0-9_.]', '_', request_info.get('endpoint') or 'unknown')
+    name = f'{time.strftime("%Y%m%d-%H%M%S")}-{endpoint}-{secrets.token_hex(3)}'
+    with open(os.path.join(directory, name + '.folded'), 'w') as f:
+        f.write(profiler.folded())
+    summary = {
+        **request_info,
+        'name': name,
+        'duration_ms': profiler.duration * 1000,
+        'interval_ms': profiler.interval * 1000,
+        'samples': sum(profiler.stacks.values()),
+        'functions': profiler.functions(),
+        'io': io_summary,
+    }
+    with open(os.path.join(directory, name + '.json'), 'w') as f:
+        json.dump(summary, f, indent=1)
+    return name
+
+
+def list_profiles(directory):
+    """Returns the summaries of all saved profiles, newest first"""
+    try:
+        filenames = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    profiles = []
+    for filename in sorted(filenames, reverse=True):
+        if filename.endswith('.json') and _name_pattern.fullmatch(filename[:-len('.json')]):
+            with open(os.path.join(directory, filename)) as f:
+                profiles.append(json.load(f))
+    return profiles
+
+
+def load_profile(directory, name, suffix='.json'):
+    """Returns the contents of a saved profile file, or None if there is no such profile"""
+    if not _name_pattern.fullmatch(name):
+        return None
+    try:
+        with open(os.path.join(directory, name + suffix)) as f:
+            return json.load(f) if suffix == '.json' else f.read()
+    except FileNotFoundError:
+        return None
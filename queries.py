@@ -1,25 +1,68 @@
 # holds all queries and functions that help with queries for the sqlite table
+import inspect
+import re
 import sqlite3
-from contextlib import closing
+from contextlib import closing, contextmanager
 from consts import *
 
+import metrics
+
 # utility functions
 def jsonify_rows(rows):
     """jsonifies output from sqlite table"""
     return [] if not rows else [dict(result) for result in rows]
 
-def query_db(query, params=None, database_url=DATABASE_URL):
-    """Queries the sqlite database with specified query and parameters"""
-    results = []
-    with sqlite3.connect(database_url, isolation_level=None, uri=True) as connection:
-        with closing(connection.cursor()) as cursor:
-            cursor.row_factory = sqlite3.Row
+def query_db(query, params=None, database_url=None, connection=None):
+    """Queries the sqlite database with specified query and parameters (on the given connection, if any)"""
+    if connection is None:
+        with sqlite3.connect(database_url or DATABASE_URL, isolation_level=None, uri=True) as connection:
+            return query_db(query, params, connection=connection)
+    with closing(connection.cursor()) as cursor:
+        cursor.row_factory = sqlite3.Row
+        with metrics.timed('sql', 'sqlite', statement_name(query)):
             if params:
                 cursor.execute(query, params)
             else:
                 cursor.execute(query)
-            results = cursor.fetchall()
-    return results
+            return cursor.fetchall()
+
+def query_db_many(query, params_list, database_url=None, connection=None):
+    """Runs a statement once for each of the parameter lists, with executemany (on the given connection, if any)"""
+    if connection is None:
+        with sqlite3.connect(database_url or DATABASE_URL, isolation_level=None, uri=True) as connection:
+            return query_db_many(query, params_list, connection=connection)
+    with closing(connection.cursor()) as cursor:
+        with metrics.timed('sql', 'sqlite', statement_name(query)):
+            cursor.executemany(query, params_list)
+            return cursor.rowcount
+
+@contextmanager
+def transaction(database_url=None):
+    """Yields a connection for query_db whose statements are committed together, or rolled back if an exception is raised"""
+    with closing(sqlite3.connect(database_url or DATABASE_URL, isolation_level=None, uri=True)) as connection:
+        # take the write lock up front, so the transaction cannot fail halfway on a lock upgrade
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+_statement_names = None
+
+def statement_name(query):
+    """Returns the name of the function below that produced a query, used to label its metrics"""
+    global _statement_names
+    if _statement_names is None:
+        _statement_names = {function(): name
+                            for name, function in list(globals().items())
+                            if inspect.isfunction(function) and function.__module__ == __name__ and not inspect.signature(function).parameters}
+    name = _statement_names.get(query)
+    if name is None:
+        # not one of the fixed statements, fall back to the statement text with placeholder lists collapsed
+        name = re.sub(r'\(\?(?:, *\?)*\)', '(?, ...)', ' '.join(query.split()))
+    return name
 
 # sqlite queries
 def is_project_lead():
@@ -62,6 +105,15 @@ def add_statement_with_reference_and_page():
     """Adds a atstaement into the statements table that includes references and page number"""
     return "INSERT INTO statements (item_id, property_id, value_id, snaktype, username, reference_type, reference_value, pages_value) VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
 
+def add_imported_statement():
+    """Adds a statement with a given statement ID and creation timestamp, for bulk imports"""
+    return ("INSERT INTO statements (statement_id, item_id, property_id, value_id, snaktype, username, reference_type, reference_value, pages_value, created) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)")
+
+def get_max_statement_id():
+    """Returns the highest statement ID (0 if there are no statements)"""
+    return "SELECT COALESCE(MAX(statement_id), 0) AS statement_id FROM statements"
+
 def delete_statement():
     """Deletes a statement by statement id from the statements table"""
     return "DELETE FROM statements WHERE statement_id=?"
@@ -74,6 +126,15 @@ def get_latest_statement():
     """Gets the last row in the statements table (usually the one you just inserted)"""
     return "SELECT statement_id FROM statements ORDER BY rowid DESC LIMIT 1"
 
+def get_last_inserted_statement():
+    """Gets the id of the statement just inserted on the same connection"""
+    return "SELECT last_insert_rowid() AS statement_id"
+
+def get_statements_by_id():
+    """Returns the local statements whose IDs are in a JSON array"""
+    return """SELECT statement_id, item_id, value_id, snaktype, username FROM statements
+              WHERE statement_id IN (SELECT value FROM json_each(?))"""
+
 def get_object_statements():
     """Selects all locally saved statements for an object based on what user is logged in"""
     return "SELECT * FROM statements WHERE item_id=? and username=?"
@@ -85,6 +146,36 @@ def add_qualifier():
               SET iiif_region = EXCLUDED.iiif_region,
                   qualifier_hash = EXCLUDED.qualifier_hash;'''
 
+def get_items_with_region():
+    """Returns the statement_id and item_id of all local statements with a certain qualifier region (uses the iiif_region index)"""
+    return """SELECT statements.statement_id, statements.item_id FROM qualifiers
+              JOIN statements ON statements.statement_id = qualifiers.statement_id
+              WHERE qualifiers.iiif_region = ?
+              ORDER BY statements.item_id"""
+
+def get_regions_in_box():
+    """Returns the local statements with regions overlapping a box (min/max item number, min/max x, min/max y; pct times 100), using the region_index R-tree"""
+    return """SELECT statements.statement_id, statements.item_id, statements.value_id, statements.snaktype, statements.username,
+                     qualifiers.iiif_region, region_index.min_x, region_index.max_x, region_index.min_y, region_index.max_y
+              FROM region_index
+              JOIN statements ON statements.statement_id = region_index.id
+              JOIN qualifiers ON qualifiers.statement_id = CAST(region_index.id AS TEXT)
+              WHERE region_index.min_item >= ? AND region_index.max_item <= ?
+                AND region_index.max_x >= ? AND region_index.min_x <= ?
+                AND region_index.max_y >= ? AND region_index.min_y <= ?"""
+
+def get_overlapping_region_pairs():
+    """Returns all pairs of overlapping local regions on the same item within a range of item numbers, using the region_index R-tree"""
+    return """SELECT a.id AS statement_id, b.id AS other_statement_id,
+                     a.min_x, a.max_x, a.min_y, a.max_y,
+                     b.min_x AS other_min_x, b.max_x AS other_max_x, b.min_y AS other_min_y, b.max_y AS other_max_y
+              FROM region_index AS a, region_index AS b
+              WHERE a.min_item >= ? AND a.max_item <= ?
+                AND b.min_item = a.min_item AND b.max_item = a.max_item
+                AND b.max_x >= a.min_x AND b.min_x <= a.max_x
+                AND b.max_y >= a.min_y AND b.min_y <= a.max_y
+                AND b.id > a.id"""
+
 def delete_qualifier():
     """Deletes a qualifier based on statement_id"""
     return "DELETE FROM qualifiers WHERE statement_id=?"
@@ -93,6 +184,50 @@ def get_qualifier_for_statement():
     """Queries the qualifier assocatied with a statement based on statement id"""
     return "SELECT * from qualifiers WHERE statement_id=?"
 
+def get_local_depicted_uses():
+    """Returns how often each item is the value of local statements with one of the properties in a JSON array"""
+    return """SELECT value_id, COUNT(*) AS uses FROM statements
+              WHERE snaktype = 'value' AND property_id IN (SELECT value FROM json_each(?))
+              GROUP BY value_id"""
+
+def get_annotation_version():
+    """Returns the version of the local statements and regions of a user on an item (no row if there never were any)"""
+    return "SELECT version FROM annotation_versions WHERE item_id=? AND username=?"
+
+def get_annotation_changes():
+    """Returns the statements (statement_id), comments (comment_id) and approvals ('') of a user on an item changed after a version"""
+    return "SELECT DISTINCT kind, key FROM annotation_changes WHERE item_id=? AND username=? AND version>?"
+
+def has_annotation_change():
+    """Returns a row if the change of a user on an item with a certain version is still logged (older ones are pruned)"""
+    return "SELECT 1 FROM annotation_changes WHERE item_id=? AND username=? AND version=?"
+
+def prune_annotation_changes():
+    """Deletes the logged changes more than a number of versions behind the current version of their item_id and username pair"""
+    return """DELETE FROM annotation_changes WHERE change_id IN (
+                  SELECT annotation_changes.change_id FROM annotation_changes
+                  JOIN annotation_versions ON annotation_versions.item_id = annotation_changes.item_id
+                                          AND annotation_versions.username = annotation_changes.username
+                  WHERE annotation_changes.version <= annotation_versions.version - ?)"""
+
+def get_local_statements_with_regions():
+    """Returns the local statements of a user on an item with their regions, all of them or those whose IDs are in a JSON array"""
+    return """SELECT statements.statement_id, statements.property_id, statements.value_id, statements.snaktype,
+                     statements.reference_type, statements.reference_value, statements.pages_value,
+                     qualifiers.iiif_region, qualifiers.qualifier_hash
+              FROM statements
+              LEFT JOIN qualifiers ON qualifiers.statement_id = CAST(statements.statement_id AS TEXT)
+              WHERE statements.item_id = :item_id AND statements.username = :username
+                AND (:statement_ids IS NULL OR statements.statement_id IN (SELECT value FROM json_each(:statement_ids)))
+              ORDER BY statements.statement_id"""
+
+def get_comments_by_id():
+    """Returns the comments on the local statements of a user on an item, all of them or those whose IDs are in a JSON array"""
+    return """SELECT comment_id, statement_id, comment, project_lead_username FROM comments
+              WHERE item_id = :item_id AND username = :username
+                AND (:comment_ids IS NULL OR comment_id IN (SELECT value FROM json_each(:comment_ids)))
+              ORDER BY comment_id"""
+
 def get_all_annotated_objects():
     """Returns all of the item_id, username pair tuple for locally annotated objects"""
     return "SELECT statement_id, item_id, username from statements"
@@ -101,6 +236,16 @@ def get_all_annotated_objects_by_user():
     """Returns all item_ids for locally annotated objects by user"""
     return "SELECT DISTINCT item_id FROM statements WHERE username=?"
 
+def get_review_queue():
+    """Returns the item_id, username pairs with local statements that are not approved yet, with their number of statements
+    and the time of the oldest one, oldest first or (with :order 'statements') most statements first"""
+    return """SELECT statements.item_id, statements.username, COUNT(*) AS statements, MIN(statements.created) AS created
+              FROM statements
+              WHERE NOT EXISTS (SELECT 1 FROM approvals
+                                WHERE approvals.item_id = statements.item_id AND approvals.username = statements.username AND approvals.approved)
+              GROUP BY statements.item_id, statements.username
+              ORDER BY CASE WHEN :order = 'statements' THEN -COUNT(*) ELSE 0 END, MIN(statements.created), MIN(statements.statement_id)"""
+
 def get_comments():
     """Returns comment associated with an item_id, username tuple"""
     return "SELECT statement_id, comment, project_lead_username FROM comments WHERE item_id=? and username=?"
@@ -135,4 +280,98 @@ def get_number_of_objects_annotated():
 
 def get_number_of_objects_annotated_by_user():
     """"Returns the number of total objects that have been annotated by a certain user"""
-    return "SELECT COUNT(DISTINCT item_id) FROM statements WHERE username=?"
\ No newline at end of file
+    return "SELECT COUNT(DISTINCT item_id) FROM statements WHERE username=?"
+
+def add_bulk_upload():
+    """Queues an item_id, username pair of a bulk upload, claimed by the process running it until the given time"""
+    return "INSERT INTO bulk_uploads (batch_id, item_id, username, project_lead_username, status, claimed_until) VALUES (?, ?, ?, ?, 'queued', ?)"
+
+def renew_bulk_upload_claim():
+    """Extends the claim on the unfinished pairs of a bulk upload"""
+    return "UPDATE bulk_uploads SET claimed_until=? WHERE batch_id=? AND status IN ('queued', 'uploading')"
+
+def fail_interrupted_bulk_uploads():
+    """Marks the unfinished pairs of bulk uploads whose claim has run out (e.g. the process was restarted) as failed"""
+    return """UPDATE bulk_uploads SET status='failed', message=?, claimed_until=NULL
+              WHERE status IN ('queued', 'uploading') AND (claimed_until IS NULL OR claimed_until < ?)"""
+
+def get_failed_bulk_uploads():
+    """Returns the failed item_id, username pairs of a bulk upload"""
+    return "SELECT item_id, username FROM bulk_uploads WHERE batch_id=? AND status='failed' ORDER BY bulk_upload_id"
+
+def requeue_failed_bulk_uploads():
+    """Queues the failed pairs of a bulk upload again, claimed until the given time"""
+    return "UPDATE bulk_uploads SET status='queued', message=NULL, claimed_until=? WHERE batch_id=? AND status='failed'"
+
+def set_bulk_upload_status():
+    """Updates the status and message of an item_id, username pair of a bulk upload"""
+    return "UPDATE bulk_uploads SET status=?, message=? WHERE batch_id=? and item_id=? and username=?"
+
+def get_bulk_uploads():
+    """Returns the item_id, username pairs of a bulk upload with their status"""
+    return "SELECT item_id, username, project_lead_username, status, message FROM bulk_uploads WHERE batch_id=? ORDER BY bulk_upload_id"
+
+def add_outbox_email():
+    """Queues an approval email for a username, sent on behalf of the project lead"""
+    return ("INSERT INTO email_outbox (username, item_id, item_url, uploaded, project_lead_username, status, attempts, created, send_after) "
+            "VALUES (?, ?, ?, ?, ?, 'pending', 0, ?, ?)")
+
+def claim_outbox_emails():
+    """Claims all pending emails of the usernames whose oldest pending email is due, unless another worker holds them"""
+    return """UPDATE email_outbox SET claimed_by=?, claimed_until=?
+              WHERE status='pending' AND (claimed_until IS NULL OR claimed_until < ?)
+              AND username IN (SELECT username FROM email_outbox WHERE status='pending' GROUP BY username HAVING MIN(send_after) <= ?)"""
+
+def get_claimed_outbox_emails():
+    """Returns the emails claimed by a worker, oldest first per username"""
+    return "SELECT * FROM email_outbox WHERE claimed_by=? ORDER BY username, email_id"
+
+def set_outbox_emails_sent():
+    """Marks the claimed emails of a username as sent"""
+    return """UPDATE email_outbox SET status='sent', attempts=attempts+1, claimed_by=NULL, claimed_until=NULL
+              WHERE claimed_by=? AND username=?"""
+
+def set_outbox_emails_failed():
+    """Marks the claimed emails of a username as failed for good"""
+    return """UPDATE email_outbox SET status='failed', attempts=attempts+1, last_error=?, claimed_by=NULL, claimed_until=NULL
+              WHERE claimed_by=? AND username=?"""
+
+def retry_outbox_emails():
+    """Releases the claimed emails of a username to be retried after the given time"""
+    return """UPDATE email_outbox SET attempts=attempts+1, last_error=?, send_after=?, claimed_by=NULL, claimed_until=NULL
+              WHERE claimed_by=? AND username=?"""
+
+def get_outbox_emails():
+    """Returns the emails to a username with their status"""
+    return "SELECT item_id, project_lead_username, status, attempts, last_error FROM email_outbox WHERE username=? ORDER BY email_id"
+
+def get_export_statements():
+    """Returns the next chunk of local statements after a statement ID, with their region, approval and comments,
+    filtered by username, item_id, approval state and creation date (a NULL filter matches everything)"""
+    return """SELECT statements.statement_id, statements.item_id, statements.property_id, statements.value_id, statements.snaktype,
+                     statements.username, statements.reference_type, statements.reference_value, statements.pages_value, statements.created,
+                     qualifiers.iiif_region,
+                     EXISTS (SELECT 1 FROM approvals WHERE approvals.username = statements.username AND approvals.item_id = statements.item_id
+                             AND approvals.approved) AS approved,
+                     (SELECT json_group_array(json_object('comment', comments.comment, 'project_lead_username', comments.project_lead_username))
+                      FROM comments WHERE comments.statement_id = CAST(statements.statement_id AS TEXT)) AS comments
+              FROM statements LEFT JOIN qualifiers ON qualifiers.statement_id = CAST(statements.statement_id AS TEXT)
+              WHERE statements.statement_id > :after
+                AND (:username IS NULL OR statements.username = :username)
+                AND (:item_id IS NULL OR statements.item_id = :item_id)
+                AND (:since IS NULL OR statements.created >= :since)
+                AND (:until IS NULL OR statements.created < :until)
+                AND (:approved IS NULL OR :approved = EXISTS (SELECT 1 FROM approvals WHERE approvals.username = statements.username
+                                                                AND approvals.item_id = statements.item_id AND approvals.approved))
+              ORDER BY statements.statement_id
+              LIMIT :limit"""
+
+def put_stored_entity():
+    """Adds or replaces the stored data of an entity, unless the stored data is from a newer revision"""
+    return """INSERT INTO entity_store (entity_id, props, data, lastrevid) VALUES (?, ?, ?, ?)
+              ON CONFLICT (entity_id) DO UPDATE SET props=excluded.props, data=excluded.data, lastrevid=excluded.lastrevid
+              WHERE excluded.lastrevid >= entity_store.lastrevid"""
+
+def get_stored_entities():
+    """Returns the stored data of the entities whose IDs are in a JSON array"""
+    return "SELECT entity_id, props, data FROM entity_store WHERE entity_id IN (SELECT value FROM json_each(?))"
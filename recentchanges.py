@@ -0,0 +1,116 @@
+# following the recent changes of Wikidata and Commons, so that cached data is dropped when the page it came from is edited
+import logging
+import threading
+import time
+
+import metrics
+
+
+START_MARGIN = 60  # seconds before the start to read changes from, for clock differences (older revisions are skipped by revision ID)
+MAX_FAILURES = 3  # polls in a row that may fail before edits count as unnoticed
+
+logger = logging.getLogger(__name__)
+
+
+class RecentChanges:
+    """Polls list=recentchanges of some wikis from a background thread and reports edits of tracked pages.
+
+    track(domain, title, revid) registers a page with the revision the cached data is from;
+    when a newer revision of it shows up in the recent changes, on_change(domain, change) is called
+    with the recent change (title, pageid, revid, timestamp), and the page is tracked at that revision.
+    session(domain) returns an API session; namespaces maps each domain to the namespaces to follow.
+    Failed polls are logged and counted; after MAX_FAILURES of them in a row, on_health(False) is called,
+    since edits are not noticed anymore, and on_health(True) once a poll succeeds again.
+    """
+
+    def __init__(self, session, on_change, namespaces, interval=10, on_health=None):
+        self.session = session
+        self.on_change = on_change
+        self.namespaces = namespaces
+        self.interval = interval
+        self.on_health = on_health
+        self.failures = 0  # polls in a row that failed
+        self._revisions = {}  # (domain, title) -> revision ID of the cached data
+        self._positions = {}  # domain -> (timestamp to continue from, last rcid seen)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def track(self, domain, title, revid):
+        with self._lock:
+            key = (domain, title)
+            self._revisions[key] = max(revid, self._revisions.get(key, 0))
+
+    def start(self):
+        """Starts the polling thread, unless it is already running; returns whether it was started"""
+        with self._lock:
+            if self._thread is not None:
+                return False
+            for domain in self.namespaces:
+                self._positions.setdefault(domain, (start_timestamp(), 0))
+            self._thread = threading.Thread(target=self._run, name='recent-changes', daemon=True)
+            self._thread.start()
+            return True
+
+    def poll(self):
+        """Reads the recent changes of all wikis since the last poll, returning the number of tracked pages that changed"""
+        changed = 0
+        for domain in self.namespaces:
+            changed += self.poll_domain(domain)
+        return changed
+
+    def poll_domain(self, domain):
+        timestamp, last_rcid = self._positions.setdefault(domain, (start_timestamp(), 0))
+        params = {
+            'action': 'query',
+            'list': 'recentchanges',
+            'rcprop': 'title|ids|timestamp',
+            'rctype': 'edit|new',
+            'rcnamespace': self.namespaces[domain],
+            'rcdir': 'newer',
+            'rcstart': timestamp,
+            'rclimit': 'max',
+        }
+        changed = 0
+        for response in self.session(domain).get(continuation=True, **params):
+            for change in response['query']['recentchanges']:
+                if change['rcid'] <= last_rcid:
+                    continue  # rcstart is inclusive, these were read by the last poll
+                timestamp, last_rcid = change['timestamp'], change['rcid']
+                key = (domain, change['title'])
+                with self._lock:
+                    revid = self._revisions.get(key)
+                    if revid is None or change['revid'] <= revid:
+                        continue
+                    self._revisions[key] = change['revid']
+                self.on_change(domain, change)
+                changed += 1
+            self._positions[domain] = (timestamp, last_rcid)
+        if changed:
+            metrics.increment('recent_changes_total', changed, domain=domain)
+        return changed
+
+    def run_once(self):
+        """Polls once, as the thread does: failures (e.g. the API is unavailable) are reported, not raised,
+        and the next poll continues from the same position; returns the number of changed pages, or None"""
+        try:
+            changed = self.poll()
+        except Exception as error:
+            self.failures += 1
+            metrics.increment('recent_changes_errors_total')
+            logger.warning('Reading the recent changes failed (%d in a row): %r', self.failures, error)
+            if self.failures == MAX_FAILURES and self.on_health is not None:
+                self.on_health(False)
+            return None
+        if self.failures >= MAX_FAILURES and self.on_health is not None:
+            self.on_health(True)
+        self.failures = 0
+        return changed
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.run_once()
+
+
+def start_timestamp():
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(time.time() - START_MARGIN))
@@ -0,0 +1,25 @@
+# parsing of pct:x,y,w,h IIIF regions, shared by the app, the importer and the write-behind buffer
+import math
+
+
+# the browser rounds the percentages of a region a bit, and so does the importer (to hundredths),
+# so a region along the right or bottom edge of the image may end slightly past 100%
+EDGE_TOLERANCE = 0.02
+
+
+def parse_pct_region(iiif_region):
+    """Parses a pct:x,y,w,h IIIF region into a tuple of floats, or returns None.
+
+    The region must have a width and height and lie within the image."""
+    if not isinstance(iiif_region, str) or not iiif_region.startswith('pct:'):
+        return None
+    try:
+        region = tuple(float(part) for part in iiif_region[len('pct:'):].split(','))
+    except ValueError:
+        return None
+    if len(region) != 4 or not all(math.isfinite(part) and part >= 0 for part in region):
+        return None
+    x, y, w, h = region
+    if w <= 0 or h <= 0 or x + w > 100 + EDGE_TOLERANCE or y + h > 100 + EDGE_TOLERANCE:
+        return None
+    return region
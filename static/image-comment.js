@@ -250,11 +250,13 @@ function setup() {
                 credentials: 'include',
             }).then(response => {
                 if (response.ok) {
-                    alert("Notified user!")
+                    alert("Approved! The user will be notified by email shortly.")
                     document.querySelector('#approve-button').remove();
                     return;
                 } else {
-                   alert("This user's annotations have been approved but the email notification has failed to send. This is most likely because the user does not have an email associated with their Wikimedia account")
+                   return response.text().then(error => {
+                       alert(`An error occurred:\n\n${error}`);
+                   });
                 }
             });
 
@@ -8,7 +8,9 @@ function setup() {
     'use strict';
     const csrfTokenElement = document.getElementById('csrf_token'),
           baseUrl = document.querySelector('link[rel=index]').href.replace(/\/$/, ''),
-          depictedProperties = JSON.parse(document.getElementsByTagName('main')[0].dataset.depictedProperties);
+          depictedProperties = JSON.parse(document.getElementsByTagName('main')[0].dataset.depictedProperties),
+          searchDelay = 150, // milliseconds without typing before the item search is sent
+          commentsInterval = 30000; // milliseconds between checks for new comments
 
     /** Make a key event handler that calls the given callback when Esc is pressed. */
     function onEscape(callback) {
@@ -19,6 +21,39 @@ function setup() {
         };
     }
 
+    /**
+     * Apply operations on the user's local statements in one request and transaction.
+     * Regions of statements on Wikidata are not local statements, and are saved separately.
+     *
+     * @param {string} domain The domain of the subject entity
+     * @param {string} entityId The subject entity
+     * @param {Object[]} operations The operations (see /api/v2/batch_local)
+     * @return {Promise<Object[]>} The results, one per operation;
+     * rejected with the error message if nothing was applied
+     */
+    function batchLocal(domain, entityId, operations) {
+        const formData = new FormData();
+        formData.append('entity_id', entityId);
+        formData.append('operations', JSON.stringify(operations));
+        formData.append('_csrf_token', csrfTokenElement.textContent);
+        return fetch(`${baseUrl}/api/v2/batch_local/${domain}`, {
+            method: 'POST',
+            body: formData,
+            credentials: 'include',
+        }).then(response => {
+            if (response.ok) {
+                return response.json().then(json => json.results);
+            }
+            return response.text().then(text => {
+                throw new Error(text);
+            });
+        });
+    }
+
+    function isLocalStatement(statementId) {
+        return !String(statementId).includes('Q');
+    }
+
     function addEditButtons() {
         document.querySelectorAll('.wd-image-positions--depicted-without-region').forEach(addEditButton);
         document.querySelectorAll('.wd-image-positions--depicted-without-region').forEach(addRemoveButton);
@@ -149,40 +184,40 @@ function setup() {
 
         function onClick() {
             const statementId = element.dataset.statementId,
-                  formData = new FormData();
-            formData.append('statement_id', statementId);
+                  entity = element.closest('.wd-image-positions--entity');
             element.remove()
-            fetch(`${baseUrl}/api/v1/delete_statement_local`, {
-                method: 'POST',
-                body: formData,
-                credentials: 'include',
-            }).then(response => {
-                if (response.ok) {
-                   
-                } else {
-                    window.alert(`An error occurred: deleting statement with id ${statementId} failed. This could be because it is not a local statement.`);
-                    throw new Error('Deleting failed');
-                }
+            batchLocal(entity.dataset.entityDomain, entity.dataset.entityId, [
+                { op: 'delete_statement', statement: Number(statementId) },
+            ]).catch(() => {
+                window.alert(`An error occurred: deleting statement with id ${statementId} failed. This could be because it is not a local statement.`);
             });
         }
     }
 
+    let annotationsVersion = 0;
+    const shownCommentIds = new Set();
+
     function addCommentLabelsOwnUser() {
         // get base level information
-        const formData = new FormData();
         const entityDiv = document.querySelector(".wd-image-positions--entity");
         const itemId = entityDiv.getAttribute('data-entity-id');
-        formData.append('item_id', itemId);
-    
-        // fetch comments
-        return fetch(`${baseUrl}/api/v2/get_comments_own_user`, {
-            method: 'POST',
-            body: formData,
+
+        // fetch the comments added since the last time (all of them the first time)
+        return fetch(`${baseUrl}/api/v2/annotations/${itemId}/delta?since=${annotationsVersion}`, {
             credentials: 'include',
         }).then(response => {
+            if (response.status === 304) {
+                return; // nothing changed
+            }
             if (response.ok) {
-                return response.json().then(json => {
-                    json.forEach(item => addCommentLabel(item.statement_id, item.project_lead_username, item.comment))
+                return response.json().then(delta => {
+                    annotationsVersion = delta.version;
+                    delta.comments
+                        .filter(item => !shownCommentIds.has(item.comment_id))
+                        .forEach(item => {
+                            shownCommentIds.add(item.comment_id);
+                            addCommentLabel(item.statement_id, item.project_lead_username, item.comment);
+                        });
                 });
             } else {
                 return response.text().then(error => {
@@ -190,7 +225,7 @@ function setup() {
                 });
             }
         });
-   
+
    }
 
     /**
@@ -250,15 +285,24 @@ function setup() {
         const iiifRegion = `pct:${pct('left')},${pct('top')},${pct('width')},${pct('height')}`;
 
         const statementId = depicted.dataset.statementId,
-              qualifierHash = depicted.dataset.qualifierHash,
-              csrfToken = csrfTokenElement.textContent,
-              formData = new FormData();
+              qualifierHash = depicted.dataset.qualifierHash;
+        function onError(text) {
+            window.alert(`An error occurred:\n\n${text}\n\nThe region drawn is ${iiifRegion}, if you want to add it manually.`);
+            throw new Error('Saving failed');
+        }
+        if (isLocalStatement(statementId)) {
+            return batchLocal(subject.domain, subject.id, [
+                { op: 'set_region', statement: Number(statementId), iiif_region: iiifRegion },
+            ]).catch(error => onError(error.message));
+        }
+
+        const formData = new FormData();
         formData.append('statement_id', statementId);
         if (qualifierHash) {
             formData.append('qualifier_hash', qualifierHash);
         }
         formData.append('iiif_region', iiifRegion);
-        formData.append('_csrf_token', csrfToken);
+        formData.append('_csrf_token', csrfTokenElement.textContent);
         return fetch(`${baseUrl}/api/v2/add_qualifier_local/${subject.domain}`, {
             method: 'POST',
             body: formData,
@@ -269,10 +313,7 @@ function setup() {
                     depicted.dataset.qualifierHash = json.qualifier_hash;
                 });
             } else {
-                return response.text().then(text => {
-                    window.alert(`An error occurred:\n\n${text}\n\nThe region drawn is ${iiifRegion}, if you want to add it manually.`);
-                    throw new Error('Saving failed');
-                });
+                return response.text().then(onError);
             }
         });
     }
@@ -440,50 +481,43 @@ function setup() {
             }
             
             const depicted = event.target.closest('.wd-image-positions--depicted');
-            const statementId = depicted.getAttribute("data-statement-id"),
-                  formData = new FormData();
-            formData.append("statement_id", statementId)
+            const statementId = depicted.getAttribute("data-statement-id");
             depicted.remove()
-            fetch(`${baseUrl}/api/v2/delete_qualifier_local`, {
-                method: 'POST',
-                body: formData,
-                credentials: 'include',
-            }).then(response => {
-                if (response.ok) {
-                    return response.json().then(json => {
-                        const statementId = json.depicted.statement_id;
-                        const propertyId = json.depicted.property_id;
-                        let depictedsWithoutRegionList = entityElement.querySelector(
-                            `.wd-image-positions--depicteds-without-region__${propertyId} ul`,
-                        );
-                        if (!depictedsWithoutRegionList) {
-                            const depictedsWithoutRegionDiv = document.createElement('div'),
-                                    depictedsWithoutRegionText = document.createTextNode(
-                                        `${depictedProperties[propertyId]?.[1] || propertyId} with no region specified:`,
-                                    );
-                            depictedsWithoutRegionList = document.createElement('ul');
-                            depictedsWithoutRegionDiv.classList.add('wd-image-positions--depicteds-without-region');
-                            depictedsWithoutRegionDiv.classList.add(`wd-image-positions--depicteds-without-region__${propertyId}`);
-                            depictedsWithoutRegionDiv.append(depictedsWithoutRegionText, depictedsWithoutRegionList);
-                            const newDepictedFormRoot = document.getElementById('new-depicted-form-root')
-                            newDepictedFormRoot.insertAdjacentElement('beforebegin', depictedsWithoutRegionDiv);
-                        }
-                        const new_depicted = document.createElement('li');
-                        new_depicted.classList.add('wd-image-positions--depicted-without-region');
-                        new_depicted.dataset.statementId = statementId;
-                        new_depicted.innerHTML = json.depicted_item_link;
-                        depictedsWithoutRegionList.append(new_depicted);
-                        addEditButton(new_depicted);
-                        if (!String(statementId).includes("Q")) {
-                            addRemoveButton(new_depicted);
-                        }
-                    });
-                    
-                } else {
+            batchLocal(entityElement.dataset.entityDomain, entityElement.dataset.entityId, [
+                { op: 'delete_region', statement: Number(statementId) },
+            ]).then(
+                ([json]) => {
+                    const statementId = json.depicted.statement_id;
+                    const propertyId = json.depicted.property_id;
+                    let depictedsWithoutRegionList = entityElement.querySelector(
+                        `.wd-image-positions--depicteds-without-region__${propertyId} ul`,
+                    );
+                    if (!depictedsWithoutRegionList) {
+                        const depictedsWithoutRegionDiv = document.createElement('div'),
+                                depictedsWithoutRegionText = document.createTextNode(
+                                    `${depictedProperties[propertyId]?.[1] || propertyId} with no region specified:`,
+                                );
+                        depictedsWithoutRegionList = document.createElement('ul');
+                        depictedsWithoutRegionDiv.classList.add('wd-image-positions--depicteds-without-region');
+                        depictedsWithoutRegionDiv.classList.add(`wd-image-positions--depicteds-without-region__${propertyId}`);
+                        depictedsWithoutRegionDiv.append(depictedsWithoutRegionText, depictedsWithoutRegionList);
+                        const newDepictedFormRoot = document.getElementById('new-depicted-form-root')
+                        newDepictedFormRoot.insertAdjacentElement('beforebegin', depictedsWithoutRegionDiv);
+                    }
+                    const new_depicted = document.createElement('li');
+                    new_depicted.classList.add('wd-image-positions--depicted-without-region');
+                    new_depicted.dataset.statementId = statementId;
+                    new_depicted.innerHTML = json.depicted_item_link;
+                    depictedsWithoutRegionList.append(new_depicted);
+                    addEditButton(new_depicted);
+                    if (!String(statementId).includes("Q")) {
+                        addRemoveButton(new_depicted);
+                    }
+                },
+                () => {
                     window.alert(`An error occurred: deleting qualifier with statement id ${statementId} failed. This may be because it is a qualifier that has already been posted on wikidata.`);
-                    throw new Error('Deleting failed');
-                }
-            });
+                },
+            );
 
             cancelDeleteRegion()
         }
@@ -663,7 +697,11 @@ function setup() {
                         this.searchResults = [];
                         return;
                     }
-                    const searchResults = await this.doSearch(value, this.searchOffset);
+                    await new Promise(resolve => setTimeout(resolve, searchDelay));
+                    if (this.searchValue !== value) {
+                        return; // still typing
+                    }
+                    const searchResults = await this.doDepictedSearch(value, this.searchOffset);
                     if (this.searchValue !== value) {
                         return; // changed during the request
                     }
@@ -694,7 +732,7 @@ function setup() {
 
                 async onSearchLoadMore() {
                     const value = this.searchValue;
-                    const moreResults = await this.doSearch(value, this.searchOffset);
+                    const moreResults = await this.doDepictedSearch(value, this.searchOffset);
                     if (this.searchValue !== value) {
                         return; // changed during the request
                     }
@@ -712,6 +750,24 @@ function setup() {
                     this.searchReferenceOffset += this.searchLimit;
                 },
 
+                async doDepictedSearch(value, offset) {
+                    // items depicted elsewhere in the corpus first, then other Wikidata items (cached by the tool)
+                    const params = new URLSearchParams({ search: value, limit: this.searchLimit, continue: offset });
+                    const response = await fetch(`${baseUrl}/api/v2/search_depicted?${params}`);
+                    if (!response.ok) {
+                        return [];
+                    }
+                    return (await response.json()).search.map(result => ({
+                        value: result.id,
+                        label: result.label?.value,
+                        description: result.uses ? `${result.description?.value ?? ''} (depicted ${result.uses}×)` : result.description?.value,
+                        language: {
+                            label: result.label?.language,
+                            description: result.description?.language,
+                        },
+                    }));
+                },
+
                 async doSearch(value, offset) {
                     const response = await session.request({
                         action: 'wbsearchentities',
@@ -739,10 +795,12 @@ function setup() {
                     if (!this.selectedItem) {
                         return;
                     }
-                    const formData = new FormData();
-                    formData.append('snaktype', 'value');
-                    formData.append('property_id', this.selectedProperty);
-                    formData.append('item_id', this.selectedItem);
+                    const operation = {
+                        op: 'add_statement',
+                        snaktype: 'value',
+                        property_id: this.selectedProperty,
+                        item_id: this.selectedItem,
+                    };
 
                     const dropdown = document.querySelector('#referencetype');
                     const toggle = document.querySelector('#qid-toggle');
@@ -775,74 +833,63 @@ function setup() {
                             }
                         }
 
-                        formData.append('reference_type', dropdown.value)
+                        operation.reference_type = dropdown.value;
                         if (dropdown.selectedIndex == 1) {
                             // 1 = reference URL
-                            formData.append('reference_value', this.searchReferenceValue);
+                            operation.reference_value = this.searchReferenceValue;
                         } else if (dropdown.selectedIndex == 2) {
                             // 2 = stated in                          
                             if (toggle.checked) {
-                                formData.append('reference_value', this.searchReferenceValue);
+                                operation.reference_value = this.searchReferenceValue;
                             } else {
-                                formData.append('reference_value', this.selectedReferenceItem);
+                                operation.reference_value = this.selectedReferenceItem;
                             }
 
                             const pages = document.querySelector("#pages-input");
                             if (pages.value != "") {
-                                formData.append('pages_value', pages.value);
+                                operation.pages_value = pages.value;
                             }
                         }
                     }
-                    this.addStatement(formData);
+                    this.addStatement(operation);
                 },
 
                 onAddNonValue(snakType) {
-                    const formData = new FormData();
-                    formData.append('snaktype', snakType);
-                    this.addStatement(formData);
+                    this.addStatement({ op: 'add_statement', snaktype: snakType });
                 },
 
-                addStatement(formData) {
+                addStatement(operation) {
                     this.disabled = true;
-                    formData.append('entity_id', subjectId);
-                    formData.append('_csrf_token', csrfTokenElement.textContent);
-                    fetch(`${baseUrl}/api/v1/add_statement_local/${subjectDomain}`, {
-                        method: 'POST',
-                        body: formData,
-                        credentials: 'include',
-                    }).then(response => {
-                        if (response.ok) {
-                            return response.json().then(json => {
-                                const statementId = json.depicted.statement_id;
-                                const propertyId = json.depicted.property_id;
-                                let depictedsWithoutRegionList = entityElement.querySelector(
-                                    `.wd-image-positions--depicteds-without-region__${propertyId} ul`,
-                                );
-                                if (!depictedsWithoutRegionList) {
-                                    const depictedsWithoutRegionDiv = document.createElement('div'),
-                                          depictedsWithoutRegionText = document.createTextNode(
-                                              `${depictedProperties[propertyId]?.[1] || propertyId} with no region specified:`,
-                                          );
-                                    depictedsWithoutRegionList = document.createElement('ul');
-                                    depictedsWithoutRegionDiv.classList.add('wd-image-positions--depicteds-without-region');
-                                    depictedsWithoutRegionDiv.classList.add(`wd-image-positions--depicteds-without-region__${propertyId}`);
-                                    depictedsWithoutRegionDiv.append(depictedsWithoutRegionText, depictedsWithoutRegionList);
-                                    newDepictedFormRoot.insertAdjacentElement('beforebegin', depictedsWithoutRegionDiv);
-                                }
-                                const depicted = document.createElement('li');
-                                depicted.classList.add('wd-image-positions--depicted-without-region');
-                                depicted.dataset.statementId = statementId;
-                                depicted.innerHTML = json.depicted_item_link;
-                                depictedsWithoutRegionList.append(depicted);
-                                addEditButton(depicted);
-                                addRemoveButton(depicted);
-                            });
-                        } else {
-                            return response.text().then(error => {
-                                window.alert(`An error occurred:\n\n${error}`);
-                            });
-                        }
-                    }).finally(() => {
+                    batchLocal(subjectDomain, subjectId, [operation]).then(
+                        ([json]) => {
+                            const statementId = json.depicted.statement_id;
+                            const propertyId = json.depicted.property_id;
+                            let depictedsWithoutRegionList = entityElement.querySelector(
+                                `.wd-image-positions--depicteds-without-region__${propertyId} ul`,
+                            );
+                            if (!depictedsWithoutRegionList) {
+                                const depictedsWithoutRegionDiv = document.createElement('div'),
+                                      depictedsWithoutRegionText = document.createTextNode(
+                                          `${depictedProperties[propertyId]?.[1] || propertyId} with no region specified:`,
+                                      );
+                                depictedsWithoutRegionList = document.createElement('ul');
+                                depictedsWithoutRegionDiv.classList.add('wd-image-positions--depicteds-without-region');
+                                depictedsWithoutRegionDiv.classList.add(`wd-image-positions--depicteds-without-region__${propertyId}`);
+                                depictedsWithoutRegionDiv.append(depictedsWithoutRegionText, depictedsWithoutRegionList);
+                                newDepictedFormRoot.insertAdjacentElement('beforebegin', depictedsWithoutRegionDiv);
+                            }
+                            const depicted = document.createElement('li');
+                            depicted.classList.add('wd-image-positions--depicted-without-region');
+                            depicted.dataset.statementId = statementId;
+                            depicted.innerHTML = json.depicted_item_link;
+                            depictedsWithoutRegionList.append(depicted);
+                            addEditButton(depicted);
+                            addRemoveButton(depicted);
+                        },
+                        error => {
+                            window.alert(`An error occurred:\n\n${error.message}`);
+                        },
+                    ).finally(() => {
                         this.disabled = false;
                     });
                 }
@@ -909,6 +956,8 @@ function setup() {
     });
     addNewDepictedForms();
     addCommentLabelsOwnUser();
+    // comments by project leads show up while editing
+    setInterval(() => document.hidden || addCommentLabelsOwnUser(), commentsInterval);
 
     addDropDownEventListener();
 
@@ -1,6 +1,11 @@
+import flask
+import json
 import pytest
+import time
 
 import app as wdip
+from benchmarks import harness
+import queries
 
 
 @pytest.mark.parametrize('input, expected', [
@@ -50,3 +55,475 @@ def test_parse_image_title_input_question_mark(input):
     expected = 'CSD_Berlin_2022_-_Lucas_Werkmeister_-_49_-_Do_You_Think_You’re_More_Tired_Of_The_War_Than_We_Are?.jpg'
     actual = wdip.parse_image_title_input(input)
     assert expected == actual
+
+
+def batch_local(client, csrf_token, operations, entity_id='Q100000'):
+    return client.post('/api/v2/batch_local/www.wikidata.org',
+                       data={'entity_id': entity_id, '_csrf_token': csrf_token, 'operations': json.dumps(operations)},
+                       headers={'Referer': 'http://localhost/item/' + entity_id})
+
+
+def test_batch_local(fake_wikimedia):
+    client = wdip.app.test_client()
+    csrf_token = harness.log_in(client, 'Student')
+    response = batch_local(client, csrf_token, [
+        {'op': 'add_statement', 'snaktype': 'value', 'item_id': 'Q900000', 'reference_type': 'P854', 'reference_value': 'https://example.org/'},
+        {'op': 'set_region', 'statement': {'index': 0}, 'iiif_region': 'pct:10,10,20,20'},
+        {'op': 'add_statement', 'snaktype': 'somevalue'},
+        {'op': 'set_region', 'statement': {'index': 2}, 'iiif_region': 'pct:50,50,20,20'},
+        {'op': 'delete_region', 'statement': {'index': 2}},
+    ])
+    assert response.status_code == 200
+    results = response.json['results']
+    assert [result['op'] for result in results] == ['add_statement', 'set_region', 'add_statement', 'set_region', 'delete_region']
+    first_id, second_id = results[0]['statement_id'], results[2]['statement_id']
+    assert results[1]['statement_id'] == first_id
+    assert results[0]['depicted']['item_id'] == 'Q900000'
+    assert 'data-entity-id="Q900000"' in results[0]['depicted_item_link']
+    assert 'wd-image-positions--snaktype-not-value' in results[4]['depicted_item_link']
+
+    statements = queries.jsonify_rows(queries.query_db(queries.get_object_statements(), params=['Q100000', 'Student']))
+    assert [statement['statement_id'] for statement in statements] == [first_id, second_id]
+    assert statements[0]['reference_value'] == 'https://example.org/'
+    assert queries.jsonify_rows(queries.query_db(queries.get_qualifier_for_statement(), params=[first_id]))[0]['iiif_region'] == 'pct:10,10,20,20'
+    assert not queries.query_db(queries.get_qualifier_for_statement(), params=[second_id])
+
+    response = batch_local(client, csrf_token, [{'op': 'delete_statement', 'statement': second_id}])
+    assert response.status_code == 200
+    assert not queries.query_db(queries.get_statement(), params=[second_id])
+
+
+def test_batch_local_is_all_or_nothing(fake_wikimedia):
+    client = wdip.app.test_client()
+    csrf_token = harness.log_in(client, 'Student')
+    response = batch_local(client, csrf_token, [
+        {'op': 'add_statement', 'snaktype': 'novalue'},
+        {'op': 'set_region', 'statement': {'index': 5}, 'iiif_region': 'pct:10,10,20,20'},
+    ])
+    assert response.status_code == 400
+    assert response.text == 'Operation 1: Bad statement index'
+    assert not queries.query_db(queries.get_object_statements(), params=['Q100000', 'Student'])
+
+    # a rolled back batch keeps the pending region of its statement, a committed one replaces it
+    statement_id = batch_local(client, csrf_token, [{'op': 'add_statement', 'snaktype': 'novalue'}]).json['results'][0]['statement_id']
+    wdip.qualifier_buffer.put(statement_id, 'pct:1,2,3,4', '')
+    response = batch_local(client, csrf_token, [
+        {'op': 'set_region', 'statement': statement_id, 'iiif_region': 'pct:10,10,20,20'},
+        {'op': 'unknown'},
+    ])
+    assert response.status_code == 400 and wdip.qualifier_buffer.get(statement_id) == ('pct:1,2,3,4', '')
+    batch_local(client, csrf_token, [{'op': 'set_region', 'statement': statement_id, 'iiif_region': 'pct:10,10,20,20'}])
+    wdip.qualifier_buffer.flush()
+    assert queries.jsonify_rows(queries.query_db(queries.get_qualifier_for_statement(), params=[statement_id]))[0]['iiif_region'] == 'pct:10,10,20,20'
+
+
+def test_bad_regions_are_rejected(fake_wikimedia):
+    client = wdip.app.test_client()
+    csrf_token = harness.log_in(client, 'Student')
+    response = batch_local(client, csrf_token, [
+        {'op': 'add_statement', 'snaktype': 'novalue'},
+        {'op': 'set_region', 'statement': {'index': 0}, 'iiif_region': 'pct:10,10,-5,5'},
+    ])
+    assert response.status_code == 400 and response.text == 'Operation 1: Bad iiif_region'
+
+    statement_id = batch_local(client, csrf_token, [{'op': 'add_statement', 'snaktype': 'novalue'}]).json['results'][0]['statement_id']
+    response = client.post('/api/v2/add_qualifier_local/www.wikidata.org', headers={'Referer': 'http://localhost/item/Q100000'},
+                           data={'statement_id': statement_id, 'iiif_region': 'pct:10,10,-5,5', '_csrf_token': csrf_token})
+    assert response.status_code == 400 and wdip.qualifier_buffer.get(statement_id) is None
+
+    # written some other way, such regions are not indexed (instead of failing the write)
+    queries.query_db(queries.add_qualifier(), params=[statement_id, 'pct:10,10,-5,5', ''])
+    assert not queries.query_db(queries.get_regions_in_box(), params=[100000, 100000, 0, 10000, 0, 10000])
+
+
+def test_batch_local_only_touches_own_statements(fake_wikimedia):
+    harness.seed_local_statements('Q100000', 'Other student', fake_wikimedia.fixtures, count=1)
+    statement_id = queries.jsonify_rows(queries.query_db(queries.get_latest_statement()))[0]['statement_id']
+    client = wdip.app.test_client()
+    csrf_token = harness.log_in(client, 'Student')
+    wdip.qualifier_buffer.put(statement_id, 'pct:1,2,3,4', '')  # the other student is dragging its region
+    response = batch_local(client, csrf_token, [{'op': 'delete_statement', 'statement': statement_id}])
+    assert response.status_code == 400
+    assert queries.query_db(queries.get_statement(), params=[statement_id])
+    assert wdip.qualifier_buffer.get(statement_id) == ('pct:1,2,3,4', '')
+
+
+def test_batch_local_checks_csrf_token(fake_wikimedia):
+    client = wdip.app.test_client()
+    harness.log_in(client, 'Student')
+    assert batch_local(client, 'wrong', []).status_code == 403
+
+
+def test_items_with_region_include_local_annotations(fake_wikimedia):
+    harness.seed_local_statements('Q100003', 'Student', fake_wikimedia.fixtures, count=2)
+    statement_id = queries.jsonify_rows(queries.query_db(queries.get_latest_statement()))[0]['statement_id']
+    wdip.qualifier_buffer.put(statement_id, 'pct:1,2,3,4', '')
+    assert wdip.items_with_region('pct:0,0,10,10') == ['Q100003']
+    assert wdip.items_with_region('pct:1,2,3,4') == ['Q100003']
+    assert wdip.items_with_region('pct:5,5,10,10') == []  # its region in the database is replaced by the buffered one
+    assert wdip.qualifier_buffer.get(statement_id)  # read without writing it
+
+    response = wdip.app.test_client().get('/iiif_region/pct:0,0,10,10')
+    assert response.status_code == 200
+    assert 'data-entity-id="Q100003"' in response.text
+
+
+def test_items_with_region_uses_index(fake_wikimedia):
+    plan = queries.query_db('EXPLAIN QUERY PLAN ' + queries.get_items_with_region(), params=['pct:0,0,10,10'])
+    assert any('ix_qualifiers_iiif_region' in row['detail'] for row in plan)
+
+
+def test_regions_by_point_and_box(fake_wikimedia):
+    # regions pct:0,0,10,10, pct:5,5,10,10 and pct:10,10,10,10 on Q100000, pct:0,0,10,10 on Q100001
+    harness.seed_local_statements('Q100000', 'Student', fake_wikimedia.fixtures, count=3)
+    harness.seed_local_statements('Q100001', 'Other student', fake_wikimedia.fixtures, count=1)
+    client = wdip.app.test_client()
+    harness.log_in(client, 'Student')
+
+    def regions(**args):
+        response = client.get('/api/v2/regions', query_string=args)
+        assert response.status_code == 200
+        return sorted((region['item_id'], region['iiif_region']) for region in response.json['regions'])
+
+    assert regions(item_id='Q100000', x=7, y=7) == [('Q100000', 'pct:0,0,10,10'), ('Q100000', 'pct:5,5,10,10')]
+    assert regions(x=2, y=2) == [('Q100000', 'pct:0,0,10,10'), ('Q100001', 'pct:0,0,10,10')]
+    assert regions(item_id='Q100000', iiif_region='pct:16,16,2,2') == [('Q100000', 'pct:10,10,10,10')]
+    assert regions(item_id='Q100000', x=50, y=50) == []
+    assert client.get('/api/v2/regions', query_string={'iiif_region': 'xywh=1,2,3,4'}).status_code == 400
+
+
+def test_region_duplicates(fake_wikimedia):
+    harness.seed_local_statements('Q100000', 'Student', fake_wikimedia.fixtures, count=2)
+    harness.seed_local_statements('Q100000', 'Other student', fake_wikimedia.fixtures, count=1)
+    client = wdip.app.test_client()
+    harness.log_in(client, 'Student')
+
+    response = client.get('/api/v2/regions/duplicates', query_string={'item_id': 'Q100000', 'iiif_region': 'pct:0.5,0,10,10'})
+    duplicates = response.json['duplicates']
+    assert sorted(duplicate['username'] for duplicate in duplicates) == ['Other student', 'Student']
+    assert all(duplicate['iou'] > 0.9 for duplicate in duplicates)
+
+    response = client.get('/api/v2/regions/duplicates', query_string={'item_id': 'Q100000'})
+    assert len(response.json['pairs']) == 1
+    assert response.json['pairs'][0]['iou'] == 1.0
+    response = client.get('/api/v2/regions/duplicates', query_string={'threshold': 0.1})
+    assert len(response.json['pairs']) == 3
+
+    # regions in the write-behind buffer count, without being written for the query
+    statement_id = queries.jsonify_rows(queries.query_db(queries.get_latest_statement()))[0]['statement_id']
+    wdip.qualifier_buffer.put(statement_id, 'pct:50,50,10,10', '')
+    assert client.get('/api/v2/regions/duplicates', query_string={'item_id': 'Q100000'}).json['pairs'] == []
+    wdip.qualifier_buffer.put(statement_id, 'pct:5,5,10,10', '')
+    response = client.get('/api/v2/regions/duplicates', query_string={'item_id': 'Q100000', 'threshold': 0.9})
+    assert [pair['statement_ids'][1] for pair in response.json['pairs']] == [statement_id]
+    regions = client.get('/api/v2/regions', query_string={'item_id': 'Q100000', 'x': 14, 'y': 14}).json['regions']
+    assert sorted((region['statement_id'], region['iiif_region']) for region in regions) == [
+        (statement_id - 1, 'pct:5,5,10,10'), (statement_id, 'pct:5,5,10,10')]
+    assert wdip.qualifier_buffer.get(statement_id)
+
+
+def test_intersection_over_union():
+    assert wdip.intersection_over_union((0, 10, 0, 10), (0, 10, 0, 10)) == 1.0
+    assert wdip.intersection_over_union((0, 10, 0, 10), (5, 15, 0, 10)) == 50 / 150
+    assert wdip.intersection_over_union((0, 10, 0, 10), (20, 30, 20, 30)) == 0.0
+
+
+def test_upload_only_writes_what_is_missing(fake_wikimedia):
+    # Q100000 has a P180 claim for Q900035 without a region and one for Q900066 with region pct:45,10,25,83
+    def add_local_statements():
+        for value_id, iiif_region, reference_value in [('Q900035', 'pct:1,1,5,5', 'https://example.org/'),
+                                                       ('Q900066', 'pct:45,10,25,83', None),
+                                                       ('Q900066', 'pct:1,2,3,4', None)]:
+            if reference_value:
+                queries.query_db(queries.add_statement_with_reference(), params=['Q100000', 'P180', value_id, 'value', 'Student', 'P854', reference_value])
+            else:
+                queries.query_db(queries.add_statement(), params=['Q100000', 'P180', value_id, 'value', 'Student'])
+            statement_id = queries.jsonify_rows(queries.query_db(queries.get_latest_statement()))[0]['statement_id']
+            queries.query_db(queries.add_qualifier(), params=[statement_id, iiif_region, ''])
+
+    client = wdip.app.test_client()
+    harness.log_in(client, 'Student')
+    add_local_statements()
+    edits_before = fake_wikimedia.edits
+    assert client.post('/api/v2/upload_annotations', data={'item_id': 'Q100000'}).status_code == 200
+    # a qualifier and a reference for the first claim, nothing for the second, a new claim with qualifier for the third
+    assert fake_wikimedia.edits - edits_before == 4
+
+    claims = fake_wikimedia.fixtures['entities']['Q100000']['claims']['P180']
+    assert sorted(wdip.claim_regions(claim).pop() for claim in claims if wdip.claim_value(claim) in {'Q900035', 'Q900066'}) == [
+        'pct:1,1,5,5', 'pct:1,2,3,4', 'pct:45,10,25,83']
+
+    # uploading the same statements again (e.g. after a partial upload) makes no edits
+    add_local_statements()
+    edits_before = fake_wikimedia.edits
+    assert client.post('/api/v2/upload_annotations', data={'item_id': 'Q100000'}).status_code == 200
+    assert fake_wikimedia.edits == edits_before
+
+
+def wait_for_bulk_upload(client, status_url):
+    for _ in range(100):
+        response = client.get(status_url)
+        if 'http-equiv="refresh"' not in response.text:
+            break
+        time.sleep(0.05)
+    return response
+
+
+def test_bulk_upload(fake_wikimedia):
+    harness.add_user('Lead', is_project_lead=True)
+    for item_id in ['Q100000', 'Q100001']:
+        harness.seed_local_statements(item_id, 'Student', fake_wikimedia.fixtures, count=2)
+    harness.seed_local_statements('Q100000', 'Other student', fake_wikimedia.fixtures, count=1)
+    client = wdip.app.test_client()
+    csrf_token = harness.log_in(client, 'Lead')
+
+    response = client.post('/projectleaddashboard/bulk', data={
+        '_csrf_token': csrf_token,
+        'pair': ['Q100000|Student', 'Q100001|Student', 'Q100000|Other student'],
+    })
+    assert response.status_code == 302
+    response = wait_for_bulk_upload(client, response.headers['Location'])
+    assert response.text.count('<td>uploaded</td>') == 3
+
+    assert not queries.query_db(queries.get_all_annotated_objects())
+    assert not fake_wikimedia.emails  # queued in the outbox until the digest window has passed
+    assert wdip.email_outbox.send_due(time.time() + wdip.email_outbox.window) == 2
+    assert sorted((email['to'], email['subject']) for email in fake_wikimedia.emails) == [
+        ('Other student', 'Annotations for object Q100000 approved'),
+        ('Student', 'Annotations for 2 objects approved'),
+    ]
+    assert all(email['from'] == 'Lead' for email in fake_wikimedia.emails)
+
+
+def test_interrupted_bulk_upload_can_be_retried(fake_wikimedia):
+    harness.add_user('Lead', is_project_lead=True)
+    harness.seed_local_statements('Q100000', 'Student', fake_wikimedia.fixtures, count=2)
+    # a batch whose process went away while it was running: nothing renews its claim
+    queries.query_db(queries.add_bulk_upload(), params=['lost', 'Q100000', 'Student', 'Lead', time.time() - 1])
+    client = wdip.app.test_client()
+    csrf_token = harness.log_in(client, 'Lead')
+
+    response = client.get('/projectleaddashboard/bulk/lost')
+    assert 'http-equiv="refresh"' not in response.text and 'Interrupted' in response.text and 'Retry the failed uploads' in response.text
+
+    response = client.post('/projectleaddashboard/bulk/lost/retry', data={'_csrf_token': csrf_token})
+    response = wait_for_bulk_upload(client, response.headers['Location'])
+    assert '<td>uploaded</td>' in response.text and 'Retry' not in response.text
+    assert not queries.query_db(queries.get_all_annotated_objects())
+
+
+def test_bulk_upload_needs_project_lead(fake_wikimedia):
+    client = wdip.app.test_client()
+    csrf_token = harness.log_in(client, 'Student')
+    response = client.post('/projectleaddashboard/bulk', data={'_csrf_token': csrf_token, 'pair': ['Q100000|Student']})
+    assert 'Permission denied' in response.text
+    assert not queries.query_db('SELECT * FROM bulk_uploads')
+
+
+def test_iiif_collection(fake_wikimedia, monkeypatch):
+    monkeypatch.setattr(wdip, 'COLLECTION_PAGE_SIZE', 12)
+    client = wdip.app.test_client()
+    collection = client.get('/iiif/collection.json').json
+    assert (collection['@type'], collection['total']) == ('sc:Collection', 30)
+    assert collection['last'].endswith('/iiif/collection/3.json')
+
+    page = client.get(collection['first']).json
+    assert page['within'] == collection['@id']
+    assert 'prev' not in page and page['next'].endswith('/iiif/collection/2.json')
+    assert len(page['manifests']) == 12
+    manifest = page['manifests'][0]
+    assert manifest['@id'].endswith('/iiif/Q100000/P18/manifest.json')
+    assert manifest['label'] == {'@value': 'Dura-Europos excavation photograph 0', '@language': 'en'}
+    assert manifest['thumbnail']['width'] == 400
+
+    last_page = client.get(collection['last']).json
+    assert last_page['startIndex'] == 24 and len(last_page['manifests']) == 6 and 'next' not in last_page
+    assert client.get('/iiif/collection/4.json').status_code == 404
+
+    # pages are cached as a whole
+    requests_before = fake_wikimedia.requests
+    assert client.get(collection['first']).json == page
+    assert fake_wikimedia.requests == requests_before
+
+
+def test_entity_data_is_shared_between_languages(fake_wikimedia):
+    client = wdip.app.test_client()
+    depicted_id = fake_wikimedia.fixtures['entities']['Q100000']['claims']['P180'][0]['mainsnak']['datavalue']['value']['id']
+    labels = {language: label['value'] for language, label in fake_wikimedia.fixtures['entities'][depicted_id]['labels'].items()}
+    assert labels['fr'] in client.get('/item/Q100000', headers={'Accept-Language': 'fr-CH, fr;q=0.9, en;q=0.8'}).text
+
+    # other language chains are resolved from the same cached entity data, including languages without labels
+    requests_before = fake_wikimedia.requests
+    assert labels['de'] in client.get('/item/Q100000?uselang=de').text
+    assert labels['en'] in client.get('/item/Q100000', headers={'Accept-Language': 'uk, ru;q=0.9'}).text
+    assert labels['fr'] in client.get('/item/Q100000?uselang=xx', headers={'Accept-Language': 'fr'}).text
+    assert fake_wikimedia.requests == requests_before
+
+    with wdip.app.test_request_context():
+        assert wdip.entity_language_codes(['fr', 'xx', 'en', 'fr', 'en']) == ('fr', 'en')
+
+
+def test_image_attribution_is_translated_locally(fake_wikimedia):
+    image_title = fake_wikimedia.fixtures['entities']['Q100000']['claims']['P18'][0]['mainsnak']['datavalue']['value']
+    extmetadata = fake_wikimedia.fixtures['files'][image_title]['imageinfo']['extmetadata']
+    extmetadata['Credit'] = {'value': {'en': 'Yale University Art Gallery', 'fr': 'Galerie d’art de l’université Yale',
+                                       '_default': 'Yale University Art Gallery'}}
+    with wdip.app.test_request_context():
+        assert wdip.load_image(image_title, ['fr', 'en'])['image_attribution']['attribution_text'].endswith('(Galerie d’art de l’université Yale)')
+        requests_before = fake_wikimedia.requests
+        assert wdip.load_image(image_title, ['de', 'en'])['image_attribution']['attribution_text'].endswith('(Yale University Art Gallery)')
+        assert wdip.image_attribution(image_title, ['tr'])['license_url'] == 'https://creativecommons.org/licenses/by-sa/4.0'
+        assert fake_wikimedia.requests == requests_before
+
+
+def rendered_templates(client, *args, **kwargs):
+    templates = []
+    with flask.template_rendered.connected_to(lambda sender, template, context, **extra: templates.append(template.name), wdip.app):
+        response = client.get(*args, **kwargs)
+    return response, templates
+
+
+# an item page, with the fragments of its depicted items
+ITEM_TEMPLATES = ['depicteds.html', 'depicteds-without-region.html', 'item.html']
+
+
+def test_anonymous_pages_are_cached(fake_wikimedia):
+    client = wdip.app.test_client()
+    first, templates = rendered_templates(client, '/item/Q100000', headers={'Accept-Language': 'fr-CH, fr;q=0.9'})
+    assert templates == ITEM_TEMPLATES and first.headers['Cache-Control'] == 'public, max-age=60'
+    assert 'Accept-Language' in first.headers['Vary'] and 'Cookie' in first.headers['Vary']
+
+    # the same language chain, however it is spelled, gets the same page without rendering it again
+    again, templates = rendered_templates(client, '/item/Q100000', headers={'Accept-Language': 'fr'})
+    assert templates == [] and again.data == first.data
+    assert rendered_templates(client, '/item/Q100000?uselang=de')[1] == ITEM_TEMPLATES
+    assert rendered_templates(client, '/dashboard/1')[1] == ['dashboard.html']
+    assert rendered_templates(client, '/dashboard/1')[1] == []
+
+    # logged-in users see their own annotations and are never served from the page cache
+    harness.log_in(client, 'Student')
+    response, templates = rendered_templates(client, '/item/Q100000', headers={'Accept-Language': 'fr'})
+    assert templates == ITEM_TEMPLATES and response.headers['Cache-Control'] == 'private'
+
+
+def test_cached_pages_are_dropped_when_their_data_is_edited(fake_wikimedia):
+    client = wdip.app.test_client()
+    fixtures = fake_wikimedia.fixtures
+    depicted_id = fixtures['entities']['Q100001']['claims']['P180'][0]['mainsnak']['datavalue']['value']['id']
+    image_title = fixtures['entities']['Q100002']['claims']['P18'][0]['mainsnak']['datavalue']['value']
+    for path in ['/item/Q100000', '/item/Q100001', '/item/Q100002', '/dashboard/1']:
+        client.get(path)
+    wdip.recent_changes.poll()
+
+    fake_wikimedia.edit('wikidata', depicted_id, lambda entity: entity['labels']['en'].update(value='relabelled thing'))
+    fake_wikimedia.edit('commons', fixtures['files'][image_title]['mediainfo']['id'], lambda mediainfo: None)
+    assert wdip.recent_changes.poll() == 2
+    assert 'relabelled thing' in client.get('/item/Q100001').text
+    assert rendered_templates(client, '/item/Q100002')[1] == ['item.html']  # the depicteds of the item itself are unchanged
+    assert rendered_templates(client, '/dashboard/1')[1] == ['dashboard.html']  # shows the image of Q100002
+    if depicted_id not in {claim['mainsnak']['datavalue']['value']['id'] for claim in fixtures['entities']['Q100000']['claims']['P180']}:
+        assert rendered_templates(client, '/item/Q100000')[1] == []
+
+
+def test_depicteds_are_rendered_once(fake_wikimedia):
+    client = wdip.app.test_client()
+    image_title = fake_wikimedia.fixtures['entities']['Q100000']['claims']['P18'][0]['mainsnak']['datavalue']['value'].replace(' ', '_')
+    embed, templates = rendered_templates(client, f'/api/v1/depicteds_html/file/{image_title}')
+    assert 'depicteds.html' in templates and 'wd-image-positions--depicted__P180' in embed.text
+    requests_before = fake_wikimedia.requests
+    again, templates = rendered_templates(client, f'/api/v1/depicteds_html/file/{image_title}')
+    assert templates == [] and again.text == embed.text and fake_wikimedia.requests == requests_before
+    assert again.headers['Access-Control-Allow-Origin'] == '*'
+
+    # the logged-in user's own annotations are part of the key, through the version the local store keeps
+    harness.log_in(client, 'Student')
+    assert 'depicteds.html' in rendered_templates(client, '/item/Q100001')[1]
+    assert 'depicteds.html' not in rendered_templates(client, '/item/Q100001')[1]
+    harness.seed_local_statements('Q100001', 'Someone else', fake_wikimedia.fixtures, count=1)
+    assert 'depicteds.html' not in rendered_templates(client, '/item/Q100001')[1]
+    harness.seed_local_statements('Q100001', 'Student', fake_wikimedia.fixtures, count=1)
+    response, templates = rendered_templates(client, '/item/Q100001')
+    assert 'depicteds.html' in templates and 'wd-image-positions--depicted__local' in response.text
+
+    # including regions that are only in the write-behind buffer so far
+    statement_id = queries.jsonify_rows(queries.query_db(queries.get_latest_statement()))[0]['statement_id']
+    wdip.qualifier_buffer.put(statement_id, 'pct:12,34,5,6', '')
+    assert 'left: 12%; top: 34%' in client.get('/item/Q100001').text
+
+
+def test_annotations_delta(fake_wikimedia):
+    client = wdip.app.test_client()
+    csrf_token = harness.log_in(client, 'Student')
+    assert client.get('/api/v2/annotations/Q100000/delta').status_code == 304  # nothing yet
+
+    harness.seed_local_statements('Q100000', 'Student', fake_wikimedia.fixtures, count=3)
+    harness.seed_local_statements('Q100001', 'Student', fake_wikimedia.fixtures, count=1)
+    delta = client.get('/api/v2/annotations/Q100000/delta').json
+    assert delta['full'] and delta['approved'] is False and delta['comments'] == []
+    assert [statement['iiif_region'] for statement in delta['statements']] == ['pct:0,0,10,10', 'pct:5,5,10,10', 'pct:10,10,10,10']
+    version = delta['version']
+    assert client.get('/api/v2/annotations/Q100000/delta', query_string={'since': version}).status_code == 304
+
+    # a project lead comments while the contributor is editing in another tab
+    first, second, third = [statement['statement_id'] for statement in delta['statements']]
+    harness.add_user('Lead', is_project_lead=True)
+    lead = wdip.app.test_client()
+    harness.log_in(lead, 'Lead')
+    lead.post('/api/v2/add_comment', data={'statement_id': first, 'comment': 'Is this right?', 'item_id': 'Q100000', 'username': 'Student'})
+    batch_local(client, csrf_token, [{'op': 'set_region', 'statement': second, 'iiif_region': 'pct:1,2,3,4'},
+                                     {'op': 'delete_statement', 'statement': third}])
+    delta = client.get('/api/v2/annotations/Q100000/delta', query_string={'since': version}).json
+    assert not delta['full'] and 'approved' not in delta
+    assert [(statement['statement_id'], statement['iiif_region']) for statement in delta['statements']] == [(second, 'pct:1,2,3,4')]
+    assert delta['deleted_statements'] == [third]
+    assert [(comment['statement_id'], comment['comment']) for comment in delta['comments']] == [(str(first), 'Is this right?')]
+
+    # the project lead can follow the contributor, other contributors cannot
+    assert lead.get('/api/v2/annotations/Q100000/delta', query_string={'username': 'Student', 'since': version}).json == delta
+    other = wdip.app.test_client()
+    harness.log_in(other, 'Other student')
+    assert other.get('/api/v2/annotations/Q100000/delta', query_string={'username': 'Student'}).status_code == 403
+
+    # polling does not write regions from the write-behind buffer, they are sent until they are written
+    wdip.qualifier_buffer.put(second, 'pct:9,9,9,9', '')
+    for _ in range(2):
+        buffered = client.get('/api/v2/annotations/Q100000/delta', query_string={'since': delta['version']}).json
+        assert buffered['version'] == delta['version'] and [statement['iiif_region'] for statement in buffered['statements']] == ['pct:9,9,9,9']
+    assert wdip.qualifier_buffer.get(second) is not None
+    wdip.qualifier_buffer.flush()
+    assert client.get('/api/v2/annotations/Q100000/delta', query_string={'since': delta['version'] + 1}).status_code == 304
+
+    # once the changes after a version are pruned from the log, it gets everything again
+    queries.query_db(queries.prune_annotation_changes(), params=[1])
+    delta = client.get('/api/v2/annotations/Q100000/delta', query_string={'since': version}).json
+    assert delta['full'] and [statement['statement_id'] for statement in delta['statements']] == [first, second]
+
+
+def test_review_queue(fake_wikimedia, monkeypatch):
+    monkeypatch.setitem(wdip.app.config, 'REVIEW_PREFETCH', 1)
+    harness.add_user('Lead', is_project_lead=True)
+    harness.seed_local_statements('Q100000', 'Student', fake_wikimedia.fixtures, count=1)
+    harness.seed_local_statements('Q100001', 'Other student', fake_wikimedia.fixtures, count=3)
+    harness.seed_local_statements('Q100002', 'Student', fake_wikimedia.fixtures, count=2)
+    queries.query_db(queries.add_approval(), params=['Student', 'Q100002', True])
+    client = wdip.app.test_client()
+    harness.log_in(client, 'Lead')
+
+    assert client.get('/review').headers['Location'] == '/review/oldest/Q100000/Student'
+    assert client.get('/review?order=statements').headers['Location'] == '/review/statements/Q100001/Other%20student'
+
+    first = client.get('/review/oldest/Q100000/Student').text
+    assert '1 of 2' in first and 'href="/review/oldest/Q100001/Other%20student"' in first and 'Previous' not in first
+    wdip.review_prefetch_executor.submit(lambda: None).result()  # the next entry was loaded meanwhile
+    response, templates = rendered_templates(client, '/review/oldest/Q100001/Other%20student')
+    assert 'review.html' in templates and 'depicteds.html' not in templates
+    assert '2 of 2' in response.text and 'href="/review/oldest/Q100000/Student"' in response.text
+    assert response.text.count('wd-image-positions--depicted__local') == 3
+
+    # approved entries leave the queue
+    queries.query_db(queries.add_approval(), params=['Student', 'Q100000', True])
+    queries.query_db(queries.add_approval(), params=['Other student', 'Q100001', True])
+    assert 'All annotations have been reviewed' in client.get('/review').text
+
+    harness.log_in(client, 'Student')
+    assert 'Permission denied' in client.get('/review').text
@@ -0,0 +1,75 @@
+import collections
+import time
+
+import app as wdip
+import autocomplete
+import queries
+import upstream
+
+
+def wait_for_depicted_index():
+    for _ in range(500):
+        if wdip.depicted_index_cache.peek(('depicted',)) is not None:
+            return
+        time.sleep(0.01)
+    raise AssertionError('the index of depicted items was not built')
+
+
+def test_depicted_index():
+    index = autocomplete.DepictedIndex({'Q1': 1, 'Q2': 5, 'Q3': 2}, {
+        'Q1': {'en': 'Roman bath', 'fr': 'Thermes romains'},
+        'Q2': {'en': 'bathhouse'},
+        'Q3': {'en': 'Temple of Bel', 'el': 'Ναός του Βήλου'},
+    })
+    assert index.search('bath') == ['Q2', 'Q1']
+    assert index.search('  ROMAN  ') == ['Q1']
+    assert index.search('thermes rom') == ['Q1']
+    assert index.search('ναος') == ['Q3']  # without the accent
+    assert index.search('ath') == [] and index.search('') == []
+
+
+def test_search_depicted_items(fake_wikimedia):
+    fixtures = fake_wikimedia.fixtures
+    uses = collections.Counter(claim['mainsnak']['datavalue']['value']['id'] for n in range(30)
+                               for claim in fixtures['entities'][f'Q1000{n:02d}']['claims']['P180'])
+    unused = sorted(entity_id for entity_id in fixtures['entities'] if entity_id.startswith('Q9') and entity_id not in uses)[0]
+    for _ in range(uses.most_common(1)[0][1] + 1):
+        queries.query_db(queries.add_statement(), params=['Q100000', 'P180', unused, 'value', 'Someone'])
+    client = wdip.app.test_client()
+
+    # the first search only starts building the index, and is answered by wbsearchentities meanwhile
+    results = client.get('/api/v2/search_depicted', query_string={'search': 'depicted thing', 'limit': 50}).json['search']
+    assert results and all(result['uses'] == 0 for result in results)
+    wait_for_depicted_index()
+
+    results = client.get('/api/v2/search_depicted', query_string={'search': 'depicted thing', 'limit': 50}).json['search']
+    assert results[0]['id'] == unused
+    assert [result['uses'] for result in results[1:]] == sorted(uses.values(), reverse=True)[:49]
+    assert results[0]['label'] == {'language': 'en', 'value': fixtures['entities'][unused]['labels']['en']['value']}
+
+    # served from the index: no API requests, in the user's language, with continuation
+    requests_before = fake_wikimedia.requests
+    response = client.get('/api/v2/search_depicted', query_string={'search': 'chose representee', 'limit': 5, 'continue': 5},
+                          headers={'Accept-Language': 'fr'}).json
+    assert fake_wikimedia.requests == requests_before
+    assert [result['id'] for result in response['search']] == [result['id'] for result in results[5:10]]
+    assert response['search'][0]['label']['language'] == 'fr' and response['search-continue'] == 10
+
+
+def test_search_falls_back_to_wbsearchentities(fake_wikimedia, monkeypatch):
+    client = wdip.app.test_client()
+    results = client.get('/api/v2/search_depicted', query_string={'search': 'photo'}).json['search']
+    assert [result['id'] for result in results] == ['Q125191']
+    assert results[0]['uses'] == 0 and results[0]['label']['value'] == 'photograph'
+
+    requests_before = fake_wikimedia.requests
+    assert client.get('/api/v2/search_depicted', query_string={'search': 'Photo'}).json['search'] == results
+    assert fake_wikimedia.requests == requests_before
+
+    # when the rate limit is used up, only the depicted items are suggested
+    wait_for_depicted_index()
+    requests_before = fake_wikimedia.requests
+    monkeypatch.setattr(wdip, 'search_limiter', upstream.RateLimiter(0, 0))
+    assert client.get('/api/v2/search_depicted', query_string={'search': 'yale'}).json['search'] == []
+    assert client.get('/api/v2/search_depicted', query_string={'search': 'depicted thing'}).json['search']
+    assert fake_wikimedia.requests == requests_before
@@ -0,0 +1,15 @@
+from benchmarks import run
+
+
+def test_benchmark_scenarios_run_offline(fake_wikimedia, capsys):
+    fixtures = fake_wikimedia.fixtures
+    for name, scenario in run.scenarios(fixtures).items():
+        result = run.run_scenario(scenario, requests=2, concurrency=1, warmup=0)
+        assert result['errors'] == 0, name
+
+
+def test_percentile():
+    values = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10]
+    assert run.percentile(values, 0.5) == 5
+    assert run.percentile(values, 0.95) == 10
+    assert run.percentile([], 0.5) == 0.0
@@ -0,0 +1,160 @@
+import json
+import pytest
+import time
+
+import app as wdip
+import cache
+import entities
+from exceptions import UpstreamUnavailable
+import upstream
+
+
+def wait_for_refresh(swr_cache, key, value):
+    for _ in range(100):
+        if swr_cache.peek(key) == value:
+            return
+        time.sleep(0.01)
+
+
+def test_fresh_entries_are_not_reloaded():
+    swr_cache = cache.StaleWhileRevalidateCache('test-fresh', maxsize=10, ttl=60, stale_ttl=60)
+    loads = []
+
+    def load():
+        loads.append(1)
+        return len(loads)
+
+    assert swr_cache.get('key', load) == 1
+    assert swr_cache.get('key', load) == 1
+    assert len(loads) == 1
+
+
+def test_stale_entries_are_served_while_refreshing():
+    swr_cache = cache.StaleWhileRevalidateCache('test-stale', maxsize=10, ttl=0, stale_ttl=60)
+    swr_cache.put_many({'key': 'old'})
+    assert swr_cache.get('key', lambda: 'new') == 'old'
+    wait_for_refresh(swr_cache, 'key', 'new')
+    assert swr_cache.peek('key') == 'new'
+
+
+def test_slow_entries_are_loaded_in_the_background():
+    swr_cache = cache.StaleWhileRevalidateCache('test-later', maxsize=10, ttl=60, stale_ttl=60)
+    assert swr_cache.get_or_load_later('key', lambda: 'loaded') is None
+    wait_for_refresh(swr_cache, 'key', 'loaded')
+    assert swr_cache.get_or_load_later('key', lambda: 'reloaded') == 'loaded'
+
+    swr_cache.put_many({'key': 'expired'}, age=120)
+    assert swr_cache.get_or_load_later('key', lambda: 'reloaded', default='loading') == 'loading'
+    wait_for_refresh(swr_cache, 'key', 'reloaded')
+    assert swr_cache.peek('key') == 'reloaded'
+
+
+def test_expired_entries_are_served_if_loading_fails():
+    swr_cache = cache.StaleWhileRevalidateCache('test-expired', maxsize=10, ttl=0, stale_ttl=0)
+    swr_cache.put_many({'key': 'old'})
+
+    def load():
+        raise UpstreamUnavailable('www.wikidata.org')
+
+    assert swr_cache.get('key', load) == 'old'
+    with pytest.raises(UpstreamUnavailable):
+        swr_cache.get('other key', load)
+
+
+def test_get_many_loads_only_missing_keys():
+    swr_cache = cache.StaleWhileRevalidateCache('test-many', maxsize=10, ttl=60, stale_ttl=60)
+    swr_cache.put_many({'a': 'A'})
+    requested = []
+
+    def load_many(keys):
+        requested.append(keys)
+        return {key: key.upper() for key in keys}
+
+    assert swr_cache.get_many(['a', 'b', 'c', 'b'], load_many) == {'a': 'A', 'b': 'B', 'c': 'C'}
+    assert requested == [['b', 'c']]
+
+
+def test_least_recently_used_entries_are_evicted():
+    swr_cache = cache.StaleWhileRevalidateCache('test-lru', maxsize=2, ttl=60, stale_ttl=60)
+    swr_cache.put_many({'a': 1, 'b': 2})
+    swr_cache.get('a', lambda: None)
+    swr_cache.put_many({'c': 3})
+    assert swr_cache.peek('a') == 1
+    assert swr_cache.peek('b') is None
+    assert len(swr_cache) == 2
+
+
+def test_circuit_breaker_opens_after_repeated_failures():
+    breaker = upstream.CircuitBreaker('example.org', failure_threshold=2, reset_timeout=60)
+    breaker.before_call()
+    breaker.failure()
+    breaker.before_call()
+    breaker.failure()
+    with pytest.raises(UpstreamUnavailable):
+        breaker.before_call()
+
+
+def test_circuit_breaker_lets_one_trial_call_through():
+    breaker = upstream.CircuitBreaker('example.org', failure_threshold=1, reset_timeout=60)
+    breaker.failure()
+    breaker.open_until = 0.0  # the reset timeout has passed
+    breaker.before_call()
+    with pytest.raises(UpstreamUnavailable):
+        breaker.before_call()
+    breaker.success()
+    breaker.before_call()
+
+
+def test_circuit_breaker_honors_retry_after():
+    breaker = upstream.CircuitBreaker('example.org', failure_threshold=5, reset_timeout=60)
+    breaker.failure(retry_after=120)
+    with pytest.raises(UpstreamUnavailable) as excinfo:
+        breaker.before_call()
+    assert 100 < excinfo.value.retry_after <= 120
+
+
+def test_parse_retry_after():
+    assert upstream.parse_retry_after('5') == 5
+    assert upstream.parse_retry_after('100000') == upstream.MAX_RETRY_AFTER
+    assert upstream.parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT') == 0
+    assert upstream.parse_retry_after('soon') is None
+    assert upstream.parse_retry_after(None) is None
+
+
+def test_maxlag_fails_fast_with_503(fake_wikimedia):
+    client = wdip.app.test_client()
+    fake_wikimedia.incident = 'maxlag'
+    response = client.get('/item/Q100000')
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '5'
+    requests_before = fake_wikimedia.requests
+    assert client.get('/item/Q100001').status_code == 503
+    assert fake_wikimedia.requests == requests_before  # the circuit is open
+
+
+def test_rate_limited_edits_do_not_open_the_circuit(fake_wikimedia):
+    session = wdip.anonymous_session('www.wikidata.org')
+    fake_wikimedia.incident = 'ratelimited'
+    for _ in range(upstream.FAILURE_THRESHOLD + 1):
+        with pytest.raises(UpstreamUnavailable):
+            session.post(action='wbcreateclaim', entity='Q100000', property='P180', snaktype='novalue', token='+\\')
+    assert wdip.app.test_client().get('/item/Q100000').status_code == 200
+
+
+def test_cached_pages_survive_an_upstream_incident(fake_wikimedia, monkeypatch):
+    client = wdip.app.test_client()
+    assert client.get('/item/Q100000').status_code == 200
+    fake_wikimedia.incident = 'overloaded'
+    for named_cache in cache.caches.values():
+        monkeypatch.setattr(named_cache, 'ttl', 0)  # everything is stale now
+    assert client.get('/item/Q100000').status_code == 200
+
+
+def test_stale_formatted_values_are_refreshed_with_their_own_value(fake_wikimedia):
+    datavalues = tuple(json.dumps({'type': 'string', 'value': value}) for value in ['first', 'second', 'third'])
+    keys = [('P1', datavalue) for datavalue in datavalues]
+    wdip.formatted_value_cache.put_many({key: 'old' for key in keys}, age=wdip.formatted_value_cache.ttl + 1)
+    assert wdip.entity_metadata(entities.Entity('Q1', metadata={'P1': datavalues}))['P1'] == ['old', 'old', 'old']
+    for key, value in zip(keys, ['first', 'second', 'third']):
+        wait_for_refresh(wdip.formatted_value_cache, key, f'<span>{value}</span>')
+        assert wdip.formatted_value_cache.peek(key) == f'<span>{value}</span>'
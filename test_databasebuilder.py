@@ -0,0 +1,44 @@
+import os
+import sqlite3
+import subprocess
+import sys
+
+import pytest
+
+import queries
+
+
+BUILDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'databasebuilder.py')
+
+
+def build(directory, *args):
+    subprocess.run([sys.executable, BUILDER, *args], cwd=directory, check=True)
+
+
+@pytest.fixture
+def old_database(tmp_path):
+    """A database built before the region index, with a region"""
+    build(tmp_path)
+    path = str(tmp_path / 'table.sqlite')
+    with sqlite3.connect(path, isolation_level=None) as connection:
+        for name in ['qualifiers_region_index_insert', 'qualifiers_region_index_update', 'qualifiers_region_index_delete',
+                     'region_index', 'ix_qualifiers_iiif_region']:
+            kind = connection.execute('SELECT type FROM sqlite_master WHERE name = ?', [name]).fetchone()[0]
+            connection.execute(f'DROP {kind.upper()} {name}')
+    queries.query_db(queries.add_statement(), params=['Q100000', 'P180', 'Q1', 'value', 'Student'], database_url=path)
+    queries.query_db(queries.add_qualifier(), params=['1', 'pct:5,5,10,10', ''], database_url=path)
+    return tmp_path
+
+
+def test_upgrade_adds_the_region_indexes(old_database):
+    path = str(old_database / 'table.sqlite')
+    version = queries.query_db(queries.get_annotation_version(), params=['Q100000', 'Student'], database_url=path)[0]['version']
+    for _ in range(2):  # the upgrade can be run again
+        build(old_database, '--upgrade')
+
+    rows = queries.query_db(queries.get_regions_in_box(), params=[100000, 100000, 1000, 1000, 1000, 1000], database_url=path)
+    assert [(row['statement_id'], row['iiif_region']) for row in rows] == [(1, 'pct:5,5,10,10')]
+    plan = queries.query_db('EXPLAIN QUERY PLAN ' + queries.get_items_with_region(), params=['pct:5,5,10,10'], database_url=path)
+    assert any('ix_qualifiers_iiif_region' in row['detail'] for row in plan)
+    # indexing the existing regions is not a change of the annotations
+    assert queries.query_db(queries.get_annotation_version(), params=['Q100000', 'Student'], database_url=path)[0]['version'] == version
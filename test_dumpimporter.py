@@ -0,0 +1,64 @@
+import copy
+import gzip
+import io
+import json
+import time
+
+import app as wdip
+import dumpimporter
+import queries
+
+
+def write_dump(path, fixtures, extra=()):
+    """Writes entities in the format of the Wikidata JSON dumps: a JSON array with one entity per line"""
+    entities = [*extra, *fixtures['entities'].values()]
+    with gzip.open(path, 'wt', encoding='utf-8') as dump:
+        dump.write('[\n' + ',\n'.join(json.dumps(entity, separators=(',', ':')) for entity in entities) + '\n]\n')
+
+
+def stored():
+    return {row['entity_id']: row for row in queries.query_db('SELECT * FROM entity_store')}
+
+
+def test_import_dump(fake_wikimedia, tmp_path):
+    fixtures = fake_wikimedia.fixtures
+    elsewhere = copy.deepcopy(fixtures['entities']['Q100001'])
+    elsewhere['id'] = 'Q200000'
+    elsewhere['claims']['P195'][0]['mainsnak']['datavalue']['value']['id'] = 'Q42'
+    write_dump(tmp_path / 'dump.json.gz', fixtures, extra=[elsewhere, {'type': 'lexeme', 'id': 'L1', 'lemmas': {}}])
+
+    items, labels = dumpimporter.import_dump(lambda: dumpimporter.open_dump(str(tmp_path / 'dump.json.gz')),
+                                             ['en', 'fr'], wdip.depicted_properties)
+    rows = stored()
+    corpus = sorted(entity_id for entity_id, row in rows.items() if row['props'] == dumpimporter.CORPUS_PROPS)
+    assert corpus == sorted(f'Q1000{n:02d}' for n in range(30)) and items == 30
+    # the depicted items (listed before the corpus in the dump) and the metadata properties, labels only
+    referenced = {depicted['mainsnak']['datavalue']['value']['id'] for n in range(30)
+                  for depicted in fixtures['entities'][f'Q1000{n:02d}']['claims']['P180']}
+    assert {entity_id for entity_id, row in rows.items() if row['props'] == 'labels'} == referenced | {'P1476', 'P571', 'P2048', 'P195'}
+    assert labels == len(referenced) + 4
+    record = json.loads(rows[sorted(referenced)[0]]['data'])
+    assert set(record['labels']) == {'en', 'fr'} and not record['depicteds']
+
+
+def test_entity_cache_is_seeded_from_the_store(fake_wikimedia, tmp_path):
+    write_dump(tmp_path / 'dump.json.gz', fake_wikimedia.fixtures)
+    dumpimporter.main([str(tmp_path / 'dump.json.gz'), '--database', queries.DATABASE_URL])
+    fake_wikimedia.edit('wikidata', 'Q100000', lambda entity: entity['labels']['en'].update(value='Renamed since the dump'))
+
+    client = wdip.app.test_client()
+    # the label from the dump is served right away, and the entity is refreshed from the API in the background
+    assert 'Renamed since the dump' not in client.get('/item/Q100000').text
+    for _ in range(100):
+        if 'Renamed since the dump' in client.get('/item/Q100000').text:
+            break
+        time.sleep(0.05)
+    else:
+        raise AssertionError('the seeded entity was not refreshed from the API')
+
+
+def test_read_entity_data_files():
+    lines = io.StringIO('{"entities":{"Q1":{"type":"item","id":"Q1","labels":{}}}}\n{"entities":{"Q2":{"type":"item","id":"Q2"}}}\n')
+    assert [entity['id'] for entity in dumpimporter.read_entities(lines)] == ['Q1', 'Q2']
+    lines = io.StringIO('[\n{"type":"item","id":"Q1"},\n{"type":"item","id":"Q2"}\n]\n')
+    assert [entity['id'] for entity in dumpimporter.read_entities(lines, lambda line, entity_id: entity_id == 'Q2')] == ['Q2']
@@ -0,0 +1,73 @@
+import json
+import pickle
+
+import app as wdip
+import entities
+from benchmarks import fakewikimedia
+
+
+def statement(property_id, datavalue, rank='normal', datatype='commonsMedia', **extra):
+    mainsnak = {'snaktype': 'value', 'property': property_id, 'datavalue': datavalue, 'datatype': datatype}
+    return {'mainsnak': mainsnak, 'type': 'statement', 'id': f'Q1${property_id}-{rank}-{datavalue["value"]}', 'rank': rank, **extra}
+
+
+def string(value):
+    return {'value': value, 'type': 'string'}
+
+
+def state(entity):
+    return {name: getattr(entity, name) for name in entity.__slots__ if name != 'depicteds'} | {
+        'depicteds': [depicted.to_dict() for depicted in entity.depicteds]}
+
+
+def test_best_values_by_rank():
+    entity = entities.Entity.from_json({'id': 'Q1', 'claims': {
+        'P18': [statement('P18', string('a.jpg'), 'deprecated'), statement('P18', string('b.jpg')), statement('P18', string('c.jpg'))],
+        'P4291': [statement('P4291', string('d.jpg')), statement('P4291', string('e.jpg'), 'preferred')],
+        'P217': [statement('P217', string('1929.123'), datatype='external-id')],
+        'P1684': [statement('P1684', string('ΑΒΓ'), 'deprecated', datatype='string'),
+                  statement('P1684', string('ABC'), datatype='string'), statement('P1684', string('DEF'), datatype='string')],
+    }}, wdip.depicted_properties)
+    # the same choices as before the projection: the first preferred value, else the last normal one
+    assert entity.images == {'P18': string('c.jpg'), 'P4291': string('e.jpg')}
+    assert entity.metadata == {'P1684': (json.dumps(string('ABC'), sort_keys=True), json.dumps(string('DEF'), sort_keys=True))}
+    assert not entity.missing and entity.depicteds == ()
+
+
+def test_depicteds_with_regions():
+    region = {'snaktype': 'value', 'property': 'P2677', 'hash': 'abc', 'datavalue': string('pct:1,2,3,4')}
+    entity = entities.Entity.from_json({'id': 'M1', 'statements': {'P180': [
+        statement('P180', {'value': {'entity-type': 'item', 'id': 'Q2'}, 'type': 'wikibase-entityid'}, qualifiers={'P2677': [region]}),
+        {'mainsnak': {'snaktype': 'somevalue', 'property': 'P180'}, 'id': 'M1$x', 'rank': 'normal'},
+    ]}}, wdip.depicted_properties)
+    assert [depicted.to_dict() for depicted in entity.depicteds] == [
+        {'snaktype': 'value', 'statement_id': 'Q1$P180-normal-{\'entity-type\': \'item\', \'id\': \'Q2\'}', 'property_id': 'P180',
+         'item_id': 'Q2', 'iiif_region': 'pct:1,2,3,4', 'qualifier_hash': 'abc'},
+        {'snaktype': 'somevalue', 'statement_id': 'M1$x', 'property_id': 'P180'},
+    ]
+    # MediaInfo entities without statements have an empty list instead of an object (T222159)
+    assert entities.Entity.from_json({'id': 'M2', 'statements': []}, wdip.depicted_properties).depicteds == ()
+    assert entities.Entity.from_json({'id': 'Q3', 'missing': ''}, wdip.depicted_properties).missing
+
+
+def test_unused_claims_are_not_kept():
+    fixtures = fakewikimedia.synthetic_fixtures()
+    for item_id in ['Q100000', 'Q100001', 'Q100002']:
+        entity_data = fixtures['entities'][item_id]
+        projected = entities.Entity.from_json(entity_data, wdip.depicted_properties)
+        # real items also have identifiers, sitelink-like and descriptive claims the tool never looks at
+        reference = {'snaks': {'P248': [{'snaktype': 'value', 'property': 'P248', 'datavalue': string('Q1')}]}}
+        bloated = dict(entity_data, claims={
+            **entity_data['claims'],
+            **{f'P{7000 + n}': [statement(f'P{7000 + n}', string(f'id-{n}'), datatype='external-id', references=[reference])]
+               for n in range(100)},
+        })
+        assert state(entities.Entity.from_json(bloated, wdip.depicted_properties)) == state(projected)
+        assert len(pickle.dumps(projected)) < len(pickle.dumps(bloated)) / 4
+
+
+def test_entity_cache_holds_projections(fake_wikimedia):
+    client = wdip.app.test_client()
+    assert client.get('/item/Q100000').status_code == 200
+    cached = [value for value, _ in wdip.entity_cache._entries.values()]
+    assert cached and all(isinstance(value, entities.Entity) for value in cached)
@@ -0,0 +1,73 @@
+import csv
+import io
+import json
+
+import app as wdip
+from benchmarks import harness
+import export
+import queries
+
+
+def seed(fake_wikimedia):
+    harness.seed_local_statements('Q100000', 'Student', fake_wikimedia.fixtures, count=3)
+    harness.seed_local_statements('Q100001', 'Other student', fake_wikimedia.fixtures, count=2)
+    queries.query_db(queries.add_comment(), params=['1', 'Too small', 'Lead', 'Q100000', 'Student'])
+    queries.query_db(queries.add_approval(), params=['Other student', 'Q100001', True])
+
+
+def test_statements_are_read_in_chunks(fake_wikimedia):
+    seed(fake_wikimedia)
+    statements = list(export.statements(chunk_size=2))
+    assert [statement['statement_id'] for statement in statements] == [1, 2, 3, 4, 5]
+    assert statements[0]['comments'] == [{'comment': 'Too small', 'project_lead_username': 'Lead'}]
+    assert statements[0]['iiif_region'] == 'pct:0,0,10,10'
+    assert statements[0]['created'].endswith('Z')
+
+
+def test_statements_are_filtered(fake_wikimedia):
+    seed(fake_wikimedia)
+    assert [s['statement_id'] for s in export.statements(username='Student')] == [1, 2, 3]
+    assert [s['statement_id'] for s in export.statements(item_id='Q100001')] == [4, 5]
+    assert [s['statement_id'] for s in export.statements(approved=True)] == [4, 5]
+    assert [s['statement_id'] for s in export.statements(approved=False, username='Student', chunk_size=1)] == [1, 2, 3]
+    assert list(export.statements(since='2000-01-01', until='2000-01-02')) == []
+    assert len(list(export.statements(since='2000-01-01'))) == 5
+
+
+def test_export_endpoint(fake_wikimedia):
+    seed(fake_wikimedia)
+    harness.add_user('Lead', is_project_lead=True)
+    client = wdip.app.test_client()
+    harness.log_in(client, 'Lead')
+
+    response = client.get('/api/v2/export/ndjson?approved=yes')
+    assert response.mimetype == 'application/x-ndjson'
+    assert [json.loads(line)['username'] for line in response.text.splitlines()] == ['Other student', 'Other student']
+
+    rows = list(csv.DictReader(io.StringIO(client.get('/api/v2/export/csv?username=Student').text)))
+    assert [row['statement_id'] for row in rows] == ['1', '2', '3']
+    assert json.loads(rows[0]['comments'])[0]['comment'] == 'Too small'
+
+    lines = client.get('/api/v2/export/quickstatements?item_id=Q100001').text.splitlines()
+    assert lines[0].split('\t')[:5] == ['Q100001', 'P180', queries.query_db(queries.get_statement(), params=[4])[0]['value_id'],
+                                        'P2677', '"pct:0,0,10,10"']
+    assert lines[0].split('\t')[5:] == ['S854', '"https://example.org/"']
+
+    data = json.loads(client.get('/api/v2/export/wbeditentity?item_id=Q100001').text.splitlines()[1])
+    assert data['id'] == 'Q100001'
+    assert data['claims'][0]['qualifiers']['P2677'][0]['datavalue']['value'] == 'pct:5,5,10,10'
+
+    assert client.get('/api/v2/export/xml').status_code == 404
+    assert client.get('/api/v2/export/csv?approved=maybe').status_code == 400
+
+
+def test_export_needs_project_lead(fake_wikimedia):
+    client = wdip.app.test_client()
+    harness.log_in(client, 'Student')
+    assert client.get('/api/v2/export/ndjson').status_code == 403
+
+
+def test_export_command_line(fake_wikimedia, capsys):
+    seed(fake_wikimedia)
+    export.main(['--database', queries.DATABASE_URL, '--format', 'quickstatements', '--username', 'Other student'])
+    assert len(capsys.readouterr().out.splitlines()) == 2
@@ -0,0 +1,99 @@
+import iiif_prezi.factory
+import json
+import pytest
+
+import app as wdip
+
+
+def language_string_wikibase_to_iiif(language_string):
+    if language_string is None:
+        return None
+    return {language_string['language']: language_string['value']}
+
+
+def factory_manifest(item, base_url, image_info, attribution):
+    """The manifest as the iiif_prezi factory built it before build_manifest"""
+    fac = iiif_prezi.factory.ManifestFactory()
+    fac.set_base_prezi_uri(base_url)
+    fac.set_debug('error')
+
+    iiif_item_label = language_string_wikibase_to_iiif(item['label'])
+    iiif_item_description = language_string_wikibase_to_iiif(item['description'])
+
+    manifest = fac.manifest(ident='manifest.json')
+    if iiif_item_label is not None:
+        manifest.label = iiif_item_label
+    if iiif_item_description is not None:
+        manifest.description = iiif_item_description
+    if attribution is not None:
+        manifest.attribution = attribution['attribution_text']
+        manifest.license = attribution['license_url']
+    for metadata in item['metadata']:
+        manifest.set_metadata({
+            'label': language_string_wikibase_to_iiif(metadata['label']),
+            'value': metadata['value'],
+        })
+    sequence = manifest.sequence(ident='normal', label='default order')
+    canvas = sequence.canvas(ident='c0')
+    if iiif_item_label is not None:
+        canvas.label = iiif_item_label
+    annolist = fac.annotationList(ident='annotations', label='Things depicted on this canvas')
+    canvas.add_annotationList(annolist)
+
+    width, height = image_info['thumbwidth'], image_info['thumbheight']
+    canvas.set_hw(height, width)
+    anno = canvas.annotation(ident='a0')
+    img = anno.image(ident=image_info['thumburl'], iiif=False)
+    img.set_hw(height, width)
+    img.format = image_info['mime']
+    canvas.thumbnail = fac.image(ident=wdip.thumbnail_url(image_info, item['image_title']))
+    canvas.thumbnail.format = image_info['mime']
+    canvas.thumbnail.set_hw(int(height * (400 / width)), 400)
+
+    return manifest.toJSON(top=True)
+
+
+def manifest_inputs(item_id):
+    path = f'/iiif/{item_id}/P18/manifest.json'
+    with wdip.app.test_request_context(path):
+        item = wdip.load_item_and_property(item_id, 'P18', include_description=True, include_metadata=True)
+        return (item, 'http://localhost' + path[:-len('/manifest.json')], wdip.load_image_info(item['image_title']),
+                wdip.image_attribution(item['image_title'], ['en']))
+
+
+@pytest.mark.parametrize('variant', ['full', 'no description', 'no metadata', 'no attribution'])
+def test_manifest_matches_factory_output(fake_wikimedia, variant):
+    for item_id in ['Q100000', 'Q100007', 'Q100023']:
+        item, base_url, image_info, attribution = manifest_inputs(item_id)
+        if variant == 'no description':
+            item['description'] = None
+        elif variant == 'no metadata':
+            item['metadata'] = []
+        elif variant == 'no attribution':
+            attribution = None
+        expected = json.loads(json.dumps(factory_manifest(item, base_url, image_info, attribution)))
+        assert wdip.build_manifest(item, base_url, image_info, attribution) == expected
+
+
+def test_manifest_endpoint(fake_wikimedia):
+    client = wdip.app.test_client()
+    response = client.get('/iiif/Q100000/P18/manifest.json')
+    assert response.mimetype == 'application/json'
+    assert response.headers['Access-Control-Allow-Origin'] == '*'
+    item, base_url, image_info, attribution = manifest_inputs('Q100000')
+    assert response.json == json.loads(json.dumps(factory_manifest(item, base_url, image_info, attribution)))
+
+
+def test_manifest_v3(fake_wikimedia):
+    client = wdip.app.test_client()
+    manifest = client.get('/iiif/v3/Q100000/P18/manifest.json').json
+    assert manifest['@context'] == 'http://iiif.io/api/presentation/3/context.json'
+    assert (manifest['id'], manifest['type']) == ('http://localhost/iiif/v3/Q100000/P18/manifest.json', 'Manifest')
+    assert manifest['label'] == {'en': ['Dura-Europos excavation photograph 0']}
+    assert manifest['rights'] == 'http://creativecommons.org/licenses/by-sa/4.0'
+    [canvas] = manifest['items']
+    [annotation] = canvas['items'][0]['items']
+    assert annotation['motivation'] == 'painting'
+    assert annotation['target'] == canvas['id']
+    assert (annotation['body']['width'], annotation['body']['height']) == (canvas['width'], canvas['height'])
+    assert client.get('/iiif/v3/Q900000/P18/manifest.json').status_code == 404
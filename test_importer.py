@@ -0,0 +1,130 @@
+import io
+
+import app as wdip
+from benchmarks import harness
+import importer
+import queries
+
+
+def local_statements():
+    return queries.jsonify_rows(queries.query_db(
+        'SELECT statements.*, qualifiers.iiif_region FROM statements '
+        'LEFT JOIN qualifiers ON qualifiers.statement_id = CAST(statements.statement_id AS TEXT) ORDER BY statements.statement_id'))
+
+
+def import_text(text, username='Importer', **kwargs):
+    return importer.import_annotations(importer.read(text), username, wdip.existing_items, wdip.item_image_sizes, **kwargs)
+
+
+def image_size(fake_wikimedia, item_id):
+    image_title = fake_wikimedia.fixtures['entities'][item_id]['claims']['P18'][0]['mainsnak']['datavalue']['value']
+    imageinfo = fake_wikimedia.fixtures['files'][image_title]['imageinfo']
+    return imageinfo['thumbwidth'], imageinfo['thumbheight']
+
+
+def test_import_csv(fake_wikimedia):
+    width, height = image_size(fake_wikimedia, 'Q100001')
+    text = ('item_id,value_id,username,iiif_region,xywh,reference_type,reference_value\n'
+            'Q100000,Q900001,Student,"pct:10,20,30,40",,P854,https://example.org/\n'
+            f'Q100001,Q900002,,,"{width // 4},{height // 2},{width // 2},{height // 4}",,\n'
+            'Q100002,Q900003,,,,,\n')
+    assert import_text(text) == (3, [])
+    statements = local_statements()
+    assert [(s['item_id'], s['value_id'], s['username'], s['iiif_region']) for s in statements] == [
+        ('Q100000', 'Q900001', 'Student', 'pct:10,20,30,40'),
+        ('Q100001', 'Q900002', 'Importer', 'pct:25,50,50,25'),
+        ('Q100002', 'Q900003', 'Importer', None),
+    ]
+    assert statements[0]['reference_value'] == 'https://example.org/'
+    assert statements[0]['created'].endswith('Z')
+    # the regions are in the region index
+    assert queries.query_db('SELECT COUNT(*) FROM region_index')[0][0] == 2
+
+
+def test_import_annotation_list(fake_wikimedia):
+    client = wdip.app.test_client()
+    annotation_list = client.get('/iiif/Q100003/list/annotations.json').text
+    claims = fake_wikimedia.fixtures['entities']['Q100003']['claims']['P180']
+    with_region = [claim for claim in claims if 'qualifiers' in claim]
+
+    imported, errors = import_text(annotation_list)
+    assert (imported, errors) == (len(claims), [])
+    statements = local_statements()
+    assert [s['value_id'] for s in statements] == [claim['mainsnak']['datavalue']['value']['id'] for claim in claims]
+    # pixel coordinates are rounded down in the annotation list, so the regions come back to within a pixel
+    for statement, claim in zip([s for s in statements if s['iiif_region']], with_region):
+        original = [float(part) for part in claim['qualifiers']['P2677'][0]['datavalue']['value'][4:].split(',')]
+        imported_region = [float(part) for part in statement['iiif_region'][4:].split(',')]
+        assert all(abs(a - b) < 0.1 for a, b in zip(original, imported_region))
+
+
+def test_invalid_rows_are_reported(fake_wikimedia):
+    text = ('item_id,value_id,iiif_region,xywh\n'
+            'Q100000,Q900001,"pct:1,2,3,4",\n'
+            'Q999999,Q900001,,\n'
+            'Q100000,Q900001,"pct:1,2,3",\n'
+            'Q100000,Q900001,,"1,2,300000,4"\n'
+            'x,Q900001,,\n')
+    imported, errors = import_text(text)
+    assert imported == 0
+    assert [number for number, _ in errors] == [2, 3, 4, 5]
+    assert 'Q999999 does not exist' in errors[0][1]
+    assert not local_statements()
+
+    imported, errors = import_text(text, skip_invalid=True)
+    assert imported == 1
+    assert len(errors) == 4
+    assert [s['iiif_region'] for s in local_statements()] == ['pct:1,2,3,4']
+
+
+def test_empty_regions_and_regions_past_the_edge_are_invalid(fake_wikimedia):
+    text = ('item_id,value_id,iiif_region,xywh\n'
+            'Q100000,Q900001,"pct:10,10,0,0",\n'
+            'Q100000,Q900001,"pct:90,90,50,50",\n'
+            'Q100000,Q900001,"pct:10,10,0.001,5",\n'
+            'Q100001,Q900001,,"0,0,0,0"\n')
+    imported, errors = import_text(text)
+    assert imported == 0
+    assert [number for number, _ in errors] == [1, 2, 3, 4]
+    assert importer.pct_region('pct:0,0,100,100') == 'pct:0,0,100,100'
+
+
+def test_import_in_chunks(fake_wikimedia):
+    harness.seed_local_statements('Q100000', 'Student', fake_wikimedia.fixtures, count=2)
+    text = 'item_id,value_id,iiif_region\n' + ''.join(f'Q1000{n:02d},Q9000{n:02d},"pct:{n},{n},5,5"\n' for n in range(5))
+    assert import_text(text, chunk_size=2) == (5, [])
+    statements = local_statements()
+    assert [s['statement_id'] for s in statements] == [1, 2, 3, 4, 5, 6, 7]
+    assert [s['iiif_region'] for s in statements[2:]] == [f'pct:{n},{n},5,5' for n in range(5)]
+
+
+def test_lookups_are_batched_and_cached(fake_wikimedia):
+    text = 'item_id,value_id,xywh\n' + ''.join(f'Q1000{n:02d},Q9000{n:02d},"0,0,10,10"\n' for n in range(30))
+    requests_before = fake_wikimedia.requests
+    assert import_text(text) == (30, [])
+    # one wbgetentities request for the 60 entities (50 per request) and one for their images
+    assert fake_wikimedia.requests - requests_before == 3
+    requests_before = fake_wikimedia.requests
+    assert import_text(text) == (30, [])
+    assert fake_wikimedia.requests == requests_before
+
+
+def test_import_endpoint(fake_wikimedia):
+    harness.add_user('Lead', is_project_lead=True)
+    client = wdip.app.test_client()
+    csrf_token = harness.log_in(client, 'Lead')
+    text = 'item_id,value_id,iiif_region\nQ100000,Q900001,"pct:1,2,3,4"\n'
+    response = client.post('/api/v2/import', data={'_csrf_token': csrf_token, 'file': (io.BytesIO(text.encode()), 'legacy.csv')})
+    assert response.json == {'imported': 1, 'errors': []}
+    assert local_statements()[0]['username'] == 'Lead'
+
+    response = client.post('/api/v2/import', data={'_csrf_token': csrf_token, 'file': (io.BytesIO(b'item_id\nQ0\n'), 'bad.csv')})
+    assert response.status_code == 400
+    assert response.json['errors'] == [{'row': 1, 'error': "invalid item ID 'Q0'"}]
+
+
+def test_import_needs_project_lead(fake_wikimedia):
+    client = wdip.app.test_client()
+    csrf_token = harness.log_in(client, 'Student')
+    response = client.post('/api/v2/import', data={'_csrf_token': csrf_token, 'file': (io.BytesIO(b''), 'empty.csv')})
+    assert response.status_code == 403
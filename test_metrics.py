@@ -0,0 +1,41 @@
+import app as wdip
+import metrics
+import queries
+
+
+def test_server_timing_aggregates_per_operation():
+    timings = [
+        ('api', 'www.wikidata.org', 'wbgetentities', 0.010, None),
+        ('api', 'www.wikidata.org', 'wbgetentities', 0.020, 'TimeoutError'),
+        ('sql', 'sqlite', 'get_object_statements', 0.001, None),
+    ]
+    header = metrics.server_timing(timings, 0.05)
+    assert header == ('api-wbgetentities;dur=30.0;desc="www.wikidata.org wbgetentities x2 (1 failed)", '
+                      'sql-get_object_statements;dur=1.0;desc="sqlite get_object_statements x1", '
+                      'total;dur=50.0')
+
+
+def test_prometheus_text():
+    metrics.reset()
+    metrics.observe('api', 'www.wikidata.org', 'wbgetentities', 0.02)
+    metrics.observe('api', 'www.wikidata.org', 'wbgetentities', 3.0, 'TimeoutError')
+    text = metrics.prometheus_text()
+    assert 'outbound_api_duration_seconds_bucket{host="www.wikidata.org",action="wbgetentities",le="0.025"} 1\n' in text
+    assert 'outbound_api_duration_seconds_bucket{host="www.wikidata.org",action="wbgetentities",le="+Inf"} 2\n' in text
+    assert 'outbound_api_duration_seconds_count{host="www.wikidata.org",action="wbgetentities"} 2\n' in text
+    assert 'outbound_api_errors_total{host="www.wikidata.org",action="wbgetentities",error="TimeoutError"} 1\n' in text
+    metrics.reset()
+
+
+def test_statement_name():
+    assert queries.statement_name(queries.get_object_statements()) == 'get_object_statements'
+    assert queries.statement_name('SELECT * FROM statements WHERE statement_id IN (?, ?, ?)') == 'SELECT * FROM statements WHERE statement_id IN (?, ...)'
+
+
+def test_server_timing_header_and_metrics_endpoint():
+    client = wdip.app.test_client()
+    response = client.get('/')
+    assert response.headers['Server-Timing'].startswith('total;dur=')
+    response = client.get('/metrics')
+    assert response.mimetype == 'text/plain'
+    assert 'http_request_duration_seconds_count{endpoint="index",method="GET"}' in response.get_data(as_text=True)
@@ -0,0 +1,84 @@
+import time
+
+import app as wdip
+import outbox
+from benchmarks import harness
+import queries
+import upstream
+
+
+def outbox_emails(username):
+    return queries.jsonify_rows(queries.query_db(queries.get_outbox_emails(), params=[username]))
+
+
+def enqueue(item_id, username='Student'):
+    wdip.email_outbox.enqueue(username, item_id, f'https://example.org/item/{item_id}', True, 'Lead', {'key': 'Lead', 'secret': 'secret'})
+
+
+def test_approvals_are_sent_as_one_digest(fake_wikimedia):
+    client = wdip.app.test_client()
+    harness.log_in(client, 'Lead')
+    for item_id in ['Q100000', 'Q100001']:
+        response = client.post('/api/v2/emailuser', data={'username': 'Student', 'item_id': item_id})
+        assert response.status_code == 200
+    assert not fake_wikimedia.emails
+    assert queries.query_db(queries.get_approval(), params=['Student', 'Q100001'])[0]['approved']
+
+    now = time.time()
+    assert wdip.email_outbox.send_due(now) == 0  # still collecting
+    assert wdip.email_outbox.send_due(now + wdip.email_outbox.window) == 1
+    assert [(email['from'], email['to'], email['subject']) for email in fake_wikimedia.emails] == [
+        ('Lead', 'Student', 'Annotations for 2 objects approved')]
+    assert 'https://dura-europos-wd-annotation.toolforge.org/item/Q100001' in fake_wikimedia.emails[0]['text']
+    assert [email['status'] for email in outbox_emails('Student')] == ['sent', 'sent']
+    # the project lead's access token is never written to the database
+    assert not [row for row in queries.query_db('SELECT * FROM email_outbox') if 'secret' in tuple(row)]
+
+
+def test_failed_digests_are_retried_with_backoff(fake_wikimedia):
+    enqueue('Q100000')
+    fake_wikimedia.incident = 'overloaded'
+    assert wdip.email_outbox.send_due(time.time() + wdip.email_outbox.window) == 0
+    [email] = outbox_emails('Student')
+    assert (email['status'], email['attempts']) == ('pending', 1)
+    assert wdip.email_outbox.send_due(time.time() + wdip.email_outbox.window) == 0  # backing off
+
+    fake_wikimedia.incident = None
+    upstream._breakers.clear()
+    enqueue('Q100001')  # joins the digest that is being retried
+    assert wdip.email_outbox.send_due(time.time() + wdip.email_outbox.window + wdip.email_outbox.backoff) == 1
+    assert [email['subject'] for email in fake_wikimedia.emails] == ['Annotations for 2 objects approved']
+
+
+def test_users_without_email_are_not_retried(fake_wikimedia):
+    fake_wikimedia.users_without_email.add('Student')
+    enqueue('Q100000')
+    enqueue('Q100000', username='Other student')
+    assert wdip.email_outbox.send_due(time.time() + wdip.email_outbox.window) == 1
+    [email] = outbox_emails('Student')
+    assert (email['status'], email['attempts']) == ('failed', 1)
+    assert 'noemail' in email['last_error']
+    assert [email['to'] for email in fake_wikimedia.emails] == ['Other student']
+
+
+def test_claimed_emails_are_not_sent_twice(fake_wikimedia):
+    enqueue('Q100000')
+    later = time.time() + wdip.email_outbox.window
+    queries.query_db(queries.claim_outbox_emails(), params=['other worker', later + 60, later, later])
+    assert wdip.email_outbox.send_due(later) == 0
+    assert wdip.email_outbox.send_due(later + 600) == 1  # the other worker never reported back
+    assert len(fake_wikimedia.emails) == 1
+
+
+def test_digests_without_access_token_are_sent_from_the_tool_account(fake_wikimedia, monkeypatch):
+    enqueue('Q100000')
+    # another worker process (or this one after a restart) does not have the project lead's access token
+    monkeypatch.setattr(wdip, 'email_outbox', outbox.Outbox(wdip.send_approval_digest, wdip.email_outbox.window))
+    later = time.time() + wdip.email_outbox.window
+    assert wdip.email_outbox.send_due(later) == 0
+    [email] = outbox_emails('Student')
+    assert (email['status'], email['attempts']) == ('pending', 1) and 'access token' in email['last_error']
+
+    monkeypatch.setitem(wdip.app.config, 'EMAIL_ACCESS_TOKEN', {'key': 'Dura-Europos tool', 'secret': 'secret'})
+    assert wdip.email_outbox.send_due(later + wdip.email_outbox.backoff) == 1
+    assert [(email['from'], email['to']) for email in fake_wikimedia.emails] == [('Dura-Europos tool', 'Student')]
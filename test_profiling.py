@@ -0,0 +1,30 @@
+import time
+
+import profiling
+
+
+def busy(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+def test_sampling_profiler_collects_folded_stacks(tmp_path):
+    profiler = profiling.SamplingProfiler().start()
+    busy(0.05)
+    profiler.stop()
+
+    assert profiler.stacks
+    assert any('busy (test_profiling.py:' in stack for stack in profiler.stacks)
+    for line in profiler.folded().splitlines():
+        stack, count = line.rsplit(' ', 1)
+        assert int(count) > 0
+
+    name = profiling.save(str(tmp_path), profiler, {'endpoint': 'item_and_property', 'url': 'http://localhost/item/Q1'}, [])
+    assert profiling.load_profile(str(tmp_path), name)['samples'] == sum(profiler.stacks.values())
+    assert profiling.load_profile(str(tmp_path), name, suffix='.folded') == profiler.folded()
+    assert [profile['name'] for profile in profiling.list_profiles(str(tmp_path))] == [name]
+
+
+def test_load_profile_rejects_other_paths(tmp_path):
+    assert profiling.load_profile(str(tmp_path), '../table') is None
@@ -0,0 +1,100 @@
+import app as wdip
+import metrics
+import recentchanges
+import upstream
+
+
+def set_label(value):
+    def update(entity):
+        entity['labels'] = {**entity['labels'], 'en': {'language': 'en', 'value': value}}
+    return update
+
+
+def test_edited_entities_are_reloaded(fake_wikimedia):
+    client = wdip.app.test_client()
+    depicted_id = fake_wikimedia.fixtures['entities']['Q100000']['claims']['P180'][0]['mainsnak']['datavalue']['value']['id']
+    client.get('/item/Q100000')
+    client.get('/item/Q100001')
+    assert wdip.recent_changes.poll() == 0
+
+    fake_wikimedia.edit('wikidata', 'Q100000', set_label('Renamed photograph'))
+    fake_wikimedia.edit('wikidata', depicted_id, set_label('renamed depicted thing'))
+    fake_wikimedia.edit('wikidata', 'Q100029', set_label('never loaded'))
+    assert wdip.recent_changes.poll() == 2
+    # changes that were read before are not reported again
+    assert wdip.recent_changes.poll() == 0
+
+    requests_before = fake_wikimedia.requests
+    client.get('/item/Q100001')
+    assert fake_wikimedia.requests == requests_before
+    text = client.get('/item/Q100000').text
+    assert 'Renamed photograph' in text and 'renamed depicted thing' in text
+
+
+def test_edits_by_the_tool_are_noticed(fake_wikimedia):
+    client = wdip.app.test_client()
+    client.get('/item/Q100002')
+    session = wdip.anonymous_session('www.wikidata.org')
+    session.post(action='wbcreateclaim', entity='Q100002', snaktype='somevalue', property='P180')
+    assert wdip.recent_changes.poll() == 1
+    assert wdip.entity_cache.peek(('www.wikidata.org', 'Q100002', ('claims',))) is None
+
+
+def test_older_revisions_are_skipped(fake_wikimedia):
+    changes = []
+    watcher = recentchanges.RecentChanges(wdip.anonymous_session, lambda domain, change: changes.append(change['title']),
+                                          {'www.wikidata.org': [0]})
+    revid = fake_wikimedia.edit('wikidata', 'Q100003', set_label('first'))
+    watcher.track('www.wikidata.org', 'Q100003', revid)
+    fake_wikimedia.edit('wikidata', 'Q100004', set_label('untracked'))
+    assert watcher.poll() == 0
+    fake_wikimedia.edit('wikidata', 'Q100003', set_label('second'))
+    assert watcher.poll() == 1 and changes == ['Q100003']
+
+
+def test_many_changes_are_read_with_continuation(fake_wikimedia, monkeypatch):
+    changes = []
+    watcher = recentchanges.RecentChanges(wdip.anonymous_session, lambda domain, change: changes.append(change['revid']),
+                                          {'www.wikidata.org': [0]})
+    monkeypatch.setattr(fake_wikimedia, 'list_recentchanges', _with_limit(fake_wikimedia.list_recentchanges, 3))
+    for n in range(10):
+        watcher.track('www.wikidata.org', f'Q1000{n:02d}', 0)
+        fake_wikimedia.edit('wikidata', f'Q1000{n:02d}', set_label(f'edit {n}'))
+    assert watcher.poll() == 10
+    assert changes == sorted(changes)
+
+
+def _with_limit(list_recentchanges, limit):
+    return lambda wiki, params: list_recentchanges(wiki, {**params, 'rclimit': str(limit)})
+
+
+def test_edited_files_are_reloaded(fake_wikimedia):
+    image_title = fake_wikimedia.fixtures['entities']['Q100005']['claims']['P18'][0]['mainsnak']['datavalue']['value']
+    file = fake_wikimedia.fixtures['files'][image_title]
+    with wdip.app.test_request_context():
+        wdip.load_image(image_title, ['en'])
+        wdip.load_entities('commons.wikimedia.org', [file['mediainfo']['id']], ['claims'])
+
+    fake_wikimedia.edit('commons', file['mediainfo']['id'], lambda mediainfo: mediainfo['statements'].pop('P180'))
+    file['imageinfo']['extmetadata']['Credit'] = {'value': 'Someone else'}
+    assert wdip.recent_changes.poll() == 1
+    with wdip.app.test_request_context():
+        assert wdip.load_image(image_title, ['en'])['image_attribution']['attribution_text'].endswith('(Someone else)')
+        assert wdip.load_entities('commons.wikimedia.org', [file['mediainfo']['id']], ['claims'])[file['mediainfo']['id']].depicteds == ()
+
+
+def test_failing_polls_shorten_the_entity_ttl(fake_wikimedia, caplog):
+    wdip.recent_changes_health(True)
+    assert wdip.entity_cache.ttl == wdip.app.config['RECENT_CHANGES_ENTITY_TTL']
+    metrics.reset()
+    fake_wikimedia.incident = 'overloaded'
+    for _ in range(recentchanges.MAX_FAILURES):
+        assert wdip.recent_changes.run_once() is None
+    assert f'recent_changes_errors_total{{}} {recentchanges.MAX_FAILURES}' in metrics.prometheus_text()
+    assert 'Reading the recent changes failed' in caplog.text
+    assert wdip.entity_cache.ttl == wdip.ENTITY_TTL
+
+    fake_wikimedia.incident = None
+    upstream._breakers.clear()
+    assert wdip.recent_changes.run_once() == 0
+    assert wdip.entity_cache.ttl == wdip.app.config['RECENT_CHANGES_ENTITY_TTL']
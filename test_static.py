@@ -0,0 +1,19 @@
+import glob
+import os
+import shutil
+import subprocess
+
+import pytest
+
+
+# the scripts are loaded as modules, except image.js, which is a classic script
+SCRIPTS = sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', '*.js')))
+
+
+@pytest.mark.skipif(shutil.which('node') is None, reason='Node.js is not installed')
+@pytest.mark.parametrize('path', SCRIPTS, ids=os.path.basename)
+def test_script_syntax(path):
+    input_type = 'commonjs' if os.path.basename(path) == 'image.js' else 'module'
+    with open(path, 'rb') as script:
+        result = subprocess.run(['node', f'--input-type={input_type}', '--check'], stdin=script, capture_output=True)
+    assert result.returncode == 0, result.stderr.decode()
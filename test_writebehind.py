@@ -0,0 +1,105 @@
+import pytest
+import sqlite3
+
+import app as wdip
+from benchmarks import harness
+import queries
+import writebehind
+
+
+@pytest.fixture
+def database(monkeypatch, tmp_path):
+    path = str(tmp_path / 'table.sqlite')
+    harness.create_database(path)
+    monkeypatch.setattr(queries, 'DATABASE_URL', path)
+    return path
+
+
+def stored_region(statement_id):
+    rows = queries.jsonify_rows(queries.query_db(queries.get_qualifier_for_statement(), params=[statement_id]))
+    return rows[0]['iiif_region'] if rows else None
+
+
+def test_only_the_last_region_is_written(database):
+    buffer = writebehind.QualifierBuffer(delay=60)
+    for x in range(5):
+        buffer.put(1, f'pct:{x},0,10,10', '')
+    buffer.put(2, 'pct:50,50,10,10', '')
+    assert buffer.get(1) == ('pct:4,0,10,10', '')
+    assert stored_region(1) is None
+
+    buffer.flush()
+    assert stored_region(1) == 'pct:4,0,10,10'
+    assert stored_region(2) == 'pct:50,50,10,10'
+    assert buffer.get(1) is None
+
+
+def test_regions_are_flushed_after_the_delay(database):
+    buffer = writebehind.QualifierBuffer(delay=0.01)
+    buffer.put(1, 'pct:1,2,3,4', '')
+    buffer._timer.join()
+    assert stored_region(1) == 'pct:1,2,3,4'
+
+
+def test_discarded_regions_are_not_written(database):
+    buffer = writebehind.QualifierBuffer(delay=60)
+    buffer.put(1, 'pct:1,2,3,4', '')
+    buffer.discard('1')
+    buffer.flush()
+    assert stored_region(1) is None
+
+
+def test_failed_flushes_keep_the_regions(database, monkeypatch):
+    buffer = writebehind.QualifierBuffer(delay=60)
+    buffer.put(1, 'pct:1,2,3,4', '')
+    monkeypatch.setattr(queries, 'DATABASE_URL', 'file:missing.sqlite?mode=ro')
+    with pytest.raises(sqlite3.OperationalError):
+        buffer.flush()
+    assert buffer.get(1) == ('pct:1,2,3,4', '')
+    monkeypatch.setattr(queries, 'DATABASE_URL', database)
+    buffer.flush()
+    assert stored_region(1) == 'pct:1,2,3,4'
+
+
+def test_bad_regions_are_not_buffered(database):
+    buffer = writebehind.QualifierBuffer(delay=60)
+    with pytest.raises(ValueError):
+        buffer.put(1, 'pct:10,10,-5,5', '')
+    assert buffer.get(1) is None
+
+
+def test_rejected_regions_are_dropped(database):
+    with sqlite3.connect(database) as connection:
+        connection.execute('''CREATE TRIGGER reject_region BEFORE INSERT ON qualifiers WHEN NEW.iiif_region = 'pct:6,6,6,6'
+                              BEGIN SELECT RAISE(ABORT, 'rejected'); END''')
+    buffer = writebehind.QualifierBuffer(delay=60)
+    buffer.put(1, 'pct:6,6,6,6', '')
+    buffer.put(2, 'pct:1,2,3,4', '')
+    buffer.flush()
+    assert stored_region(1) is None and buffer.get(1) is None
+    assert stored_region(2) == 'pct:1,2,3,4'
+
+
+def test_no_delay_writes_directly(database):
+    buffer = writebehind.QualifierBuffer(delay=0)
+    buffer.put(1, 'pct:1,2,3,4', '')
+    assert stored_region(1) == 'pct:1,2,3,4'
+
+
+def test_pending_regions_are_shown_before_they_are_written(fake_wikimedia):
+    client = wdip.app.test_client()
+    csrf_token = harness.log_in(client, 'Student')
+    headers = {'Referer': 'http://localhost/item/Q100000'}
+    response = client.post('/api/v1/add_statement_local/www.wikidata.org', headers=headers,
+                           data={'entity_id': 'Q100000', 'snaktype': 'value', 'item_id': 'Q900000', '_csrf_token': csrf_token})
+    statement_id = response.json['depicted']['statement_id']
+    for x in range(3):
+        client.post('/api/v2/add_qualifier_local/www.wikidata.org', headers=headers,
+                    data={'statement_id': statement_id, 'iiif_region': f'pct:{x},0,10,10', '_csrf_token': csrf_token})
+
+    depicteds = []
+    wdip.append_local_depicteds(depicteds, 'Q100000', 'Student')
+    assert depicteds[0]['iiif_region'] == 'pct:2,0,10,10'
+
+    wdip.qualifier_buffer.flush()
+    assert stored_region(statement_id) == 'pct:2,0,10,10'
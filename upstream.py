@@ -0,0 +1,170 @@
+# outbound calls to the Wikimedia APIs and the Wikidata Query Service
+import email.utils
+import mwapi
+import requests
+import threading
+import time
+import urllib.parse
+
+from exceptions import UpstreamUnavailable
+import metrics
+
+
+API_TIMEOUT = 10  # seconds
+SPARQL_TIMEOUT = 30  # seconds, WDQS itself gives up after 60
+MAXLAG = 5  # seconds of replication lag after which the API asks reads to back off, see [[mw:Manual:Maxlag parameter]]
+FAILURE_THRESHOLD = 5  # consecutive failures after which a host’s circuit opens
+RESET_TIMEOUT = 30  # seconds before a trial call is let through an open circuit
+MAX_RETRY_AFTER = 300  # seconds, upper bound for Retry-After backoffs
+
+
+class CircuitBreaker:
+    """Fails calls to one upstream host fast after repeated failures or a Retry-After, until it has recovered.
+
+    After FAILURE_THRESHOLD consecutive failures, or when the host asks us to back off,
+    the circuit is open: calls raise UpstreamUnavailable immediately, without tying up
+    a worker until a timeout, for RESET_TIMEOUT seconds (or the Retry-After time).
+    Afterwards, a single trial call is let through; if it succeeds, the circuit closes again.
+    """
+
+    def __init__(self, host, failure_threshold=FAILURE_THRESHOLD, reset_timeout=RESET_TIMEOUT):
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.open_until = 0.0
+        self.trial_started = None
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        with self._lock:
+            now = time.monotonic()
+            if now < self.open_until:
+                raise UpstreamUnavailable(self.host, self.open_until - now)
+            if self.failures >= self.failure_threshold:
+                # half-open: let one trial call through (another one if it never reported back)
+                if self.trial_started is not None and now - self.trial_started < self.reset_timeout:
+                    raise UpstreamUnavailable(self.host, self.reset_timeout)
+                self.trial_started = now
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.trial_started = None
+
+    def failure(self, retry_after=None):
+        with self._lock:
+            self.failures += 1
+            self.trial_started = None
+            if retry_after is not None or self.failures >= self.failure_threshold:
+                self.open_until = time.monotonic() + (retry_after if retry_after is not None else self.reset_timeout)
+                metrics.increment('upstream_circuit_opened_total', host=self.host)
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def breaker(host):
+    with _breakers_lock:
+        if host not in _breakers:
+            _breakers[host] = CircuitBreaker(host)
+        return _breakers[host]
+
+
+class RateLimiter:
+    """A token bucket: allows rate calls per second on average, and bursts of up to burst calls"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Takes a token if one is available, returning whether the call may be made"""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+def parse_retry_after(value):
+    """Parses a Retry-After header (seconds or HTTP date) into seconds, capped at MAX_RETRY_AFTER"""
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = email.utils.parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+    return min(max(seconds, 0.0), MAX_RETRY_AFTER)
+
+
+class Session(mwapi.Session):
+    """An mwapi session that records every API call in the request metrics, keyed by action,
+    and protects the workers from a failing host with timeouts, a circuit breaker and maxlag."""
+
+    def __init__(self, host, *args, timeout=API_TIMEOUT, **kwargs):
+        super().__init__(host, *args, timeout=timeout, **kwargs)
+        self.hostname = urllib.parse.urlparse(self.host).hostname
+        self.retry_after = None
+        self.session.hooks['response'].append(self._remember_retry_after)
+
+    def _remember_retry_after(self, response, *args, **kwargs):
+        self.retry_after = parse_retry_after(response.headers.get('Retry-After'))
+
+    def _request(self, method, params=None, files=None, auth=None):
+        params = params or {}
+        action = params.get('action', 'unknown')
+        if method.upper() == 'GET':
+            # reads back off when the database replicas lag, edits are made on behalf of users and should not
+            params.setdefault('maxlag', MAXLAG)
+        host_breaker = breaker(self.hostname)
+        with metrics.timed('api', self.hostname, action):
+            host_breaker.before_call()
+            self.retry_after = None
+            try:
+                response = super()._request(method, params=params, files=files, auth=auth)
+            except mwapi.errors.APIError as error:
+                if error.code == 'maxlag':
+                    host_breaker.failure(self.retry_after or MAXLAG)
+                    raise UpstreamUnavailable(self.hostname, self.retry_after or MAXLAG) from error
+                host_breaker.success()
+                if error.code == 'ratelimited':
+                    # rate limits are per user and action (e.g. a project lead's edits), the host is fine for everyone else
+                    raise UpstreamUnavailable(self.hostname, self.retry_after) from error
+                raise
+            except (mwapi.errors.RequestError, ValueError) as error:
+                # timeouts, connection errors, and error pages instead of JSON (typically HTTP 429/5xx)
+                host_breaker.failure(self.retry_after)
+                raise UpstreamUnavailable(self.hostname, self.retry_after) from error
+            host_breaker.success()
+            return response
+
+
+def sparql(session, endpoint, query, timeout=SPARQL_TIMEOUT):
+    """Runs a SPARQL query with the given requests session and returns the decoded results"""
+    hostname = urllib.parse.urlparse(endpoint).hostname
+    host_breaker = breaker(hostname)
+    with metrics.timed('sparql', hostname, 'query'):
+        host_breaker.before_call()
+        try:
+            response = session.get(endpoint, params={'query': query}, timeout=timeout)
+        except requests.RequestException as error:
+            host_breaker.failure()
+            raise UpstreamUnavailable(hostname) from error
+        if response.status_code == 429 or response.status_code >= 500:
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            host_breaker.failure(retry_after)
+            raise UpstreamUnavailable(hostname, retry_after)
+        host_breaker.success()
+        response.raise_for_status()
+        return response.json()
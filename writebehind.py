@@ -0,0 +1,137 @@
+# write-behind buffering of local region (qualifier) updates
+import atexit
+import contextlib
+import logging
+import sqlite3
+import threading
+
+import metrics
+import queries
+import regions
+
+
+logger = logging.getLogger(__name__)
+
+
+class QualifierBuffer:
+    """Coalesces the region updates of local statements before writing them to the database.
+
+    While users drag and resize a region, every change is an upsert of the same qualifier.
+    The buffer keeps only the latest region per statement and writes all pending regions
+    in one transaction once delay seconds have passed since the first of them arrived.
+    Regions the database rejects are logged and dropped, so that they cannot hold up the others;
+    if the database is locked or unavailable, all of them are kept and written later.
+    get() returns pending regions, so readers in this process always see the latest one;
+    other worker processes see them after the flush. version increases with every buffered change,
+    for caches of data that includes pending regions.
+    """
+
+    def __init__(self, delay):
+        self.delay = delay
+        self._pending = {}  # statement ID -> (iiif_region, qualifier_hash)
+        self.version = 0
+        self._flushing = {}
+        self._timer = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.RLock()
+        atexit.register(self.flush)
+
+    def put(self, statement_id, iiif_region, qualifier_hash):
+        if regions.parse_pct_region(iiif_region) is None:
+            raise ValueError(f'Bad IIIF region {iiif_region!r}')
+        if self.delay <= 0:
+            queries.query_db(queries.add_qualifier(), params=[statement_id, iiif_region, qualifier_hash])
+            metrics.increment('qualifier_writes_total', outcome='written')
+            return
+        with self._lock:
+            coalesced = str(statement_id) in self._pending
+            self._pending[str(statement_id)] = (iiif_region, qualifier_hash)
+            self.version += 1
+            self._schedule()
+        metrics.increment('qualifier_writes_total', outcome='coalesced' if coalesced else 'buffered')
+
+    def get(self, statement_id):
+        """Returns the pending (iiif_region, qualifier_hash) of a statement, or None if there is none"""
+        with self._lock:
+            return self._pending.get(str(statement_id)) or self._flushing.get(str(statement_id))
+
+    def statement_ids(self):
+        """Returns the IDs of the statements with pending regions"""
+        with self._lock:
+            return sorted({*self._pending, *self._flushing})
+
+    def discard(self, statement_id):
+        """Drops the pending region of a statement, before its qualifier is written or deleted directly"""
+        # wait for a running flush, so it cannot write the region after the caller deleted it
+        with self._flush_lock, self._lock:
+            if self._pending.pop(str(statement_id), None) is not None:
+                self.version += 1
+
+    @contextlib.contextmanager
+    def paused(self):
+        """Keeps the buffer from being flushed meanwhile, so that its regions cannot be written over
+        direct writes of the same statements before the caller discards them"""
+        with self._flush_lock:
+            yield
+
+    def flush(self):
+        """Writes all pending regions, in one transaction unless the database rejects one of them"""
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                self._flushing = pending
+                timer, self._timer = self._timer, None
+            if timer is not None:
+                timer.cancel()
+            if not pending:
+                return
+            try:
+                self._write(pending)
+            except Exception:
+                # keep the regions (unless they have been superseded meanwhile) and try again later
+                with self._lock:
+                    self._pending = {**pending, **self._pending}
+                    self._schedule()
+                metrics.increment('qualifier_writes_total', len(pending), outcome='failed')
+                raise
+            finally:
+                with self._lock:
+                    self._flushing = {}
+            metrics.increment('qualifier_writes_total', len(pending), outcome='written')
+
+    def _write(self, pending):
+        # drops the regions the database rejects from pending
+        try:
+            with queries.transaction() as connection:
+                for statement_id, (iiif_region, qualifier_hash) in pending.items():
+                    queries.query_db(queries.add_qualifier(), params=[statement_id, iiif_region, qualifier_hash], connection=connection)
+            return
+        except sqlite3.OperationalError:
+            raise  # locked or unavailable, try all of them again later
+        except sqlite3.DatabaseError:
+            pass
+        for statement_id, (iiif_region, qualifier_hash) in list(pending.items()):
+            try:
+                queries.query_db(queries.add_qualifier(), params=[statement_id, iiif_region, qualifier_hash])
+            except sqlite3.OperationalError:
+                raise
+            except sqlite3.DatabaseError as error:
+                logger.warning('Dropping the region %s of statement %s, which the database rejected: %r', iiif_region, statement_id, error)
+                with self._lock:
+                    del pending[statement_id]
+                    self.version += 1
+                metrics.increment('qualifier_writes_total', outcome='dropped')
+
+    def _schedule(self):
+        # called with the lock held
+        if self._timer is None:
+            self._timer = threading.Timer(self.delay, self._scheduled_flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _scheduled_flush(self):
+        try:
+            self.flush()
+        except Exception as error:
+            # counted in flush(), and rescheduled
+            logger.warning('Writing the buffered regions failed, will try again: %r', error)